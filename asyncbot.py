@@ -0,0 +1,253 @@
+import asyncio, datetime, logging, signal
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from telegram.ext import ConversationHandler
+
+logger = logging.getLogger(__name__)
+
+def first_match(handlers, update):
+    for handler in handlers:
+        check = handler.check_update(update)
+        if check is not None and check is not False:
+            return handler, check
+    return None, None
+
+# Stands in for telegram.ext.CallbackContext in asyncio mode. The blocking
+# python-telegram-bot methods are awaited through call(), which runs them on
+# the engine's I/O thread pool.
+class AsyncContext:
+    def __init__(self, engine, user_data=None, chat_data=None):
+        self.engine = engine
+        self.bot = engine.bot
+        self.user_data = {} if user_data is None else user_data
+        self.chat_data = {} if chat_data is None else chat_data
+        self.args = None
+        self.matches = None
+
+    # Handlers' collect_additional_context() passes extra attributes this way.
+    def update(self, data):
+        self.__dict__.update(data)
+
+    async def call(self, fn, *args, **kwargs):
+        return await self.engine.call(fn, *args, **kwargs)
+
+# Runs a telegram.ext.ConversationHandler's entry points, states and
+# fallbacks the same way the threaded dispatcher does, keyed by (chat, user),
+# including conversation_timeout and the TIMEOUT state.
+class AsyncConversation:
+    def __init__(self, engine, handler):
+        self.engine = engine
+        self.handler = handler
+        self.states = {}
+        self.timers = {}
+
+    def check_update(self, update):
+        if update.effective_chat is None or update.effective_user is None:
+            return None
+        key = (update.effective_chat.id, update.effective_user.id)
+        state = self.states.get(key)
+        handler = check = None
+        if state is None or self.handler.allow_reentry:
+            handler, check = first_match(self.handler.entry_points, update)
+            if handler is None and state is None:
+                return None
+        if handler is None:
+            handler, check = first_match(self.handler.states.get(state, []), update)
+        if handler is None:
+            handler, check = first_match(self.handler.fallbacks, update)
+        if handler is None:
+            return None
+        return key, handler, check
+
+    async def handle_update(self, update, key, handler, check):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        new_state = await self.engine.invoke(handler, update, check)
+        if new_state == ConversationHandler.END:
+            self.states.pop(key, None)
+            return
+        if new_state is not None:
+            self.states[key] = new_state
+        if self.handler.conversation_timeout and key in self.states:
+            self.timers[key] = asyncio.get_running_loop().create_task(self.expire(key, update))
+
+    async def expire(self, key, update):
+        await asyncio.sleep(self.handler.conversation_timeout)
+        async with self.engine.chat_lock(key[0]):
+            if self.timers.get(key) is not asyncio.current_task():
+                return
+            del self.timers[key]
+            for handler in self.handler.states.get(ConversationHandler.TIMEOUT, []):
+                check = handler.check_update(update)
+                if check is not None and check is not False:
+                    try:
+                        await self.engine.invoke(handler, update, check)
+                    except Exception:
+                        logger.exception("Conversation timeout handler failed")
+            self.states.pop(key, None)
+
+# Asyncio counterpart of Updater + Dispatcher. Handlers are registered the
+# same way (groups included); a callback that has an entry in
+# async_callbacks is replaced by that coroutine function, and any other
+# callback runs on a small thread pool. Conversations are plain state in
+# memory, so thousands of them cost no threads: blocking work only holds a
+# thread of one of the bounded pools while it runs. Updates from the same
+# chat are handled one at a time and in order, different chats concurrently,
+# and at most max_pending_updates are in flight before polling waits.
+class AsyncEngine:
+    def __init__(self, bot, async_callbacks=None, io_workers=16, handler_workers=8, max_pending_updates=1000, poll_timeout=30):
+        self.bot = bot
+        self.async_callbacks = async_callbacks or {}
+        self.groups = defaultdict(list)
+        self.user_data = defaultdict(dict)
+        self.chat_data = defaultdict(dict)
+        self.io_executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="telegram-io")
+        self.handler_executor = ThreadPoolExecutor(max_workers=handler_workers, thread_name_prefix="sync-handler")
+        self.poll_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="poll")
+        self.max_pending_updates = max_pending_updates
+        self.poll_timeout = poll_timeout
+        self.chat_locks = {}
+        self.tasks = set()
+        self.jobs = []
+
+    def add_handler(self, handler, group=0):
+        if isinstance(handler, ConversationHandler):
+            handler = AsyncConversation(self, handler)
+        self.groups[group].append(handler)
+
+    def run_repeating(self, callback, interval):
+        self.jobs.append(partial(self.repeat, callback, interval))
+
+    def run_daily(self, callback, time):
+        self.jobs.append(partial(self.daily, callback, time))
+
+    async def call(self, fn, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.io_executor, partial(fn, *args, **kwargs))
+
+    async def run_callback(self, callback, *args):
+        if asyncio.iscoroutinefunction(callback):
+            return await callback(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.handler_executor, partial(callback, *args))
+
+    async def invoke(self, handler, update, check):
+        user, chat = update.effective_user, update.effective_chat
+        context = AsyncContext(
+            self, None if user is None else self.user_data[user.id], None if chat is None else self.chat_data[chat.id]
+        )
+        handler.collect_additional_context(context, update, None, check)
+        callback = self.async_callbacks.get(handler.callback, handler.callback)
+        return await self.run_callback(callback, update, context)
+
+    @asynccontextmanager
+    async def chat_lock(self, chat_id):
+        entry = self.chat_locks.get(chat_id)
+        if entry is None:
+            entry = self.chat_locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.chat_locks[chat_id]
+
+    async def process_update(self, update):
+        chat_id = None if update.effective_chat is None else update.effective_chat.id
+        async with self.chat_lock(chat_id):
+            for group in sorted(self.groups):
+                for handler in self.groups[group]:
+                    try:
+                        if isinstance(handler, AsyncConversation):
+                            match = handler.check_update(update)
+                            if match is None:
+                                continue
+                            await handler.handle_update(update, *match)
+                        else:
+                            check = handler.check_update(update)
+                            if check is None or check is False:
+                                continue
+                            await self.invoke(handler, update, check)
+                    except Exception:
+                        logger.exception("Error while handling update %s", update.update_id)
+                    break
+
+    # Hands an update to the engine, waiting while max_pending_updates are
+    # already being handled.
+    async def put_update(self, update):
+        await self.pending.acquire()
+        task = asyncio.get_running_loop().create_task(self.process_update(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.finish_update)
+
+    def finish_update(self, task):
+        self.tasks.discard(task)
+        self.pending.release()
+
+    async def poll(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.poll_executor, self.bot.delete_webhook)
+        offset = None
+        while True:
+            try:
+                updates = await loop.run_in_executor(
+                    self.poll_executor, partial(self.bot.get_updates, offset=offset, timeout=self.poll_timeout)
+                )
+            except Exception:
+                logger.exception("Fetching updates failed, retrying")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                await self.put_update(update)
+
+    async def run_job(self, callback):
+        try:
+            await self.run_callback(callback, AsyncContext(self))
+        except Exception:
+            logger.exception("Job %s failed", getattr(callback, "__name__", callback))
+
+    async def repeat(self, callback, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self.run_job(callback)
+
+    async def daily(self, callback, time):
+        while True:
+            now = datetime.datetime.now(time.tzinfo or datetime.timezone.utc)
+            target = now.replace(hour=time.hour, minute=time.minute, second=time.second, microsecond=0)
+            if target <= now:
+                target += datetime.timedelta(days=1)
+            await asyncio.sleep((target - now).total_seconds())
+            await self.run_job(callback)
+
+    async def serve(self, source=None):
+        self.pending = asyncio.Semaphore(self.max_pending_updates)
+        loop = asyncio.get_running_loop()
+        main_task = asyncio.current_task()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, main_task.cancel)
+        except (NotImplementedError, RuntimeError):
+            pass
+        jobs = [loop.create_task(job()) for job in self.jobs]
+        try:
+            await (self.poll() if source is None else source(self))
+        finally:
+            for job in jobs:
+                job.cancel()
+            if self.tasks:
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    # Blocks until interrupted, like Updater.start_polling() followed by
+    # idle(). source(engine) may replace polling as the supplier of updates.
+    def run(self, source=None):
+        try:
+            asyncio.run(self.serve(source))
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        finally:
+            for executor in (self.poll_executor, self.handler_executor, self.io_executor):
+                executor.shutdown(wait=False)
@@ -0,0 +1,347 @@
+import argparse, json, os, random, statistics, subprocess, sys, tempfile, threading, time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# libraries that should only be imported once a feature needs them
+HEAVY_MODULES = ["selenium", "webdriver_manager", "telepot", "firebase", "google.cloud.storage", "PIL", "flask"]
+
+# Runs in a fresh interpreter: imports the bot, then does everything main()
+# does before it starts polling, without touching the network.
+STARTUP_PROBE = """
+import json, queue, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.db.setup()
+main.usernames.load()
+main.build_dispatcher(queue.Queue())
+ready = time.perf_counter()
+print(json.dumps({
+    "import_s": imported - started,
+    "ready_s": ready - started,
+    "heavy_modules": [name for name in %r if name in sys.modules],
+}))
+""" % (HEAVY_MODULES,)
+
+def run_startup_probe(importtime=False):
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, PYTHONPATH=ROOT, PHOTO_DIR=os.path.join(workdir, "photos"))
+        # Bot() only checks the token's format, it never calls Telegram here
+        env.setdefault("API_KEY", "123456:benchmark-token-benchmark-token-abc")
+        command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", STARTUP_PROBE]
+        started = time.perf_counter()
+        result = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True)
+        elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError("startup probe failed:\n" + result.stderr)
+    probe = json.loads(result.stdout.strip().splitlines()[-1])
+    probe["process_s"] = elapsed
+    return probe, result.stderr
+
+def slowest_imports(importtime_log, top):
+    # lines look like "import time:   self [us] | cumulative | imported package"
+    timings = []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        timings.append((int(cumulative_us), name.strip()))
+    timings.sort(reverse=True)
+    return [{"module": name, "cumulative_ms": round(us / 1000, 1)} for us, name in timings[:top]]
+
+def summarize(samples):
+    return {
+        "min": round(min(samples), 4),
+        "median": round(statistics.median(samples), 4),
+        "max": round(max(samples), 4),
+    }
+
+def bench_startup(runs=5, importtime=False, top=15):
+    """Measures import and ready-to-poll time of main.py over fresh interpreters."""
+    probes = [run_startup_probe()[0] for _ in range(runs)]
+    report = {
+        "runs": runs,
+        "import_s": summarize([probe["import_s"] for probe in probes]),
+        "ready_s": summarize([probe["ready_s"] for probe in probes]),
+        "process_s": summarize([probe["process_s"] for probe in probes]),
+        "heavy_modules": probes[-1]["heavy_modules"],
+    }
+    if importtime:
+        report["slowest_imports"] = slowest_imports(run_startup_probe(importtime=True)[1], top)
+    return report
+
+# Stand-ins for the python-telegram-bot objects handlers touch. Every call
+# that would reach Telegram returns straight away and is only counted.
+class FakeUser:
+    def __init__(self, user_id, username):
+        self.id = user_id
+        self.username = username
+        self.first_name = username
+
+    def mention_markdown_v2(self):
+        return "[{}](tg://user?id={})".format(self.first_name, self.id)
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+        self.type = "private"
+
+class FakePhotoSize:
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+class FakeMessage:
+    def __init__(self, bench, user, text=None):
+        self.bench = bench
+        self.from_user = user
+        self.chat = FakeChat(user.id)
+        self.chat_id = user.id
+        self.text = text
+        self.photo = []
+        self.document = None
+
+    def reply(self, *args, **kwargs):
+        self.bench.api_call()
+        return FakeMessage(self.bench, self.from_user)
+
+    def reply_photo(self, photo, *args, **kwargs):
+        sent = self.reply()
+        sent.photo = [FakePhotoSize("bench-file-id")]
+        return sent
+
+    reply_text = reply_markdown_v2 = reply_document = edit_text = reply
+
+class FakeCallbackQuery:
+    def __init__(self, bench, user, data):
+        self.bench = bench
+        self.from_user = user
+        self.data = data
+        self.message = FakeMessage(bench, user)
+
+    # answer() and friends also run on the Sender's threads
+    def call(self, *args, **kwargs):
+        self.bench.api_call()
+        return True
+
+    answer = edit_message_text = edit_message_reply_markup = call
+
+class FakeUpdate:
+    def __init__(self, message=None, callback_query=None):
+        self.message = message
+        self.callback_query = callback_query
+        user = (message or callback_query).from_user
+        self.effective_user = user
+        self.effective_chat = FakeChat(user.id)
+
+class FakeContext:
+    def __init__(self, bot, user_data):
+        self.bot = bot
+        self.user_data = user_data
+        self.chat_data = {}
+
+# Counts the statements SQLite runs on any of the DBHelper's connections.
+class StatementCounter:
+    def __init__(self, db):
+        self.count = 0
+        self.lock = threading.Lock()
+        self.trace(db.pool.writer)
+        for conn in list(db.pool.readers.queue):
+            self.trace(conn)
+        connect = db.pool.connect
+        db.pool.connect = lambda: self.trace(connect())
+
+    def trace(self, conn):
+        conn.set_trace_callback(self.statement)
+        return conn
+
+    def statement(self, _sql):
+        with self.lock:
+            self.count += 1
+
+# Version of the scenario below; bump it when the scenario changes so that
+# reports from different versions are not compared.
+SCENARIO = 1
+WORDS = ["chicken", "rice", "garlic", "ginger", "soy", "egg", "noodle", "pork", "beef", "chilli", "lime", "onion", "tofu", "basil", "butter"]
+
+class HandlerBench:
+    def __init__(self, main, seed):
+        self.main = main
+        self.random = random.Random(seed)
+        self.counter = StatementCounter(main.db)
+        self.latencies = defaultdict(list)
+        self.statements = defaultdict(list)
+        self.api_calls = 0
+        self.lock = threading.Lock()
+
+    def api_call(self):
+        with self.lock:
+            self.api_calls += 1
+
+    def run(self, handler, update, context):
+        before = self.counter.count
+        started = time.perf_counter()
+        getattr(self.main, handler)(update, context)
+        self.latencies[handler].append(time.perf_counter() - started)
+        self.statements[handler].append(self.counter.count - before)
+
+    def text(self, handler, user, context, text):
+        self.run(handler, FakeUpdate(message=FakeMessage(self, user, text)), context)
+
+    def tap(self, handler, user, context, data):
+        self.run(handler, FakeUpdate(callback_query=FakeCallbackQuery(self, user, data)), context)
+
+    def phrase(self, words):
+        return " ".join(self.random.sample(WORDS, words))
+
+    # One synthetic user going through /start, /add, /view, /search, /edit
+    # and /delete, the same way for every run.
+    def user_session(self, user_id):
+        user = FakeUser(user_id, "bench{}".format(user_id))
+        context = FakeContext(None, {})
+        recipe_name = "{} {}".format(self.phrase(2), user_id)
+        self.text("start", user, context, "/start")
+
+        self.text("add_recipe", user, context, "/add")
+        self.text("name", user, context, recipe_name)
+        self.text("skip_photo", user, context, "/skip")
+        self.text("servings", user, context, "4 people")
+        for i in range(6):
+            self.text("ingredients", user, context, "{} {}".format(i + 1, self.phrase(2)))
+        self.text("ingredients", user, context, "/done")
+        for i in range(6):
+            self.text("steps", user, context, "Step {}: {}".format(i + 1, self.phrase(5)))
+        self.text("steps", user, context, "/done")
+
+        self.text("view_recipe", user, context, "/view")
+        self.text("send_recipe", user, context, recipe_name)
+        self.text("search_recipes", user, context, "/search " + self.random.choice(WORDS))
+
+        self.text("edit_recipe", user, context, "/edit")
+        self.tap("recipe_choice", user, context, recipe_name)
+        self.tap("edit_ingredients", user, context, "ingredients")
+        self.tap("ingredients_list_operation", user, context, "add")
+        self.text("add_ingredient", user, context, "a pinch of " + self.phrase(1))
+        ingredient_ids = self.main.db.load_recipe(user_id, recipe_name).ingredient_ids
+        self.tap("ingredients_list_operation", user, context, "edit")
+        self.tap("update_ingredient", user, context, "ingredient {}".format(ingredient_ids[0]))
+        self.text("save_ingredient", user, context, "2 cups of " + self.phrase(1))
+        self.tap("ingredients_list_operation", user, context, "delete")
+        self.tap("delete_ingredient", user, context, "ingredient {}".format(ingredient_ids[1]))
+        self.tap("recipe_choice", user, context, recipe_name)
+        self.tap("edit_steps", user, context, "directions")
+        step_ids = self.main.db.load_recipe(user_id, recipe_name).step_ids
+        self.tap("steps_list_operation", user, context, "move")
+        self.tap("move_step", user, context, "step {}".format(step_ids[0]))
+        self.tap("move_step_to", user, context, "move to the end")
+        self.tap("steps_list_operation", user, context, "edit")
+        self.tap("update_step", user, context, "step {}".format(step_ids[1]))
+        self.text("save_step", user, context, "Taste and " + self.phrase(3))
+        self.tap("steps_list_operation", user, context, "delete")
+        self.tap("delete_step", user, context, "step {}".format(step_ids[2]))
+        self.tap("toggle_privacy", user, context, "set private")
+        self.tap("toggle_privacy", user, context, "set public")
+
+        self.text("delete_recipe", user, context, "/delete")
+        self.tap("confirmation", user, context, recipe_name)
+        self.tap("deletion", user, context, "yes")
+
+    def report(self, elapsed):
+        handlers = {}
+        for handler, samples in sorted(self.latencies.items()):
+            samples = sorted(samples)
+            handlers[handler] = {
+                "calls": len(samples),
+                "p50_ms": round(samples[len(samples) // 2] * 1000, 3),
+                "p99_ms": round(samples[min(len(samples) - 1, len(samples) * 99 // 100)] * 1000, 3),
+                "sql_per_update": round(statistics.mean(self.statements[handler]), 2),
+                "per_second": round(len(samples) / sum(samples), 1) if sum(samples) else None,
+            }
+        updates = sum(handler["calls"] for handler in handlers.values())
+        return {
+            "updates": updates,
+            "seconds": round(elapsed, 3),
+            "updates_per_second": round(updates / elapsed, 1),
+            "sql_statements": self.counter.count,
+            "api_calls": self.api_calls,
+            "handlers": handlers,
+        }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def bench_handlers(users=200, seed=1, warmup=20, sql_stats=False):
+    """Drives the real handlers with synthetic users against a scratch database."""
+    workdir = tempfile.mkdtemp(prefix="botmama-bench-")
+    os.environ.setdefault("API_KEY", "123456:benchmark-token-benchmark-token-abc")
+    os.environ["PHOTO_DIR"] = os.path.join(workdir, "photos")
+    os.environ["SQL_STATS"] = "1" if sql_stats else "0"
+    # main.py opens recipes.sqlite in the working directory when imported
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import main
+    main.db.setup()
+    main.usernames.load()
+    for user_id in range(1, warmup + 1):
+        HandlerBench(main, seed).user_session(user_id)
+    bench = HandlerBench(main, seed)
+    started = time.perf_counter()
+    for user_id in range(warmup + 1, warmup + users + 1):
+        bench.user_session(user_id)
+    elapsed = time.perf_counter() - started
+    main.sender.shutdown()
+    report = bench.report(elapsed)
+    if main.sql_stats is not None:
+        # includes the warmup users
+        report["sql"] = {
+            method: {"calls": entry["calls"], "ms": round(entry["seconds"] * 1000, 1), "rows": entry["rows"]}
+            for method, entry in sorted(main.sql_stats.snapshot().items(), key=lambda item: item[1]["seconds"], reverse=True)
+        }
+    return dict({"commit": git_commit(), "scenario": SCENARIO, "users": users, "seed": seed, "python": sys.version.split()[0], "sql_stats": sql_stats}, **report)
+
+# Ratio of each handler's p50 and p99 to the baseline's, e.g. 0.8 is 20% faster.
+def compare(report, baseline):
+    if baseline.get("scenario") != report["scenario"] or baseline.get("users") != report["users"]:
+        raise SystemExit("baseline was run with a different scenario or number of users")
+    changes = {}
+    for handler, result in report["handlers"].items():
+        before = baseline["handlers"].get(handler)
+        if before is None:
+            continue
+        changes[handler] = {
+            key: round(result[key] / before[key], 2) if before[key] else None for key in ("p50_ms", "p99_ms", "sql_per_update")
+        }
+    return {"baseline_commit": baseline.get("commit"), "changes": changes}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks for BotMaMa.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    startup_parser = commands.add_parser("startup", help="time importing main.py and getting ready to poll")
+    startup_parser.add_argument("--runs", type=int, default=5)
+    startup_parser.add_argument("--importtime", action="store_true", help="also list the slowest imports")
+    startup_parser.add_argument("--top", type=int, default=15)
+    handlers_parser = commands.add_parser("handlers", help="time the handlers with synthetic users, offline")
+    handlers_parser.add_argument("--users", type=int, default=200)
+    handlers_parser.add_argument("--seed", type=int, default=1)
+    handlers_parser.add_argument("--baseline", help="report from an earlier run to compare with")
+    handlers_parser.add_argument("--out", help="also write the report to this file")
+    handlers_parser.add_argument("--sql-stats", action="store_true", help="run with SQL_STATS=1 and add the time spent per DBHelper method")
+    args = parser.parse_args()
+
+    if args.command == "startup":
+        print(json.dumps(bench_startup(args.runs, args.importtime, args.top), indent=2))
+    else:
+        report = bench_handlers(args.users, args.seed, sql_stats=args.sql_stats)
+        if args.baseline:
+            with open(args.baseline, encoding="utf-8") as f:
+                report["comparison"] = compare(report, json.load(f))
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
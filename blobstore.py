@@ -0,0 +1,60 @@
+import hashlib, os, threading
+from urllib.parse import quote, unquote
+
+EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp"}
+
+def content_key(data, content_type="image/jpeg"):
+    return hashlib.sha256(data).hexdigest() + EXTENSIONS.get(content_type, "")
+
+# Blob stores keep photos under the hash of their content, so the same photo
+# is stored once no matter how many recipes use it and renaming a recipe
+# never touches storage. Callers only deal in public URLs: put() returns one
+# and delete() takes one back.
+class GCSStore:
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    @classmethod
+    def from_bucket_name(cls, bucket_name):
+        from google.cloud import storage
+        return cls(storage.Client().get_bucket(bucket_name))
+
+    def put(self, data, content_type="image/jpeg"):
+        blob = self.bucket.blob(content_key(data, content_type))
+        if not blob.exists():
+            blob.upload_from_string(data, content_type=content_type)
+            blob.make_public()
+        return blob.public_url
+
+    def delete(self, url):
+        blob = self.bucket.get_blob(unquote(url.split("?")[0].rsplit("/", 1)[-1]))
+        if blob is not None:
+            blob.delete()
+
+# Keeps photos in a local directory, for development and tests. URLs are
+# base_url + key when a base_url is given (e.g. a static file server in front
+# of root), and file:// URLs otherwise.
+class LocalStore:
+    def __init__(self, root, base_url=None):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip("/") + "/" if base_url else "file://" + quote(self.root) + "/"
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def put(self, data, content_type="image/jpeg"):
+        key = content_key(data, content_type)
+        path = os.path.join(self.root, key)
+        with self.lock:
+            if not os.path.exists(path):
+                with open(path + ".part", "wb") as f:
+                    f.write(data)
+                os.replace(path + ".part", path)
+        return self.base_url + key
+
+    def delete(self, url):
+        if not url.startswith(self.base_url):
+            return
+        path = os.path.join(self.root, os.path.basename(unquote(url[len(self.base_url):])))
+        with self.lock:
+            if os.path.exists(path):
+                os.remove(path)
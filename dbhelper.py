@@ -1,9 +1,247 @@
-import sqlite3
+import sqlite3, threading, queue, json, asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from sqlstats import InstrumentedConnection
+
+# Keep the recipe_search full-text index in step with the base tables.
+SEARCH_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS recipe_search_insert AFTER INSERT ON recipe BEGIN
+           INSERT INTO recipe_search (rowid, recipe_name, ingredients, steps) VALUES (NEW.recipe_id, NEW.recipe_name,
+               IFNULL((SELECT group_concat(ingredient_name, ' ') FROM ingredient WHERE recipe_id = NEW.recipe_id), ''),
+               IFNULL((SELECT group_concat(details, ' ') FROM step WHERE recipe_id = NEW.recipe_id), ''));
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS recipe_search_rename AFTER UPDATE OF recipe_name ON recipe BEGIN
+           UPDATE recipe_search SET recipe_name = NEW.recipe_name WHERE rowid = NEW.recipe_id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS recipe_search_delete AFTER DELETE ON recipe BEGIN
+           DELETE FROM recipe_search WHERE rowid = OLD.recipe_id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS ingredient_search_insert AFTER INSERT ON ingredient BEGIN
+           UPDATE recipe_search SET ingredients = (SELECT group_concat(ingredient_name, ' ') FROM ingredient WHERE recipe_id = NEW.recipe_id) WHERE rowid = NEW.recipe_id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS ingredient_search_update AFTER UPDATE ON ingredient BEGIN
+           UPDATE recipe_search SET ingredients = (SELECT group_concat(ingredient_name, ' ') FROM ingredient WHERE recipe_id = NEW.recipe_id) WHERE rowid = NEW.recipe_id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS ingredient_search_delete AFTER DELETE ON ingredient BEGIN
+           UPDATE recipe_search SET ingredients = IFNULL((SELECT group_concat(ingredient_name, ' ') FROM ingredient WHERE recipe_id = OLD.recipe_id), '') WHERE rowid = OLD.recipe_id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS step_search_insert AFTER INSERT ON step BEGIN
+           UPDATE recipe_search SET steps = (SELECT group_concat(details, ' ') FROM step WHERE recipe_id = NEW.recipe_id) WHERE rowid = NEW.recipe_id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS step_search_update AFTER UPDATE ON step BEGIN
+           UPDATE recipe_search SET steps = (SELECT group_concat(details, ' ') FROM step WHERE recipe_id = NEW.recipe_id) WHERE rowid = NEW.recipe_id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS step_search_delete AFTER DELETE ON step BEGIN
+           UPDATE recipe_search SET steps = IFNULL((SELECT group_concat(details, ' ') FROM step WHERE recipe_id = OLD.recipe_id), '') WHERE rowid = OLD.recipe_id;
+       END""",
+]
+
+# Each entry upgrades the schema by one version; PRAGMA user_version records
+# how many have been applied to a given database file.
+MIGRATIONS = [
+    [
+        "CREATE INDEX IF NOT EXISTS recipe_user_name_idx ON recipe (user_id, recipe_name)",
+        "CREATE INDEX IF NOT EXISTS ingredient_recipe_idx ON ingredient (recipe_id)",
+        "CREATE INDEX IF NOT EXISTS step_recipe_idx ON step (recipe_id)",
+        "CREATE INDEX IF NOT EXISTS user_username_idx ON user (username)",
+    ],
+    [
+        # Full-text index over each recipe's name, ingredients and steps, with
+        # rowid = recipe_id.
+        "CREATE VIRTUAL TABLE IF NOT EXISTS recipe_search USING fts5 (recipe_name, ingredients, steps, tokenize = 'porter unicode61')",
+    ] + SEARCH_TRIGGERS + [
+        """INSERT INTO recipe_search (rowid, recipe_name, ingredients, steps)
+           SELECT recipe_id, recipe_name,
+                  IFNULL((SELECT group_concat(ingredient_name, ' ') FROM ingredient WHERE recipe_id = recipe.recipe_id), ''),
+                  IFNULL((SELECT group_concat(details, ' ') FROM step WHERE recipe_id = recipe.recipe_id), '')
+           FROM recipe""",
+    ],
+    # Surrogate ids and explicit ordering for ingredients and steps. The tables
+    # are rebuilt, so the search triggers that refer to them are recreated.
+    ["DROP TRIGGER IF EXISTS " + name for name in (
+        "recipe_search_insert", "recipe_search_rename", "recipe_search_delete",
+        "ingredient_search_insert", "ingredient_search_update", "ingredient_search_delete",
+        "step_search_insert", "step_search_update", "step_search_delete",
+    )] + [
+        """CREATE TABLE ingredient_new
+           (ingredient_id INTEGER PRIMARY KEY,
+            ingredient_name TEXT NOT NULL,
+            recipe_id INT NOT NULL,
+            position REAL NOT NULL,
+            FOREIGN KEY(recipe_id) REFERENCES recipe(recipe_id) ON UPDATE NO ACTION ON DELETE CASCADE
+           )""",
+        "INSERT INTO ingredient_new (ingredient_id, ingredient_name, recipe_id, position) SELECT rowid, ingredient_name, recipe_id, rowid FROM ingredient",
+        "DROP TABLE ingredient",
+        "ALTER TABLE ingredient_new RENAME TO ingredient",
+        "CREATE INDEX ingredient_recipe_idx ON ingredient (recipe_id, position)",
+        """CREATE TABLE step_new
+           (step_id INTEGER PRIMARY KEY,
+            details TEXT NOT NULL,
+            recipe_id INT NOT NULL,
+            position REAL NOT NULL,
+            FOREIGN KEY(recipe_id) REFERENCES recipe(recipe_id) ON UPDATE NO ACTION ON DELETE CASCADE
+           )""",
+        "INSERT INTO step_new (step_id, details, recipe_id, position) SELECT rowid, details, recipe_id, rowid FROM step",
+        "DROP TABLE step",
+        "ALTER TABLE step_new RENAME TO step",
+        "CREATE INDEX step_recipe_idx ON step (recipe_id, position)",
+    ] + SEARCH_TRIGGERS,
+    [
+        # Telegram file_id of the recipe photo, so it is only fetched from
+        # picture_url the first time it is sent.
+        "ALTER TABLE recipe ADD COLUMN picture_file_id TEXT",
+        "CREATE INDEX recipe_picture_idx ON recipe (picture_url)",
+    ],
+    [
+        # Small version of the photo for menus, with its own Telegram file_id.
+        "ALTER TABLE recipe ADD COLUMN thumbnail_url TEXT",
+        "ALTER TABLE recipe ADD COLUMN thumbnail_file_id TEXT",
+        "CREATE INDEX recipe_thumbnail_idx ON recipe (thumbnail_url)",
+    ],
+    [
+        # When the username refresh job last looked each chat up, so a run that
+        # was interrupted resumes where it stopped.
+        "CREATE TABLE username_check (chat_id INTEGER PRIMARY KEY, checked_at REAL NOT NULL)",
+        "CREATE INDEX user_chat_idx ON user (chat_id)",
+    ],
+    [
+        # Deleting a recipe used to leave its ingredients and steps behind.
+        "DELETE FROM ingredient WHERE recipe_id NOT IN (SELECT recipe_id FROM recipe)",
+        "DELETE FROM step WHERE recipe_id NOT IN (SELECT recipe_id FROM recipe)",
+    ],
+]
+
+class Recipe:
+    __slots__ = ("recipe_id", "name", "public", "servings", "picture_url", "picture_file_id", "thumbnail_url", "thumbnail_file_id", "ingredients", "steps", "ingredient_ids", "step_ids", "rendered")
+
+    def __init__(self, recipe_id, name, public, servings, picture_url, picture_file_id, thumbnail_url, thumbnail_file_id, ingredients, steps, ingredient_ids, step_ids):
+        self.recipe_id = recipe_id
+        self.name = name
+        self.public = public
+        self.servings = servings
+        self.picture_url = picture_url
+        self.picture_file_id = picture_file_id
+        self.thumbnail_url = thumbnail_url
+        self.thumbnail_file_id = thumbnail_file_id
+        self.ingredients = ingredients
+        self.steps = steps
+        self.ingredient_ids = ingredient_ids
+        self.step_ids = step_ids
+        self.rendered = None
+
+# Bounded LRU of loaded recipes keyed by (user_id, recipe_id). Cached
+# recipes are shared between handlers and must not be modified. Every
+# invalidation bumps the generation, so a load that raced with a write
+# cannot put the stale copy back.
+class RecipeCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.names = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id, recipe_name):
+        with self.lock:
+            recipe_id = self.names.get((user_id, recipe_name))
+            if recipe_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end((user_id, recipe_id))
+            return self.entries[(user_id, recipe_id)]
+
+    def put(self, user_id, recipe, generation):
+        with self.lock:
+            if generation != self.generation or self.maxsize <= 0:
+                return
+            self.entries[(user_id, recipe.recipe_id)] = recipe
+            self.entries.move_to_end((user_id, recipe.recipe_id))
+            self.names[(user_id, recipe.name)] = recipe.recipe_id
+            while len(self.entries) > self.maxsize:
+                (old_user_id, _), old = self.entries.popitem(last=False)
+                self.names.pop((old_user_id, old.name), None)
+                self.evictions += 1
+
+    def invalidate(self, user_id, recipe_name):
+        with self.lock:
+            self.generation += 1
+            recipe_id = self.names.pop((user_id, recipe_name), None)
+            if recipe_id is not None:
+                self.entries.pop((user_id, recipe_id), None)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            hit_rate = self.hits / lookups if lookups else 0.0
+            return {"size": len(self.entries), "evictions": self.evictions, "hits": self.hits, "misses": self.misses, "hit_rate": hit_rate}
+
+# Hands out SQLite connections: one writer shared behind a lock, and up to
+# pool_size reader connections that a thread holds for the length of a read.
+# With a sqlstats.QueryStats as stats every statement is timed; without, the
+# connections are plain sqlite3 ones.
+class ConnectionPool:
+    def __init__(self, dbname, pool_size=4, busy_timeout=5.0, synchronous="NORMAL", stats=None):
+        self.dbname = dbname
+        self.size = pool_size
+        self.busy_timeout = busy_timeout
+        self.synchronous = synchronous
+        self.stats = stats
+        self.writer = self.connect()
+        self.readers = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.local = threading.local()
+
+    def connect(self):
+        if self.stats is None:
+            conn = sqlite3.connect(self.dbname, timeout=self.busy_timeout, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.dbname, timeout=self.busy_timeout, check_same_thread=False, factory=InstrumentedConnection)
+            conn.stats = self.stats
+        # WAL lets readers run alongside the writer, and with it NORMAL only
+        # syncs at checkpoints instead of on every commit.
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = {}".format(self.synchronous))
+        return conn
+
+    @contextmanager
+    def reader(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        with self.slots:
+            try:
+                conn = self.readers.get_nowait()
+            except queue.Empty:
+                conn = self.connect()
+            self.local.conn = conn
+            try:
+                yield conn
+            finally:
+                self.local.conn = None
+                conn.rollback()
+                self.readers.put(conn)
+
+    def close(self):
+        while not self.readers.empty():
+            self.readers.get_nowait().close()
+        self.writer.close()
 
 class DBHelper:
-    def __init__(self, dbname="recipes.sqlite"):
+    def __init__(self, dbname="recipes.sqlite", pool_size=4, busy_timeout=5.0, synchronous="NORMAL", cache_size=1024, stats=None):
         self.dbname = dbname
-        self.conn = sqlite3.connect(dbname, check_same_thread=False)
+        self.stats = stats
+        self.pool = ConnectionPool(dbname, pool_size, busy_timeout, synchronous, stats)
+        self.cache = RecipeCache(cache_size)
+        self.conn = self.pool.writer
+        self.lock = threading.RLock()
+        self.local = threading.local()
 
     def setup(self):
         stmt = (''' CREATE TABLE IF NOT EXISTS user
@@ -36,160 +274,576 @@ class DBHelper:
                    );''')
         self.conn.execute(stmt)
         self.conn.commit()
+        self.migrate()
+
+    # Mutations made inside the block (including nested blocks) share one commit.
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            depth = getattr(self.local, "depth", 0)
+            if depth == 0:
+                self.local.invalidated = []
+            self.local.depth = depth + 1
+            try:
+                yield self
+            except BaseException:
+                self.local.depth = depth
+                if depth == 0:
+                    self.conn.rollback()
+                    self.flush_invalidations()
+                raise
+            self.local.depth = depth
+            if depth == 0:
+                self.conn.commit()
+                self.flush_invalidations()
+
+    # Cached recipes are dropped only once the change is committed, so no
+    # other thread can re-cache the old rows in between.
+    def invalidate(self, user_id, recipe_name):
+        self.local.invalidated.append((user_id, recipe_name))
+
+    def flush_invalidations(self):
+        for user_id, recipe_name in self.local.invalidated:
+            self.cache.invalidate(user_id, recipe_name)
+        self.local.invalidated = []
+
+    # Reads inside a transaction go through the writer so they see its
+    # uncommitted changes; an in-memory database only exists on the writer.
+    @contextmanager
+    def reader(self):
+        if getattr(self.local, "depth", 0) or self.dbname == ":memory:":
+            with self.lock:
+                yield self.conn
+        else:
+            with self.pool.reader() as conn:
+                yield conn
 
+    def get_schema_version(self):
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self):
+        version = self.get_schema_version()
+        for target, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            # sqlite3 does not open a transaction for DDL on its own, so one is
+            # begun explicitly to apply each migration all or nothing.
+            self.conn.execute("BEGIN")
+            try:
+                for stmt in statements:
+                    self.conn.execute(stmt)
+                self.conn.execute("PRAGMA user_version = {}".format(target))
+            except BaseException:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
 
     def add_user(self, user_id, chat_id, username):
         stmt = "INSERT OR IGNORE INTO user (user_id, chat_id, username) VALUES (?, ?, ?)"
         args = (user_id, chat_id, username)
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+        with self.transaction():
+            self.conn.execute(stmt, args)
 
     def update_username(self, user_id, username):
         stmt = "UPDATE user SET username = (?) WHERE user_id = (?) AND username NOT IN (?)"
         args = (username, user_id, (username))
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+        with self.transaction():
+            self.conn.execute(stmt, args)
+
+    def update_usernames(self, usernames):
+        stmt = "UPDATE user SET username = (?) WHERE user_id = (?) AND username NOT IN (?)"
+        args = [(username, user_id, username) for user_id, username in usernames]
+        with self.transaction():
+            self.conn.executemany(stmt, args)
+
+    def get_usernames(self):
+        stmt = "SELECT user_id, username FROM user"
+        with self.reader() as conn:
+            return [(x[0], x[1]) for x in conn.execute(stmt)]
 
     def get_user_id(self, username):
         stmt = "SELECT user_id FROM user WHERE username = (?)"
         args = (username, )
-        return [x[0] for x in self.conn.execute(stmt, args)]
+        with self.reader() as conn:
+            return [x[0] for x in conn.execute(stmt, args)]
 
     def get_all_chat_id(self):
         stmt = "SELECT chat_id FROM user"
-        return [x[0] for x in self.conn.execute(stmt)]
+        with self.reader() as conn:
+            return [x[0] for x in conn.execute(stmt)]
+
+    # Distinct chat ids above `after` that were not checked since
+    # checked_before, in chat id order so callers can page through them.
+    def get_unchecked_chat_ids(self, checked_before, after=None, limit=500):
+        stmt = ("SELECT DISTINCT user.chat_id FROM user LEFT JOIN username_check ON username_check.chat_id = user.chat_id "
+                "WHERE user.chat_id > (?) AND (username_check.checked_at IS NULL OR username_check.checked_at < (?)) "
+                "ORDER BY user.chat_id LIMIT (?)")
+        args = (-2 ** 63 if after is None else after, checked_before, limit)
+        with self.reader() as conn:
+            return [x[0] for x in conn.execute(stmt, args)]
+
+    # Records a batch of checks made at checked_at and applies the usernames
+    # found, given as (user_id, username) pairs. Returns how many users changed.
+    def record_username_checks(self, chat_ids, usernames, checked_at):
+        stmt = "INSERT OR REPLACE INTO username_check (chat_id, checked_at) VALUES (?, ?)"
+        args = [(chat_id, checked_at) for chat_id in chat_ids]
+        with self.transaction():
+            self.conn.executemany(stmt, args)
+            stmt = "UPDATE user SET username = (?) WHERE user_id = (?) AND username IS NOT (?)"
+            args = [(username, user_id, username) for user_id, username in usernames]
+            return self.conn.executemany(stmt, args).rowcount
 
     def change_privacy(self, user_id, recipe_name, privacy):
         stmt = "UPDATE recipe SET public = (?) WHERE user_id = (?) AND recipe_name = (?)"
         args = (privacy, user_id, recipe_name)
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+        with self.transaction():
+            self.conn.execute(stmt, args)
+            self.invalidate(user_id, recipe_name)
 
     def add_recipe(self, user_id, recipe_name):
         stmt = "INSERT INTO recipe (recipe_name, user_id, public) VALUES (?, ?, ?)"
         args = (recipe_name, user_id, 1)
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+        with self.transaction():
+            self.conn.execute(stmt, args)
+
+    def add_full_recipe(self, user_id, recipe_name, picture_url, servings, ingredients, steps, picture_file_id=None, thumbnail_url=None):
+        stmt = "INSERT INTO recipe (recipe_name, picture_url, picture_file_id, thumbnail_url, servings, user_id, public) VALUES (?, ?, ?, ?, ?, ?, ?)"
+        args = (recipe_name, picture_url, picture_file_id, thumbnail_url, servings, user_id, 1)
+        with self.transaction():
+            recipe_id = self.conn.execute(stmt, args).lastrowid
+            stmt = "INSERT INTO ingredient (ingredient_name, recipe_id, position) VALUES (?, ?, ?)"
+            self.conn.executemany(stmt, [(ingredient, recipe_id, i) for i, ingredient in enumerate(ingredients, 1)])
+            stmt = "INSERT INTO step (details, recipe_id, position) VALUES (?, ?, ?)"
+            self.conn.executemany(stmt, [(step, recipe_id, i) for i, step in enumerate(steps, 1)])
+        return recipe_id
+
+    def iter_recipes(self, user_id=None):
+        stmt = (''' SELECT user_id, recipe_name, picture_url, servings, public, thumbnail_url,
+                      (SELECT json_group_array(ingredient_name) FROM
+                        (SELECT ingredient_name FROM ingredient WHERE recipe_id = recipe.recipe_id ORDER BY position)),
+                      (SELECT json_group_array(details) FROM
+                        (SELECT details FROM step WHERE recipe_id = recipe.recipe_id ORDER BY position))
+                    FROM recipe''')
+        if user_id is None:
+            stmt, args = stmt + " ORDER BY recipe_id", ()
+        else:
+            stmt, args = stmt + " WHERE user_id = (?) ORDER BY recipe_id", (user_id, )
+        # rows are pulled from the cursor one at a time rather than fetched up front
+        with self.reader() as conn:
+            for row in conn.execute(stmt, args):
+                yield {
+                    "user_id": row[0],
+                    "recipe_name": row[1],
+                    "picture_url": row[2],
+                    "servings": row[3],
+                    "public": row[4] == 1,
+                    "thumbnail_url": row[5],
+                    "ingredients": json.loads(row[6]),
+                    "steps": json.loads(row[7]),
+                }
+
+    def import_recipes(self, recipes, user_id=None, batch_size=500):
+        imported = skipped = 0
+        batch = []
+        for recipe in recipes:
+            batch.append(recipe)
+            if len(batch) == batch_size:
+                count = self.import_batch(batch, user_id)
+                imported, skipped = imported + count, skipped + len(batch) - count
+                batch = []
+        if batch:
+            count = self.import_batch(batch, user_id)
+            imported, skipped = imported + count, skipped + len(batch) - count
+        return imported, skipped
+
+    def import_batch(self, batch, user_id=None):
+        stmt = "SELECT 1 FROM recipe WHERE user_id = (?) AND recipe_name = (?)"
+        recipes, ingredients, steps = [], [], []
+        with self.transaction():
+            # ids are handed out here so that every table can be filled with
+            # executemany; like AUTOINCREMENT, ids of deleted recipes are not reused
+            stmt_id = "SELECT MAX(IFNULL((SELECT seq FROM sqlite_sequence WHERE name = 'recipe'), 0), IFNULL((SELECT MAX(recipe_id) FROM recipe), 0))"
+            recipe_id = self.conn.execute(stmt_id).fetchone()[0]
+            seen = set()
+            for recipe in batch:
+                owner = recipe["user_id"] if user_id is None else user_id
+                key = (owner, recipe["recipe_name"])
+                if key in seen or self.conn.execute(stmt, key).fetchone() is not None:
+                    continue
+                seen.add(key)
+                recipe_id += 1
+                recipes.append((recipe_id, recipe["recipe_name"], recipe.get("picture_url"), recipe.get("thumbnail_url"), recipe.get("servings"), owner, 1 if recipe.get("public", True) else 0))
+                ingredients.extend((ingredient, recipe_id, i) for i, ingredient in enumerate(recipe.get("ingredients", []), 1))
+                steps.extend((step, recipe_id, i) for i, step in enumerate(recipe.get("steps", []), 1))
+            # recipes go in last so the search trigger indexes each one once, complete
+            self.conn.executemany("INSERT INTO ingredient (ingredient_name, recipe_id, position) VALUES (?, ?, ?)", ingredients)
+            self.conn.executemany("INSERT INTO step (details, recipe_id, position) VALUES (?, ?, ?)", steps)
+            self.conn.executemany("INSERT INTO recipe (recipe_id, recipe_name, picture_url, thumbnail_url, servings, user_id, public) VALUES (?, ?, ?, ?, ?, ?, ?)", recipes)
+        return len(recipes)
 
     def is_public(self, user_id, recipe_name):
         stmt = "SELECT public FROM recipe WHERE recipe_name = (?) AND user_id = (?)"
         args = (recipe_name, user_id)
-        l = [x[0] for x in self.conn.execute(stmt, args)]
+        with self.reader() as conn:
+            l = [x[0] for x in conn.execute(stmt, args)]
         return l[0] == 1
 
     def get_recipe_id(self, user_id, recipe_name):
         stmt = "SELECT recipe_id FROM recipe WHERE recipe_name = (?) AND user_id = (?)"
         args = (recipe_name, user_id)
-        return [x[0] for x in self.conn.execute(stmt, args)]
+        with self.reader() as conn:
+            return [x[0] for x in conn.execute(stmt, args)]
+
+    def load_recipe(self, user_id, recipe_name):
+        if not getattr(self.local, "depth", 0):
+            recipe = self.cache.get(user_id, recipe_name)
+            if recipe is not None:
+                return recipe
+        return self.read_recipe(user_id, recipe_name)
+
+    # load_recipe without the cache lookup; the result is still cached when
+    # read outside a transaction.
+    def read_recipe(self, user_id, recipe_name):
+        cacheable = not getattr(self.local, "depth", 0)
+        generation = self.cache.generation
+        stmt = (''' SELECT recipe_id, public, servings, picture_url, picture_file_id, thumbnail_url, thumbnail_file_id
+                    FROM recipe WHERE recipe_name = (?) AND user_id = (?)''')
+        args = (recipe_name, user_id)
+        with self.reader() as conn:
+            row = conn.execute(stmt, args).fetchone()
+            if row is None:
+                return None
+            recipe_id, public, servings, picture_url, picture_file_id, thumbnail_url, thumbnail_file_id = row
+            stmt = (''' SELECT 0 AS kind, position, ingredient_id, ingredient_name FROM ingredient WHERE recipe_id = (?)
+                        UNION ALL
+                        SELECT 1 AS kind, position, step_id, details FROM step WHERE recipe_id = (?)
+                        ORDER BY kind, position''')
+            args = (recipe_id, recipe_id)
+            ingredients, ingredient_ids, steps, step_ids = [], [], [], []
+            for kind, _, row_id, text in conn.execute(stmt, args):
+                if kind:
+                    steps.append(text)
+                    step_ids.append(row_id)
+                else:
+                    ingredients.append(text)
+                    ingredient_ids.append(row_id)
+        recipe = Recipe(recipe_id, recipe_name, public == 1, servings, picture_url, picture_file_id, thumbnail_url, thumbnail_file_id, ingredients, steps, ingredient_ids, step_ids)
+        if cacheable:
+            self.cache.put(user_id, recipe, generation)
+        return recipe
 
     def update_name(self, user_id, old_name, new_name):
         stmt = "UPDATE recipe SET recipe_name = (?) WHERE recipe_name = (?) AND user_id = (?)"
         args = (new_name, old_name, user_id)
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+        with self.transaction():
+            self.conn.execute(stmt, args)
+            self.invalidate(user_id, old_name)
 
-    def add_picture_url(self, user_id, recipe_name, picture_url):
-        stmt = "UPDATE recipe SET picture_url = (?) WHERE recipe_name = (?) AND user_id = (?)"
-        args = (picture_url, recipe_name, user_id)
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+    # A new photo always replaces the thumbnail and file_ids of the old one.
+    def add_picture_url(self, user_id, recipe_name, picture_url, picture_file_id=None, thumbnail_url=None):
+        stmt = (''' UPDATE recipe SET picture_url = (?), picture_file_id = (?), thumbnail_url = (?), thumbnail_file_id = NULL
+                    WHERE recipe_name = (?) AND user_id = (?)''')
+        args = (picture_url, picture_file_id, thumbnail_url, recipe_name, user_id)
+        with self.transaction():
+            self.conn.execute(stmt, args)
+            self.invalidate(user_id, recipe_name)
+
+    # Sets the photo of the recipe with the given id, whatever it is called
+    # by now, and returns the urls it replaced, or None if it is gone.
+    def replace_picture_url(self, recipe_id, picture_url, picture_file_id=None, thumbnail_url=None):
+        stmt = (''' UPDATE recipe SET picture_url = (?), picture_file_id = (?), thumbnail_url = (?), thumbnail_file_id = NULL
+                    WHERE recipe_id = (?)''')
+        args = (picture_url, picture_file_id, thumbnail_url, recipe_id)
+        with self.transaction():
+            row = self.conn.execute("SELECT user_id, recipe_name, picture_url, thumbnail_url FROM recipe WHERE recipe_id = (?)", (recipe_id, )).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(stmt, args)
+            self.invalidate(row[0], row[1])
+            return [url for url in row[2:] if url is not None]
 
     def get_picture_url(self, user_id, recipe_name):
         stmt = "SELECT picture_url FROM recipe WHERE recipe_name = (?) AND user_id = (?) AND picture_url IS NOT NULL"
         args = (recipe_name, user_id)
-        return [x[0] for x in self.conn.execute(stmt, args)]
+        with self.reader() as conn:
+            return [x[0] for x in conn.execute(stmt, args)]
+
+    # Only records the file_id if the photo has not been changed since it was sent.
+    def set_picture_file_id(self, user_id, recipe_name, picture_url, picture_file_id):
+        stmt = "UPDATE recipe SET picture_file_id = (?) WHERE recipe_name = (?) AND user_id = (?) AND picture_url IS (?)"
+        args = (picture_file_id, recipe_name, user_id, picture_url)
+        with self.transaction():
+            self.conn.execute(stmt, args)
+            self.invalidate(user_id, recipe_name)
+
+    def set_thumbnail_file_id(self, user_id, recipe_name, thumbnail_url, thumbnail_file_id):
+        stmt = "UPDATE recipe SET thumbnail_file_id = (?) WHERE recipe_name = (?) AND user_id = (?) AND thumbnail_url IS (?)"
+        args = (thumbnail_file_id, recipe_name, user_id, thumbnail_url)
+        with self.transaction():
+            self.conn.execute(stmt, args)
+            self.invalidate(user_id, recipe_name)
+
+    # The stored photo and thumbnail of a recipe, whichever exist.
+    def get_photo_urls(self, user_id, recipe_name):
+        stmt = "SELECT picture_url, thumbnail_url FROM recipe WHERE recipe_name = (?) AND user_id = (?)"
+        args = (recipe_name, user_id)
+        with self.reader() as conn:
+            return [url for row in conn.execute(stmt, args) for url in row if url is not None]
+
+    def is_picture_used(self, picture_url):
+        stmt = "SELECT 1 FROM recipe WHERE picture_url = (?) OR thumbnail_url = (?) LIMIT 1"
+        args = (picture_url, picture_url)
+        with self.reader() as conn:
+            return conn.execute(stmt, args).fetchone() is not None
 
     def delete_picture_url(self, user_id, recipe_name):
-        stmt = "UPDATE recipe SET picture_url = NULL where recipe_name = (?) AND user_id = (?)"
+        stmt = (''' UPDATE recipe SET picture_url = NULL, picture_file_id = NULL, thumbnail_url = NULL, thumbnail_file_id = NULL
+                    WHERE recipe_name = (?) AND user_id = (?)''')
         args = (recipe_name, user_id)
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+        with self.transaction():
+            self.conn.execute(stmt, args)
+            self.invalidate(user_id, recipe_name)
 
     def add_servings(self, user_id, recipe_name, servings):
         stmt = "UPDATE recipe SET servings = (?) WHERE recipe_name = (?) AND user_id = (?)"
         args = (servings, recipe_name, user_id)
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+        with self.transaction():
+            self.conn.execute(stmt, args)
+            self.invalidate(user_id, recipe_name)
 
     def get_servings(self, user_id, recipe_name):
         stmt = "SELECT servings FROM recipe WHERE recipe_name = (?) AND user_id = (?) AND servings IS NOT NULL"
         args = (recipe_name, user_id)
-        return [x[0] for x in self.conn.execute(stmt, args)]
+        with self.reader() as conn:
+            return [x[0] for x in conn.execute(stmt, args)]
 
     def delete_servings(self, user_id, recipe_name):
         stmt = "UPDATE recipe SET servings = NULL where recipe_name = (?) AND user_id = (?)"
         args = (recipe_name, user_id)
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+        with self.transaction():
+            self.conn.execute(stmt, args)
+            self.invalidate(user_id, recipe_name)
 
     def add_ingredient(self, user_id, recipe_name, ingredient):
         recipe_id = self.get_recipe_id(user_id, recipe_name)[0]
-        stmt = "INSERT INTO ingredient (ingredient_name, recipe_id) VALUES (?, ?)"
-        args = (ingredient, recipe_id)
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+        stmt = "INSERT INTO ingredient (ingredient_name, recipe_id, position) SELECT ?, ?, IFNULL(MAX(position), 0) + 1 FROM ingredient WHERE recipe_id = (?)"
+        args = (ingredient, recipe_id, recipe_id)
+        with self.transaction():
+            ingredient_id = self.conn.execute(stmt, args).lastrowid
+            self.invalidate(user_id, recipe_name)
+        return ingredient_id
     
     def get_ingredients(self, user_id, recipe_name):
         recipe_id = self.get_recipe_id(user_id, recipe_name)[0]
-        stmt =  "SELECT ingredient_name FROM ingredient WHERE recipe_id = (?)"
+        stmt =  "SELECT ingredient_name FROM ingredient WHERE recipe_id = (?) ORDER BY position"
         args = (recipe_id, )
-        return [x[0] for x in self.conn.execute(stmt, args)]
+        with self.reader() as conn:
+            return [x[0] for x in conn.execute(stmt, args)]
     
-    def update_ingredient(self, user_id, recipe_name, current_ingredient, new_ingredient):
+    def update_ingredient(self, user_id, recipe_name, ingredient_id, new_ingredient):
         recipe_id = self.get_recipe_id(user_id, recipe_name)[0]
-        stmt = "UPDATE ingredient SET ingredient_name = (?) WHERE ingredient_name = (?) AND recipe_id = (?)"
-        args = (new_ingredient, current_ingredient, recipe_id)
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+        stmt = "UPDATE ingredient SET ingredient_name = (?) WHERE ingredient_id = (?) AND recipe_id = (?)"
+        args = (new_ingredient, ingredient_id, recipe_id)
+        with self.transaction():
+            self.conn.execute(stmt, args)
+            self.invalidate(user_id, recipe_name)
 
-    def delete_ingredient(self, user_id, recipe_name, ingredient):
+    def delete_ingredient(self, user_id, recipe_name, ingredient_id):
         recipe_id = self.get_recipe_id(user_id, recipe_name)[0]
-        stmt = "DELETE FROM ingredient WHERE ingredient_name = (?) AND recipe_id = (?)"
-        args = (ingredient, recipe_id)
-        self.conn.execute(stmt, args)
-        self.conn.commit
+        stmt = "DELETE FROM ingredient WHERE ingredient_id = (?) AND recipe_id = (?)"
+        args = (ingredient_id, recipe_id)
+        with self.transaction():
+            self.conn.execute(stmt, args)
+            self.invalidate(user_id, recipe_name)
+
+    # Position for a step placed just before the step `before`, or after the
+    # last step when before is None. Positions are REAL so a step can be put
+    # at the midpoint of its neighbours without touching any other row; only
+    # once the gap is too small to split are the recipe's steps renumbered.
+    def step_position(self, recipe_id, before=None, step_id=None):
+        stmt = "SELECT position FROM step WHERE step_id = (?) AND recipe_id = (?)"
+        row = None if before is None else self.conn.execute(stmt, (before, recipe_id)).fetchone()
+        if row is None:
+            stmt = "SELECT IFNULL(MAX(position), 0) + 1 FROM step WHERE recipe_id = (?) AND step_id IS NOT (?)"
+            return self.conn.execute(stmt, (recipe_id, step_id)).fetchone()[0]
+        upper = row[0]
+        stmt = "SELECT MAX(position) FROM step WHERE recipe_id = (?) AND position < (?) AND step_id IS NOT (?)"
+        lower = self.conn.execute(stmt, (recipe_id, upper, step_id)).fetchone()[0]
+        if lower is None:
+            return upper - 1
+        position = (lower + upper) / 2
+        if lower < position < upper:
+            return position
+        self.renumber_steps(recipe_id)
+        return self.step_position(recipe_id, before, step_id)
+
+    def renumber_steps(self, recipe_id):
+        stmt = "SELECT step_id FROM step WHERE recipe_id = (?) ORDER BY position"
+        step_ids = [x[0] for x in self.conn.execute(stmt, (recipe_id, ))]
+        stmt = "UPDATE step SET position = (?) WHERE step_id = (?)"
+        self.conn.executemany(stmt, [(position, step_id) for position, step_id in enumerate(step_ids, 1)])
 
-    def add_step(self, user_id, recipe_name, step):
+    def add_step(self, user_id, recipe_name, step, before=None):
         recipe_id = self.get_recipe_id(user_id, recipe_name)[0]
-        stmt = "INSERT INTO step (details, recipe_id) VALUES (?, ?)"
-        args = (step, recipe_id)
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+        stmt = "INSERT INTO step (details, recipe_id, position) VALUES (?, ?, ?)"
+        with self.transaction():
+            args = (step, recipe_id, self.step_position(recipe_id, before))
+            step_id = self.conn.execute(stmt, args).lastrowid
+            self.invalidate(user_id, recipe_name)
+        return step_id
+
+    def move_step(self, user_id, recipe_name, step_id, before=None):
+        if step_id == before:
+            return
+        recipe_id = self.get_recipe_id(user_id, recipe_name)[0]
+        stmt = "UPDATE step SET position = (?) WHERE step_id = (?) AND recipe_id = (?)"
+        with self.transaction():
+            args = (self.step_position(recipe_id, before, step_id), step_id, recipe_id)
+            self.conn.execute(stmt, args)
+            self.invalidate(user_id, recipe_name)
 
     def get_steps(self, user_id, recipe_name):
         recipe_id = self.get_recipe_id(user_id, recipe_name)[0]
-        stmt = "SELECT details FROM step WHERE recipe_id = (?)"
+        stmt = "SELECT details FROM step WHERE recipe_id = (?) ORDER BY position"
         args = (recipe_id, )
-        return [x[0] for x in self.conn.execute(stmt, args)]
+        with self.reader() as conn:
+            return [x[0] for x in conn.execute(stmt, args)]
 
-    def update_step(self, user_id, recipe_name, current_step, new_step):
+    def update_step(self, user_id, recipe_name, step_id, new_step):
         recipe_id = self.get_recipe_id(user_id, recipe_name)[0]
-        stmt = "UPDATE step SET details = (?) WHERE details = (?) AND recipe_id = (?)"
-        args = (new_step, current_step, recipe_id)
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+        stmt = "UPDATE step SET details = (?) WHERE step_id = (?) AND recipe_id = (?)"
+        args = (new_step, step_id, recipe_id)
+        with self.transaction():
+            self.conn.execute(stmt, args)
+            self.invalidate(user_id, recipe_name)
 
-    def delete_step(self, user_id, recipe_name, step):
+    def delete_step(self, user_id, recipe_name, step_id):
         recipe_id = self.get_recipe_id(user_id, recipe_name)[0]
-        stmt = "DELETE FROM step WHERE details = (?) AND recipe_id = (?)"
-        args = (step, recipe_id)
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+        stmt = "DELETE FROM step WHERE step_id = (?) AND recipe_id = (?)"
+        args = (step_id, recipe_id)
+        with self.transaction():
+            self.conn.execute(stmt, args)
+            self.invalidate(user_id, recipe_name)
 
     def delete_recipe(self, user_id, recipe_name):
-        stmt = "DELETE FROM recipe WHERE recipe_name = (?) AND user_id = (?)"
         args = (recipe_name, user_id)
-        self.conn.execute(stmt, args)
-        self.conn.commit()
+        with self.transaction():
+            # foreign keys are not enforced, so the recipe's rows go first
+            for table in ("ingredient", "step"):
+                stmt = "DELETE FROM {} WHERE recipe_id IN (SELECT recipe_id FROM recipe WHERE recipe_name = (?) AND user_id = (?))".format(table)
+                self.conn.execute(stmt, args)
+            stmt = "DELETE FROM recipe WHERE recipe_name = (?) AND user_id = (?)"
+            self.conn.execute(stmt, args)
+            self.invalidate(user_id, recipe_name)
 
     def get_recipes(self, user_id):
         stmt = "SELECT recipe_name FROM recipe WHERE user_id = (?)"
         args = (user_id, )
-        return [x[0] for x in self.conn.execute(stmt, args)]
+        with self.reader() as conn:
+            return [x[0] for x in conn.execute(stmt, args)]
     
+    def search_recipes(self, terms, limit=5, offset=0):
+        # each word is quoted so user input can't break the MATCH syntax; the
+        # porter tokenizer lets "brownie" match "brownies"
+        words = terms.split()
+        if not words:
+            return []
+        query = " ".join('"' + word.replace('"', '""') + '"' for word in words)
+        stmt = (''' SELECT recipe.recipe_id, recipe.user_id, recipe.recipe_name,
+                           (SELECT username FROM user WHERE user.user_id = recipe.user_id LIMIT 1)
+                    FROM recipe_search JOIN recipe ON recipe.recipe_id = recipe_search.rowid
+                    WHERE recipe_search MATCH (?) AND recipe.public = 1
+                    ORDER BY bm25(recipe_search, 10.0, 3.0, 1.0)
+                    LIMIT (?) OFFSET (?)''')
+        args = (query, limit, offset)
+        with self.reader() as conn:
+            return [(x[0], x[1], x[2], x[3]) for x in conn.execute(stmt, args)]
+
+    def get_recipe_owner(self, recipe_id):
+        stmt = "SELECT user_id, recipe_name FROM recipe WHERE recipe_id = (?)"
+        args = (recipe_id, )
+        with self.reader() as conn:
+            return [(x[0], x[1]) for x in conn.execute(stmt, args)]
+
     def get_public_recipes(self, user_id):
         stmt = "SELECT recipe_name FROM recipe WHERE user_id = (?) AND public = (?)"
         args = (user_id, 1)
-        return [x[0] for x in self.conn.execute(stmt, args)]
+        with self.reader() as conn:
+            return [x[0] for x in conn.execute(stmt, args)]
+
+        
+
+# Remembers the last username written for each user so that handlers only
+# touch the database when a username actually changes. Changes are queued
+# and written in one batch by flush().
+class UsernameCache:
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.known = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        usernames = self.db.get_usernames()
+        with self.lock:
+            self.known.update(usernames)
+
+    def add_user(self, user_id, chat_id, username):
+        self.db.add_user(user_id, chat_id, username)
+        with self.lock:
+            self.known.setdefault(user_id, username)
+
+    def update(self, user_id, username):
+        if username is None:
+            return
+        with self.lock:
+            if self.known.get(user_id) == username:
+                self.hits += 1
+                return
+            self.misses += 1
+            self.known[user_id] = username
+            self.pending[user_id] = username
+
+    # Takes note of usernames that were written to the database elsewhere.
+    def remember(self, usernames):
+        with self.lock:
+            self.known.update(usernames)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if pending:
+            self.db.update_usernames(pending.items())
+        return len(pending)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "pending": len(self.pending), "size": len(self.known)}
+
+# DBHelper for asyncio code. Every call runs on a dedicated thread pool, so
+# coroutines never block the event loop on SQLite, and the whole call
+# (including everything inside run()) stays on one thread, so DBHelper's
+# thread-local transactions keep working. Cached recipes are returned
+# without leaving the event loop.
+class AsyncDBHelper:
+    def __init__(self, db, max_workers=None):
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or db.pool.size + 1, thread_name_prefix="db")
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(fn, *args))
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        async def call(*args):
+            return await self.run(method, *args)
+        return call
+
+    async def load_recipe(self, user_id, recipe_name):
+        recipe = self.db.cache.get(user_id, recipe_name)
+        if recipe is not None:
+            return recipe
+        return await self.run(self.db.read_recipe, user_id, recipe_name)
 
-        
\ No newline at end of file
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
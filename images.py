@@ -0,0 +1,20 @@
+import io
+from PIL import Image, ImageOps
+
+PHOTO_SIZE = (1280, 1280)
+THUMBNAIL_SIZE = (320, 320)
+
+def encode_jpeg(image, size, quality):
+    image = image.copy()
+    image.thumbnail(size, Image.LANCZOS)
+    out = io.BytesIO()
+    image.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+    return out.getvalue()
+
+# Normalizes an uploaded photo into an upright RGB JPEG no larger than
+# PHOTO_SIZE, plus a THUMBNAIL_SIZE thumbnail. This is CPU-bound, so
+# PhotoUploader runs it in worker processes rather than threads.
+def process_photo(data):
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        return encode_jpeg(image, PHOTO_SIZE, 85), encode_jpeg(image, THUMBNAIL_SIZE, 75)
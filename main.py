@@ -1,26 +1,55 @@
-import os
-import logging, datetime, pytz, telepot, urllib3, time
+import os, io, tempfile, asyncio, queue, signal, threading
+import logging, datetime, pytz, time
 from telegram import InlineKeyboardButton, ReplyKeyboardRemove, Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, constants, Bot
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, ConversationHandler, CallbackQueryHandler
-from dbhelper import DBHelper
-from google.cloud import storage
-from firebase import firebase
-from flask import Flask, request, Response
-from flask_sslify import SSLify
-from selenium import webdriver
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from webdriver_manager.chrome import ChromeDriverManager
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.support import expected_conditions as EC
+from telegram.error import BadRequest
+from telegram.ext import Updater, JobQueue, CommandHandler, MessageHandler, Filters, CallbackContext, ConversationHandler, CallbackQueryHandler
+from dbhelper import DBHelper, AsyncDBHelper, UsernameCache
+from asyncbot import AsyncEngine, AsyncContext
+from recipebook import export_jsonl, import_jsonl
+from uploads import PhotoUploader
+from blobstore import GCSStore, LocalStore
+from scheduler import ScheduledDispatcher
+from services import Services
+from refresh import UsernameRefresher
+from outbound import RateLimitedRequest, Sender
+from websearch import WebSearch, CachedWebSearch, SearchCache, HttpFetcher, BrowserFetcher, BrowserPool, FetchError
+from sqlstats import QueryStats, serve_metrics
 
 API_KEY = os.getenv('API_KEY')
+USERNAME_FLUSH_INTERVAL = 60 # seconds between batched username writes
+STATS_LOG_INTERVAL = 60 # seconds between cache, upload and SQL stats in the log
+SEARCH_PAGE_SIZE = 5
+BOT_MODE = os.getenv('BOT_MODE', 'polling') # "polling", "webhook" or "asyncio"
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot') # e.g. webhook.py's fake API for load tests
+ASYNC_IO_WORKERS = 16 # threads for blocking Telegram and storage calls in asyncio mode
+CHAT_WORKERS = 8 # chats handled in parallel; updates from one chat are still handled one at a time
+CHAT_QUEUE_SIZE = 1000 # updates waiting for the chat workers before the dispatcher stops reading more
+SENDER_WORKERS = 4 # threads for Telegram calls handlers do not wait for
+WEB_SEARCH_URL = os.getenv('WEB_SEARCH_URL', 'https://www.allrecipes.com/search?q={query}')
+WEB_RECIPE_LINK = os.getenv('WEB_RECIPE_LINK', r'^https://www\.allrecipes\.com/recipe/\d+/') # which search results are recipe pages
+WEB_SEARCH_BROWSER = os.getenv('WEB_SEARCH_BROWSER', '1') == '1' # fall back to headless Chrome for pages plain HTTP can't read
+WEB_SEARCH_RESULTS = 5
+WEB_BROWSERS = int(os.getenv('WEB_BROWSERS', '2')) # headless Chrome sessions kept for the fallback
+WEB_BROWSERS_WARM = int(os.getenv('WEB_BROWSERS_WARM', '0')) # sessions started with the bot instead of on first use
+WEB_BROWSER_PAGES = 50 # pages a browser renders before it is replaced
+WEB_BROWSER_MEMORY = 512 * 1024 * 1024 # JavaScript heap size at which a browser is replaced
+WEB_SEARCH_TTL = int(os.getenv('WEB_SEARCH_TTL', str(24 * 3600))) # seconds web results are reused for
+WEB_SEARCH_CACHE_SIZE = int(os.getenv('WEB_SEARCH_CACHE_SIZE', '1000')) # queries kept
+WEBHOOK_URL = os.getenv('WEBHOOK_URL') # public base url Telegram posts updates to
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', API_KEY) # secret path, so only Telegram knows where to post
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+WEBHOOK_QUEUE_SIZE = 1000 # updates waiting for the dispatcher before the webhook answers 503
+WEBHOOK_MAX_CONNECTIONS = 40
+SQL_STATS = os.getenv('SQL_STATS', '0') == '1' # time every SQL statement, for /stats and /metrics
+SQL_SLOW_MS = int(os.getenv('SQL_SLOW_MS', '100')) # statements taking longer go to the slow-query log
+METRICS_PORT = os.getenv('METRICS_PORT') # serves /metrics when not in webhook mode, where the webhook app has it
+ADMIN_IDS = {int(user_id) for user_id in os.getenv('ADMIN_IDS', '').split(',') if user_id.strip()} # users allowed to use /stats
 
 NAME, PHOTO, SERVINGS, INGREDIENTS, STEPS, SEND_RECIPE, CONFIRMATION, DELETION = range(8)
 RECIPE_CHOICE, RECIPE_PART, EDIT_NAME, EDIT_PHOTO, EDIT_SERVINGS, EDIT_INGREDIENTS, EDIT_STEPS, END_ROUTES = range(8,16)
 ADD_INGREDIENT, UPDATE_INGREDIENT, SAVE_INGREDIENT, DELETE_INGREDIENT = range(16,20)
 ADD_STEP, UPDATE_STEP, SAVE_STEP, DELETE_STEP = range(20,24)
+INSERT_STEP, MOVE_STEP, MOVE_STEP_TO = range(24,27)
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', 
@@ -28,12 +57,41 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-db = DBHelper()
+sql_stats = QueryStats(SQL_SLOW_MS) if SQL_STATS else None
+db = DBHelper(stats=sql_stats)
+usernames = UsernameCache(db)
+adb = AsyncDBHelper(db)
+refresher = UsernameRefresher(db, usernames)
+sender = Sender(SENDER_WORKERS)
 
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"]='credentials.json'
-firebase = firebase.FirebaseApplication(os.getenv('DB_URL'))
-client = storage.Client()
-bucket = client.get_bucket(os.getenv('FIREBASE_URL'))
+
+# Clients are only created (and their libraries imported) when first used.
+def create_store():
+    # PHOTO_DIR keeps photos on local disk instead of the Firebase bucket, e.g. for development
+    if os.getenv('PHOTO_DIR'):
+        return LocalStore(os.getenv('PHOTO_DIR'), os.getenv('PHOTO_URL'))
+    return GCSStore.from_bucket_name(os.getenv('FIREBASE_URL'))
+
+def create_uploader():
+    from images import process_photo
+    return PhotoUploader(services.get("store"), process_photo)
+
+def create_browser_pool():
+    return BrowserPool(WEB_BROWSERS, WEB_BROWSER_PAGES, WEB_BROWSER_MEMORY)
+
+def create_web_search():
+    fetchers = [HttpFetcher()] + ([BrowserFetcher(services.get("browser pool"))] if WEB_SEARCH_BROWSER else [])
+    web_search = WebSearch(WEB_SEARCH_URL, WEB_RECIPE_LINK, fetchers, WEB_SEARCH_RESULTS)
+    # the cache lives next to the recipe database
+    cache = SearchCache(os.path.join(os.path.dirname(db.dbname), "websearch.sqlite"), WEB_SEARCH_TTL, WEB_SEARCH_CACHE_SIZE)
+    return CachedWebSearch(web_search, cache)
+
+services = Services()
+services.register("store", create_store)
+services.register("uploader", create_uploader, close=PhotoUploader.shutdown)
+services.register("browser pool", create_browser_pool, close=BrowserPool.close)
+services.register("web search", create_web_search, close=CachedWebSearch.close)
 
 def build_keyboard(items):
     keyboard = [[item] for item in items]
@@ -45,58 +103,203 @@ def build_inline_keyboard(buttons):
     markup = InlineKeyboardMarkup(keyboard)
     return markup
 
-def get_ingredient_list(user_id, recipe_name):
+def build_recipe_part_keyboard(recipe):
+    buttons = ["recipe name"]
+    has_photo = recipe.picture_url is not None or recipe.picture_file_id is not None
+    buttons.append("photo") if has_photo else buttons.append("add photo")
+    buttons.append("add servings") if recipe.servings is None else buttons.append("servings")
+    privacy = "set private" if recipe.public else "set public"
+    return build_inline_keyboard([buttons, ["ingredients", "directions"], [privacy], ["<< back to list of recipes"]])
+
+def build_ingredient_keyboard(recipe):
+    buttons = [[InlineKeyboardButton(ingredient, callback_data="ingredient " + str(ingredient_id))]
+               for ingredient, ingredient_id in zip(recipe.ingredients, recipe.ingredient_ids)]
+    buttons.append([InlineKeyboardButton("<< back", callback_data="<< back")])
+    return InlineKeyboardMarkup(buttons)
+
+def build_step_keyboard(recipe, extra=None):
+    buttons = [[InlineKeyboardButton(str(x), callback_data="step " + str(step_id))]
+               for x, step_id in enumerate(recipe.step_ids, 1)]
+    if extra is not None:
+        buttons.append([InlineKeyboardButton(extra, callback_data=extra)])
+    buttons.append([InlineKeyboardButton("<< back", callback_data="<< back")])
+    return InlineKeyboardMarkup(buttons)
+
+def build_steps_menu_keyboard(recipe_name):
+    keyboard = [[
+        InlineKeyboardButton("add a step", callback_data="add"),
+        InlineKeyboardButton("edit a step", callback_data="edit"),
+        InlineKeyboardButton("delete a step", callback_data="delete")
+    ], [
+        InlineKeyboardButton("insert a step", callback_data="insert"),
+        InlineKeyboardButton("move a step", callback_data="move")
+    ], [
+        InlineKeyboardButton("<< back", callback_data=recipe_name)
+    ]]
+    return InlineKeyboardMarkup(keyboard)
+
+def get_ingredient_list(ingredients):
     ingredient_list = 'Ingredients\n'
-    for ingredient in db.get_ingredients(user_id, recipe_name):
+    for ingredient in ingredients:
         ingredient_list = ingredient_list + "- " + ingredient + "\n"
     return ingredient_list
 
-def get_step_list(user_id, recipe_name):
+def get_step_list(steps):
     step_list = 'Directions\n'
     count = 1
-    for step in db.get_steps(user_id, recipe_name):
+    for step in steps:
         step_list = step_list + str(count) + ". " + step + "\n"
         count+=1
     return step_list
 
-def full_recipe(user_id, recipe_name):
-    if not db.is_public(user_id, recipe_name):
-        msg = recipe_name + " [private]\n\n"
+def full_recipe(recipe):
+    if recipe.rendered is not None:
+        return recipe.rendered
+    if not recipe.public:
+        msg = recipe.name + " [private]\n\n"
     else:
-        msg = recipe_name + " [public]\n\n"
-    servings = db.get_servings(user_id, recipe_name)
-    ingredients = get_ingredient_list(user_id, recipe_name)
-    steps = get_step_list(user_id, recipe_name)
-    if len(servings) == 0:
+        msg = recipe.name + " [public]\n\n"
+    ingredients = get_ingredient_list(recipe.ingredients)
+    steps = get_step_list(recipe.steps)
+    if recipe.servings is None:
         msg = msg + ingredients + "\n" + steps
     else:
-        msg = msg + "Serves " + servings[0] + "\n\n" + ingredients + "\n" + steps
+        msg = msg + "Serves " + recipe.servings + "\n\n" + ingredients + "\n" + steps
+    recipe.rendered = msg
     return msg
 
-def start(update: Update, _: CallbackContext) -> None:
-    """Send a message when the command /start is issued."""
-    user = update.effective_user
-    username = user.username
-    if username == None:
-        db.add_user(user.id, update.message.chat_id, "None")
-    else:
-        db.add_user(user.id, update.message.chat_id, username)
-    update.message.reply_markdown_v2(
+def discard_photo(picture_url):
+    # photos are stored once per content, so another recipe may still use it
+    if not db.is_picture_used(picture_url):
+        services.get("store").delete(picture_url)
+
+# An upload in progress writes its photo to the recipe with the id in
+# target['recipe id']. A draft only gets one at /done, so until then the
+# urls are kept in the target for /done to save, and a draft given up
+# before that leaves the target 'dropped' and its photo is discarded.
+def photo_uploaded(target, picture_file_id):
+    def done(picture_url, thumbnail_url):
+        # holding the transaction keeps /done from saving the draft halfway through
+        with db.transaction():
+            if target.get('recipe id') is None and not target.get('dropped'):
+                target['picture url'] = picture_url
+                target['thumbnail url'] = thumbnail_url
+                return
+            old_urls = None
+            if target.get('recipe id') is not None:
+                old_urls = db.replace_picture_url(target['recipe id'], picture_url, picture_file_id, thumbnail_url)
+        if old_urls is None:
+            # the recipe was deleted, or the draft given up, while the photo was uploading
+            for url in (picture_url, thumbnail_url):
+                if url is not None:
+                    discard_photo(url)
+            return
+        for old_url in old_urls:
+            if old_url not in (picture_url, thumbnail_url):
+                discard_photo(old_url)
+    return done
+
+def photo_upload_failed(bot, chat_id, recipe_name):
+    def failed(_):
+        bot.send_message(chat_id, "Sorry, Mama couldn't save the photo of '" + recipe_name + "'. Please try sending it again with /edit.")
+    return failed
+
+# Menus pass thumbnail=True to send the small version, falling back to the
+# full photo for recipes saved before thumbnails existed.
+def get_photo_source(recipe, thumbnail=False):
+    if thumbnail and (recipe.thumbnail_url is not None or recipe.thumbnail_file_id is not None):
+        return recipe.thumbnail_file_id, recipe.thumbnail_url, db.set_thumbnail_file_id
+    return recipe.picture_file_id, recipe.picture_url, db.set_picture_file_id
+
+# Sends the recipe photo by its Telegram file_id when there is one, so
+# Telegram does not fetch it from storage again, and records the file_id
+# the first time the photo is sent from its URL.
+def reply_recipe_photo(message, user_id, recipe, thumbnail=False):
+    file_id, url, set_file_id = get_photo_source(recipe, thumbnail)
+    if file_id is not None:
+        try:
+            message.reply_photo(file_id)
+            return
+        except BadRequest:
+            logger.warning("Stored file_id of '%s' was rejected, sending the photo by URL", recipe.name)
+    if url is not None:
+        sent = message.reply_photo(url)
+        set_file_id(user_id, recipe.name, url, sent.photo[-1].file_id)
+
+def save_draft(user_id, draft):
+    upload = draft.get('photo upload')
+    if upload is None:
+        upload = {}
+    with db.transaction():
+        db.add_full_recipe(
+            user_id, draft['recipe name'], upload.get('picture url'), draft['servings'], draft['ingredients'], draft['steps'],
+            draft['picture file id'], upload.get('thumbnail url')
+        )
+        recipe = db.load_recipe(user_id, draft['recipe name'])
+        # an upload still in progress writes its photo to the saved recipe
+        upload['recipe id'] = recipe.recipe_id
+        return recipe
+
+# Empties user_data, discarding the photo of a draft that was not saved.
+def drop_draft(draft):
+    upload = draft.get('photo upload')
+    picture_urls = []
+    if upload is not None:
+        with db.transaction():
+            if upload.get('recipe id') is None:
+                upload['dropped'] = True
+                picture_urls = [upload.get('picture url'), upload.get('thumbnail url')]
+    draft.clear()
+    for picture_url in picture_urls:
+        if picture_url is not None:
+            discard_photo(picture_url)
+
+def remove_recipe(user_id, recipe_name):
+    with db.transaction():
+        picture_urls = db.get_photo_urls(user_id, recipe_name)
+        db.delete_recipe(user_id, recipe_name)
+    for picture_url in picture_urls:
+        discard_photo(picture_url)
+
+def start_draft(draft, recipe_name):
+    # the recipe is kept as a draft in user_data and only saved at /done
+    draft['recipe name'] = recipe_name
+    draft['photo upload'] = None
+    draft['picture file id'] = None
+    draft['servings'] = None
+    draft['ingredients'] = []
+    draft['steps'] = []
+    draft['ingredient list'] = get_ingredient_list([])
+    draft['step list'] = get_step_list([])
+
+def get_start_message(user):
+    return (
         fr"Hi {user.mention_markdown_v2()}\! I'm BotMaMa\! "
         fr"I can help you manage your recipes and even search for new ones from all over the web\.{os.linesep}"
         fr"{os.linesep}To add a new recipe, use /add\."
         fr"{os.linesep}To view your recipes, use /view\."
         fr"{os.linesep}To edit your recipes, use /edit\."
         fr"{os.linesep}To delete a recipe, use /delete\."
+        fr"{os.linesep}To back up or move your recipes, use /export and /import\."
         fr"{os.linesep}Search for recipes of other users using /search \@\<username\>\. Currently, this only works for users with a username\."
-        fr"{os.linesep}Alternatively, search for new recipes from the internet with /search \<search term\>\."
+        fr"{os.linesep}Alternatively, search the public recipes of all users with /search \<search term\>\."
+        fr"{os.linesep}To find new recipes from the web, use /websearch \<search term\>\."
     )
 
+def start(update: Update, _: CallbackContext) -> None:
+    """Send a message when the command /start is issued."""
+    user = update.effective_user
+    username = user.username
+    if username == None:
+        usernames.add_user(user.id, update.message.chat_id, "None")
+    else:
+        usernames.add_user(user.id, update.message.chat_id, username)
+    update.message.reply_markdown_v2(get_start_message(user))
+
 def add_recipe(update: Update, _: CallbackContext) -> int:
     """Asks user for the recipe name."""
-    _.user_data.clear()
-    db.update_username(update.message.from_user.id, update.message.from_user.username)
-    print(isinstance(update.message.from_user.username, str))
+    drop_draft(_.user_data)
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
     update.message.reply_text(
         "Please tell me the name of your new recipe or type /cancel if you change your mind anytime!\n"
         "All recipes are set to public by default. You can change this by editing the recipe later. "
@@ -108,7 +311,7 @@ def add_recipe(update: Update, _: CallbackContext) -> int:
 def name(update: Update, _: CallbackContext) -> int:
     """Stores given name and asks for a photo of the recipe."""
     user_id = update.message.from_user.id
-    db.update_username(user_id, update.message.from_user.username)
+    usernames.update(user_id, update.message.from_user.username)
     recipes = db.get_recipes(user_id)
     recipe_name = update.message.text
     if recipe_name in recipes:
@@ -118,8 +321,7 @@ def name(update: Update, _: CallbackContext) -> int:
         update.message.reply_text("Sorry! Please choose a different name.")
         return NAME
     else:
-        db.add_recipe(user_id, recipe_name) 
-        _.user_data['recipe name'] = recipe_name
+        start_draft(_.user_data, recipe_name)
         update.message.reply_text(
             "Perfect! Next, please send a picture of your food so Mama knows what it looks like.\n"
             "Type /skip if you do not have a photo to show Mama."
@@ -128,16 +330,23 @@ def name(update: Update, _: CallbackContext) -> int:
     return PHOTO
 
 def photo(update: Update, _:CallbackContext) -> int:
-    """Stores the given photo and asks for the yield of the recipe."""
-    db.update_username(update.message.from_user.id, update.message.from_user.username)
-    photo = update.message.photo[-1].get_file()
-    blob_name = str(update.message.from_user.id) + "-" + _.user_data['recipe name'] + ".jpg"
-    photo.download(blob_name) #downloads to local directory
-    blob = bucket.blob(blob_name)
-    blob.upload_from_filename(blob_name)
-    blob.make_public()
-    db.add_picture_url(update.message.from_user.id, _.user_data['recipe name'], blob.public_url)
-    os.remove(blob_name) #deletes photo from local directory
+    """Starts uploading the given photo and asks for the yield of the recipe."""
+    user_id = update.message.from_user.id
+    recipe_name = _.user_data['recipe name']
+    usernames.update(user_id, update.message.from_user.username)
+    photo = update.message.photo[-1]
+    upload = {}
+    queued = services.get("uploader").submit(
+        lambda: photo.get_file().download_as_bytearray(),
+        photo_uploaded(upload, photo.file_id),
+        photo_upload_failed(_.bot, update.message.chat_id, recipe_name)
+    )
+    if not queued:
+        update.message.reply_text("Mama is busy with a lot of photos right now. Please send it again in a moment, or type /skip.")
+        return PHOTO
+    # the photo can already be shown by its file_id while it is uploading
+    _.user_data['photo upload'] = upload
+    _.user_data['picture file id'] = photo.file_id
     update.message.reply_text(
         "Mama is impressed! Next, please state the yield of your recipe i.e. how many people or how much food your recipe serves.\n"
         "Type /skip if you are not sure."
@@ -147,7 +356,7 @@ def photo(update: Update, _:CallbackContext) -> int:
 
 def skip_photo(update: Update, _: CallbackContext) -> int:
     """Skips the photo and asks for the yield of the recipe."""
-    db.update_username(update.message.from_user.id, update.message.from_user.username)
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
     update.message.reply_text(
         "Don't worry. You can always show Mama the next time!\n"
         "Next, please state the yield of your recipe i.e. how many people or how much food your recipe serves.\n"
@@ -157,10 +366,9 @@ def skip_photo(update: Update, _: CallbackContext) -> int:
 
 def servings(update: Update, _: CallbackContext) -> int:
     """Stores the yield of the recipe and asks for the ingredients needed."""
-    db.update_username(update.message.from_user.id, update.message.from_user.username)
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
     servings = update.message.text
-    recipe_name = _.user_data['recipe name']
-    db.add_servings(update.message.from_user.id, recipe_name, servings)
+    _.user_data['servings'] = servings
     update.message.reply_text(
         "Okay! Your recipe serves " + servings + ".\n"
         "Please tell Mama what ingredients are needed next.\nType /done when you have entered all the ingredients."
@@ -169,7 +377,7 @@ def servings(update: Update, _: CallbackContext) -> int:
 
 def skip_servings(update: Update, _: CallbackContext) -> int:
     """Skips the recipe yield and asks for the ingredients needed."""
-    db.update_username(update.message.from_user.id, update.message.from_user.username)
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
     update.message.reply_text(
         "It's okay. Please tell Mama what ingredients are needed next.\n"
         "Type /done when you have entered all the ingredients.")
@@ -177,44 +385,40 @@ def skip_servings(update: Update, _: CallbackContext) -> int:
 
 def ingredients(update: Update, _: CallbackContext) -> int:
     """Stores the ingredients and asks for the steps."""
-    user_id = update.message.from_user.id
-    db.update_username(user_id, update.message.from_user.username)
-    recipe_name = _.user_data['recipe name']
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
     ingredient = update.message.text
-    ingredient_list = db.get_ingredients(user_id, recipe_name)
 
     if ingredient == "/done":
         update.message.reply_text(
         "Impressive! Now please write down the steps to the recipe. Type /done when you have entered all the steps you need."
     )
         return STEPS
-    elif ingredient in ingredient_list:
+    elif ingredient in _.user_data['ingredients']:
         update.message.reply_text("Ingredient has already been added.\nType /done if you have entered all the ingredients needed.")
         return INGREDIENTS
     else:
-        db.add_ingredient(user_id, recipe_name, ingredient)
-        update.message.reply_text(get_ingredient_list(user_id, recipe_name))
+        _.user_data['ingredients'].append(ingredient)
+        _.user_data['ingredient list'] += "- " + ingredient + "\n"
+        update.message.reply_text(_.user_data['ingredient list'])
         return INGREDIENTS
 
 def steps(update: Update, _: CallbackContext) -> int:
     """Stores the steps of the recipe and ends the conversation."""
     user_id = update.message.from_user.id
-    db.update_username(user_id, update.message.from_user.username)
-    recipe_name = _.user_data['recipe name']
+    usernames.update(user_id, update.message.from_user.username)
     step = update.message.text
 
     if step == "/done":
-        text = full_recipe(user_id, recipe_name)
-        photo_url = db.get_picture_url(user_id, recipe_name)
-        _.user_data.clear()
+        recipe = save_draft(user_id, _.user_data)
+        drop_draft(_.user_data)
         update.message.reply_text("Terrific! This is your new recipe:")
-        if len(photo_url) != 0:
-            update.message.reply_photo(photo_url[0])
-        update.message.reply_text(text)
+        reply_recipe_photo(update.message, user_id, recipe)
+        update.message.reply_text(full_recipe(recipe))
         return ConversationHandler.END
     else:
-        db.add_step(user_id, recipe_name, step)
-        update.message.reply_text(get_step_list(user_id, recipe_name))
+        _.user_data['steps'].append(step)
+        _.user_data['step list'] += str(len(_.user_data['steps'])) + ". " + step + "\n"
+        update.message.reply_text(_.user_data['step list'])
         return STEPS
 
 def cancel_add(update: Update, _: CallbackContext) -> int:
@@ -225,21 +429,15 @@ def cancel_add(update: Update, _: CallbackContext) -> int:
     )
 
     user_id = update.message.from_user.id
-    db.update_username(user_id, update.message.from_user.username)
-    if 'recipe name' in _.user_data:
-        recipe_name = _.user_data['recipe name']
-        if len(db.get_picture_url(user_id, recipe_name)) != 0:
-            blob_name = str(user_id) + "-" + recipe_name + ".jpg"
-            bucket.delete_blob(blob_name)
-        db.delete_recipe(user_id, recipe_name)
-    _.user_data.clear()
+    usernames.update(user_id, update.message.from_user.username)
+    drop_draft(_.user_data)
     return ConversationHandler.END
 
 def view_recipe(update: Update, _: CallbackContext) -> int:
     """Allows user to view an existing recipe."""
     user_id = update.message.from_user.id
     _.user_data['user id'] = user_id
-    db.update_username(user_id, update.message.from_user.username)
+    usernames.update(user_id, update.message.from_user.username)
     recipes = db.get_recipes(user_id)
     if len(recipes) == 0:
         update.message.reply_text("You currently do not have any recipes stored. Use /add to leave your recipes with Mama!")
@@ -252,16 +450,12 @@ def view_recipe(update: Update, _: CallbackContext) -> int:
 def send_recipe(update: Update, _: CallbackContext) -> int:
     """Sends the chosen recipe to the user."""
     user_id = _.user_data['user id']
-    db.update_username(update.message.from_user.id, update.message.from_user.username)
-    recipe_name = update.message.text
-    now = datetime.now()
-    timestamp = now.strftime("%d%m%Y%H%M%S")
-    if recipe_name in db.get_recipes(user_id):
-        if user_id == update.message.from_user.id or db.is_public(user_id, recipe_name):
-            photo_url = db.get_picture_url(user_id, recipe_name)
-            if len(photo_url) != 0:
-                update.message.reply_photo(photo_url[0] + "?a=" + timestamp)
-            update.message.reply_text(full_recipe(user_id, recipe_name), reply_markup=ReplyKeyboardRemove())
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
+    recipe = db.load_recipe(user_id, update.message.text)
+    if recipe is not None:
+        if user_id == update.message.from_user.id or recipe.public:
+            reply_recipe_photo(update.message, user_id, recipe)
+            update.message.reply_text(full_recipe(recipe), reply_markup=ReplyKeyboardRemove())
         else:
             update.message.reply_text("Sorry, you are unable to view this recipe as it has been set to private.", reply_markup=ReplyKeyboardRemove())
     else:
@@ -272,7 +466,7 @@ def send_recipe(update: Update, _: CallbackContext) -> int:
 def edit_recipe(update: Update, _: CallbackContext) -> int:
     """Allows user to edit the details of a stored recipe."""
     user_id = update.message.from_user.id
-    db.update_username(user_id, update.message.from_user.username)
+    usernames.update(user_id, update.message.from_user.username)
     _.user_data['user id'] = user_id
     recipes = db.get_recipes(user_id)
     if len(recipes) == 0:
@@ -286,99 +480,74 @@ def edit_recipe(update: Update, _: CallbackContext) -> int:
 def edit_recipe_inline(update: Update, _: CallbackContext) -> int:
     """Allows user to choose a different recipe to edit when using inline buttons."""
     query = update.callback_query
-    query.answer()
-    db.update_username(query.from_user.id, query.from_user.username)
+    sender.submit(query.answer)
+    usernames.update(query.from_user.id, query.from_user.username)
     recipes = db.get_recipes(_.user_data['user id'])
     keyboard = build_inline_keyboard([[recipe] for recipe in recipes])
-    query.edit_message_text("Which recipe would you like to edit?")
-    query.edit_message_reply_markup(keyboard)
+    query.edit_message_text("Which recipe would you like to edit?", reply_markup=keyboard)
     return RECIPE_CHOICE
 
 def recipe_choice(update: Update, _: CallbackContext) -> int:
     """Stores the name of the recipe to be edited."""
     recipe_name = update.callback_query
-    recipe_name.answer()
+    sender.submit(recipe_name.answer)
     _.user_data['recipe name'] = recipe_name.data
     user_id = _.user_data['user id']
-    db.update_username(user_id, recipe_name.from_user.username)
-    servings = db.get_servings(user_id, recipe_name.data)
-    photo_url = db.get_picture_url(user_id, recipe_name.data)
-    recipe = full_recipe(user_id, recipe_name.data)
+    usernames.update(user_id, recipe_name.from_user.username)
+    recipe = db.load_recipe(user_id, recipe_name.data)
 
-    buttons = ["recipe name"]
-    if len(photo_url) == 0:
-        buttons.append("add photo")
-    else:
-        now = datetime.now()
-        timestamp = now.strftime("%d%m%Y%H%M%S")
-        recipe_name.message.reply_photo(photo_url[0] + "?=a" + timestamp)
-        buttons.append("photo")
-    buttons.append("add servings") if len(servings) == 0 else buttons.append("servings")
-    if not db.is_public(user_id, recipe_name.data):
-        keyboard = build_inline_keyboard([buttons, ["ingredients", "directions"], ["set public"], ["<< back to list of recipes"]])
-    else:
-        keyboard = build_inline_keyboard([buttons, ["ingredients", "directions"], ["set private"], ["<< back to list of recipes"]])
+    # the recipe list loses its buttons while the recipe is being sent
+    sender.submit(recipe_name.edit_message_reply_markup, None)
+    reply_recipe_photo(recipe_name.message, user_id, recipe, thumbnail=True)
+    keyboard = build_recipe_part_keyboard(recipe)
 
     recipe_name.message.reply_text(
-        recipe + "\nYou are currently editing '" + recipe_name.data + "'.\n"
+        full_recipe(recipe) + "\nYou are currently editing '" + recipe_name.data + "'.\n"
         "Which part of the recipe would you like to edit?",
         reply_markup=keyboard
     )
-    recipe_name.edit_message_reply_markup(None)
     return RECIPE_PART
 
 def toggle_privacy(update: Update, _: CallbackContext) -> int:
     query = update.callback_query
-    query.answer()
+    sender.submit(query.answer)
     user_id = _.user_data['user id']
-    db.update_username(user_id, query.from_user.username)
     recipe_name = _.user_data['recipe name']
-    photo_url = db.get_picture_url(user_id, recipe_name)
-
-    buttons = ["recipe name"]
-    if len(photo_url) == 0:
-        buttons.append("add photo")
-    else:
-        now = datetime.now()
-        timestamp = now.strftime("%d%m%Y%H%M%S")
-        recipe_name.message.reply_photo(photo_url[0] + "?=a" + timestamp)
-        buttons.append("photo")
-    buttons.append("add servings") if len(db.get_servings(user_id, recipe_name)) == 0 else buttons.append("servings")
-    if query.data == "set private":
-        db.change_privacy(user_id, recipe_name, 0)
-        keyboard = build_inline_keyboard([buttons, ["ingredients", "directions"], ["set public"], ["<< back to list of recipes"]])
-        query.edit_message_text("Recipe has been set to private.\nWhat else would you like to edit?")
-    else:
-        db.change_privacy(user_id, recipe_name, 1)
-        keyboard = build_inline_keyboard([buttons, ["ingredients", "directions"], ["set private"], ["<< back to list of recipes"]])
-        query.edit_message_text("Recipe has been set to public.\nWhat else would you like to edit?")
-    query.edit_message_reply_markup(keyboard)
+    with db.transaction():
+        usernames.update(user_id, query.from_user.username)
+        db.change_privacy(user_id, recipe_name, 0 if query.data == "set private" else 1)
+        recipe = db.load_recipe(user_id, recipe_name)
+    privacy = "private" if query.data == "set private" else "public"
+    query.edit_message_text(
+        "Recipe has been set to " + privacy + ".\nWhat else would you like to edit?",
+        reply_markup=build_recipe_part_keyboard(recipe)
+    )
 
     return RECIPE_PART
 
 def edit_name(update: Update, _: CallbackContext) -> int:
     """Asks user for the new name of the recipe."""
     query = update.callback_query
-    query.answer()
-    db.update_username(query.from_user.id, query.from_user.username)
+    sender.submit(query.answer)
+    usernames.update(query.from_user.id, query.from_user.username)
     current_name = _.user_data['recipe name']
     keyboard = [[InlineKeyboardButton("<< back", callback_data=current_name)]]
 
     query.edit_message_text(
         "Your recipe name is currently '" + current_name + "'.\n"
-        "What would you like the new name of your recipe to be?"
+        "What would you like the new name of your recipe to be?",
+        reply_markup=InlineKeyboardMarkup(keyboard)
     )
-    query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard))
     return EDIT_NAME
 
 def change_name(update: Update, _: CallbackContext) -> int:
     """Updates the recipe's name in the database."""
     new_name = update.message.text
     user_id = _.user_data['user id']
-    db.update_username(user_id, update.message.from_user.username)
     current_name = _.user_data['recipe name']
 
     if new_name == current_name or new_name in db.get_recipes(user_id) or new_name == "remove yield":
+        usernames.update(user_id, update.message.from_user.username)
         keyboard = [[InlineKeyboardButton("<< back", callback_data=current_name)]]
         update.message.reply_text(
             "Sorry, please choose a different name.",
@@ -386,26 +555,11 @@ def change_name(update: Update, _: CallbackContext) -> int:
         )
         return EDIT_NAME
 
-    db.update_name(user_id, current_name, new_name)
+    with db.transaction():
+        usernames.update(user_id, update.message.from_user.username)
+        db.update_name(user_id, current_name, new_name)
     _.user_data['recipe name'] = new_name
-    servings = db.get_servings(user_id, new_name)
-    photo_url = db.get_picture_url(user_id, new_name)
-
-    buttons = ["recipe name"]
-    buttons.append("add servings") if len(servings) == 0 else buttons.append("servings")
-    if len(photo_url) == 0:
-        buttons.append("add photo")
-    else:
-        old_blob_name = str(user_id) + "-" + current_name + ".jpg"
-        new_blob_name = str(user_id) + "-" + new_name + ".jpg"
-        blob = bucket.rename_blob(bucket.get_blob(old_blob_name), new_blob_name)
-        blob.make_public()
-        db.add_picture_url(user_id, new_name, blob.public_url)
-        buttons.append("photo")
-    if not db.is_public(user_id, new_name):
-        keyboard = build_inline_keyboard([buttons, ["ingredients", "directions"], ["set public"], ["<< back to list of recipes"]])
-    else:
-        keyboard = build_inline_keyboard([buttons, ["ingredients", "directions"], ["set private"], ["<< back to list of recipes"]])
+    keyboard = build_recipe_part_keyboard(db.load_recipe(user_id, new_name))
     update.message.reply_text(
         "The name of your recipe has been changed from '" + current_name + "' to '" + new_name + "'.\n"
         "What else would you like to edit?",
@@ -416,137 +570,114 @@ def change_name(update: Update, _: CallbackContext) -> int:
 def edit_photo(update: Update, _: CallbackContext) -> int:
     """Asks user to update the photo."""
     query = update.callback_query
-    query.answer()
+    sender.submit(query.answer)
     user_id = _.user_data['user id']
-    db.update_username(user_id, query.from_user.username)
+    usernames.update(user_id, query.from_user.username)
     recipe_name = _.user_data['recipe name']
     if query.data == "photo":
         keyboard = [[InlineKeyboardButton("remove photo", callback_data="remove photo")], [InlineKeyboardButton("<< back", callback_data=recipe_name)]]
-        query.edit_message_text("Please send Mama an updated photo of your recipe. Mama is excited to see what changes you have made!")
+        text = "Please send Mama an updated photo of your recipe. Mama is excited to see what changes you have made!"
     else:
         keyboard = [[InlineKeyboardButton("<< back", callback_data=recipe_name)]]
-        query.edit_message_text("Please send Mama a picture of the recipe.")
-    query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard))
+        text = "Please send Mama a picture of the recipe."
+    query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
     return EDIT_PHOTO
 
 def remove_photo(update: Update, _: CallbackContext) -> int:
     """Removes the recipe photo."""
     query = update.callback_query
-    query.answer()
+    sender.submit(query.answer)
     user_id = _.user_data['user id']
-    db.update_username(user_id, query.from_user.username)
     recipe_name = _.user_data['recipe name']
-    servings = db.get_servings(user_id, recipe_name)
-    blob_name = str(user_id) + "-" + recipe_name + ".jpg"
-
-    bucket.delete_blob(blob_name)
-    db.delete_picture_url(user_id, recipe_name)
+    with db.transaction():
+        usernames.update(user_id, query.from_user.username)
+        picture_urls = db.get_photo_urls(user_id, recipe_name)
+        db.delete_picture_url(user_id, recipe_name)
+        recipe = db.load_recipe(user_id, recipe_name)
+    for picture_url in picture_urls:
+        discard_photo(picture_url)
 
-    buttons = ["recipe name", "add photo"]
-    buttons.append("add servings") if len(servings) == 0 else buttons.append("servings")
-    if not db.is_public(user_id, recipe_name):
-        keyboard = build_inline_keyboard([buttons, ["ingredients", "directions"], ["set public"], ["<< back to list of recipes"]])
-    else:
-        keyboard = build_inline_keyboard([buttons, ["ingredients", "directions"], ["set private"], ["<< back to list of recipes"]])
     query.edit_message_text(
         "The picture of your recipe has been removed."
-        "\nWhat else would you like to edit?"
+        "\nWhat else would you like to edit?",
+        reply_markup=build_recipe_part_keyboard(recipe)
     )
-    query.edit_message_reply_markup(keyboard)
     return RECIPE_PART
 
 def change_photo(update: Update, _: CallbackContext) -> int:
     """Updates the picture of the recipe."""
-    new_photo = update.message.photo[-1].get_file()
+    new_photo = update.message.photo[-1]
     user_id = update.message.from_user.id
-    db.update_username(user_id, update.message.from_user.username)
     recipe_name = _.user_data['recipe name']
-    blob_name = str(user_id) + "-" + recipe_name + ".jpg"
-    if len(db.get_picture_url(user_id, recipe_name)) != 0:
-        bucket.delete_blob(blob_name) #deletes old picture
-    new_photo.download(blob_name) 
-    blob = bucket.blob(blob_name)
-    blob.upload_from_filename(blob_name)
-    os.remove(blob_name)
-    blob.make_public()
-    db.add_picture_url(user_id, recipe_name, blob.public_url)
-
-    buttons = ["recipe name", "photo"]
-    servings = db.get_servings(update.message.from_user.id, _.user_data['recipe name'])
-    buttons.append("add servings") if len(servings) == 0 else buttons.append("servings")
-    if not db.is_public(user_id, recipe_name):
-        keyboard = build_inline_keyboard([buttons, ["ingredients", "directions"], ["set public"], ["<< back to list of recipes"]])
-    else:
-        keyboard = build_inline_keyboard([buttons, ["ingredients", "directions"], ["set private"], ["<< back to list of recipes"]])
+    usernames.update(user_id, update.message.from_user.username)
+    # the photo goes to this recipe even if it is renamed while uploading
+    recipe = db.load_recipe(user_id, recipe_name)
+    queued = services.get("uploader").submit(
+        lambda: new_photo.get_file().download_as_bytearray(),
+        photo_uploaded({'recipe id': recipe.recipe_id}, new_photo.file_id),
+        photo_upload_failed(_.bot, update.message.chat_id, recipe_name)
+    )
+    if not queued:
+        keyboard = [[InlineKeyboardButton("<< back", callback_data=recipe_name)]]
+        update.message.reply_text(
+            "Mama is busy with a lot of photos right now. Please send it again in a moment.",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return EDIT_PHOTO
+
     update.message.reply_text(
-        "The picture of '" + recipe_name + "' has been updated successfully!\n"
+        "Mama is saving the new picture of '" + recipe_name + "'. It will show up in a moment!\n"
         "What else would you like to edit?",
-        reply_markup=keyboard
+        reply_markup=build_recipe_part_keyboard(recipe)
     )
     return RECIPE_PART
 
 def edit_servings(update: Update, _: CallbackContext) -> int:
     """Asks user to update the recipe yield."""
     query = update.callback_query
-    query.answer()
+    sender.submit(query.answer)
     user_id = _.user_data['user id']
-    db.update_username(user_id, query.from_user.username)
+    usernames.update(user_id, query.from_user.username)
     recipe_name = _.user_data['recipe name']
     if query.data == "servings":
-        current_serving = db.get_servings(user_id, recipe_name)
+        current_serving = db.load_recipe(user_id, recipe_name).servings
         keyboard = [[InlineKeyboardButton("remove yield", callback_data="remove yield")], [InlineKeyboardButton("<< back", callback_data=recipe_name)]]
-
-        query.edit_message_text(
-            "Your recipe currently serves " + current_serving[0] + ".\n"
-            "What is the new yield of your recipe?"
-        )
-
+        text = "Your recipe currently serves " + current_serving + ".\nWhat is the new yield of your recipe?"
     else:
         keyboard = [[InlineKeyboardButton("<< back", callback_data=recipe_name)]]
-        query.edit_message_text(
-            "What is the yield of your recipe?"
-        )
-    query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard))
+        text = "What is the yield of your recipe?"
+    query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
     return EDIT_SERVINGS
 
 def remove_servings(update: Update, _: CallbackContext) -> int:
     """Removes the yield of the recipe."""
     query = update.callback_query
-    query.answer()
-    db.update_username(query.from_user.id, query.from_user.username)
-    db.delete_servings(_.user_data['user id'], _.user_data['recipe name'])
-    photo_url = db.get_picture_url(_.user_data['user id'], _.user_data['recipe name'])
-
-    buttons = ["recipe name", "add servings"]
-    buttons.insert(1, "add photo") if len(photo_url) == 0 else buttons.insert(1, "photo")
-    if not db.is_public(_.user_data['user id'], _.user_data['recipe name']):
-        keyboard = build_inline_keyboard([buttons, ["ingredients", "directions"], ["set public"], ["<< back to list of recipes"]])
-    else:
-        keyboard = build_inline_keyboard([buttons, ["ingredients", "directions"], ["set private"], ["<< back to list of recipes"]])
+    sender.submit(query.answer)
+    with db.transaction():
+        usernames.update(query.from_user.id, query.from_user.username)
+        db.delete_servings(_.user_data['user id'], _.user_data['recipe name'])
+        recipe = db.load_recipe(_.user_data['user id'], _.user_data['recipe name'])
+
     query.edit_message_text(
         "The yield of your recipe has been removed."
-        "\nWhat else would you like to edit?"
+        "\nWhat else would you like to edit?",
+        reply_markup=build_recipe_part_keyboard(recipe)
     )
-    query.edit_message_reply_markup(keyboard)
     return RECIPE_PART
 
 def change_servings(update: Update, _: CallbackContext) -> int:
     """Updates the serving stored in the database."""
     new_serving = update.message.text
     user_id = _.user_data['user id']
-    db.update_username(user_id, update.message.from_user.username)
     recipe_name = _.user_data['recipe name']
-    current_serving = db.get_servings(user_id, recipe_name)
-    photo_url = db.get_picture_url(user_id, recipe_name)
-    db.add_servings(user_id, recipe_name, new_serving)
-
-    buttons = ["recipe name", "servings"]
-    buttons.insert(1, "add photo") if len(photo_url) == 0 else buttons.insert(1, "photo")
-    if not db.is_public(user_id, recipe_name):
-        keyboard = build_inline_keyboard([buttons, ["ingredients", "directions"], ["set public"], ["<< back to list of recipes"]])
-    else:
-        keyboard = build_inline_keyboard([buttons, ["ingredients", "directions"], ["set private"], ["<< back to list of recipes"]])
-    if len(current_serving) == 0:
+    with db.transaction():
+        usernames.update(user_id, update.message.from_user.username)
+        current_serving = db.load_recipe(user_id, recipe_name).servings
+        db.add_servings(user_id, recipe_name, new_serving)
+        recipe = db.load_recipe(user_id, recipe_name)
+
+    keyboard = build_recipe_part_keyboard(recipe)
+    if current_serving is None:
         update.message.reply_text(
             "Your recipe now serves " + new_serving + ".\n"
             "What else would you like to edit?",
@@ -554,7 +685,7 @@ def change_servings(update: Update, _: CallbackContext) -> int:
         )
     else:
         update.message.reply_text(
-            "Your recipe now serves " + new_serving + " instead of " + current_serving[0] + ".\n"
+            "Your recipe now serves " + new_serving + " instead of " + current_serving + ".\n"
             "What else would you like to edit?",
             reply_markup=keyboard
         )
@@ -563,11 +694,11 @@ def change_servings(update: Update, _: CallbackContext) -> int:
 def edit_ingredients(update: Update, _: CallbackContext) -> int:
     """Asks user how they would like to edit the list of ingredients."""
     query = update.callback_query
-    query.answer()
+    sender.submit(query.answer)
     user_id = _.user_data['user id']
-    db.update_username(user_id, query.from_user.username)
+    usernames.update(user_id, query.from_user.username)
     recipe_name = _.user_data['recipe name']
-    ingredient_list = get_ingredient_list(user_id, recipe_name)
+    ingredient_list = get_ingredient_list(db.load_recipe(user_id, recipe_name).ingredients)
     keyboard = [[
         InlineKeyboardButton("add an ingredient", callback_data="add"),
         InlineKeyboardButton("edit an ingredient", callback_data="edit"),
@@ -578,44 +709,44 @@ def edit_ingredients(update: Update, _: CallbackContext) -> int:
 
     query.edit_message_text(
         ingredient_list + "\n"
-        "What would you like to do with the list of ingredients?"
+        "What would you like to do with the list of ingredients?",
+        reply_markup=InlineKeyboardMarkup(keyboard)
     )
-    query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard))
     return EDIT_INGREDIENTS
 
 def ingredients_list_operation(update: Update, _: CallbackContext) -> int:
     """Allows user to edit the ingredient list according to their choice (add, edit or delete)."""
     query = update.callback_query
-    query.answer()
+    sender.submit(query.answer)
     user_id = _.user_data['user id']
-    db.update_username(user_id, query.from_user.username)
+    usernames.update(user_id, query.from_user.username)
     recipe_name = _.user_data['recipe name']
     if query.data == "add":
         keyboard = build_inline_keyboard([["<< back"]])
-        query.edit_message_text("Please tell Mama what ingredient you would like to add.")
-        query.edit_message_reply_markup(keyboard)
+        query.edit_message_text("Please tell Mama what ingredient you would like to add.", reply_markup=keyboard)
         return ADD_INGREDIENT
     else:
-        ingredients = db.get_ingredients(user_id, recipe_name)
-        buttons = [[ingredient] for ingredient in ingredients]
-        buttons.append(["<< back"])
-        keyboard = build_inline_keyboard(buttons)
+        keyboard = build_ingredient_keyboard(db.load_recipe(user_id, recipe_name))
         if query.data == "edit":
-            query.edit_message_text("Please select an ingredient to edit:")
-            query.edit_message_reply_markup(keyboard)
+            query.edit_message_text("Please select an ingredient to edit:", reply_markup=keyboard)
             return UPDATE_INGREDIENT
         else:
-            query.edit_message_text("Please select an ingredient to delete:")
-            query.edit_message_reply_markup(keyboard)
+            query.edit_message_text("Please select an ingredient to delete:", reply_markup=keyboard)
             return DELETE_INGREDIENT
 
 def add_ingredient(update: Update, _:CallbackContext) -> int:
     """Adds the given ingredient to the ingredient list."""
     ingredient = update.message.text
     user_id = _.user_data['user id']
-    db.update_username(user_id, update.message.from_user.username)
     recipe_name = _.user_data['recipe name']
-    if ingredient in db.get_ingredients(user_id, recipe_name):
+    with db.transaction():
+        usernames.update(user_id, update.message.from_user.username)
+        ingredients = db.load_recipe(user_id, recipe_name).ingredients
+        duplicate = ingredient in ingredients
+        if not duplicate:
+            db.add_ingredient(user_id, recipe_name, ingredient)
+            ingredients.append(ingredient)
+    if duplicate:
         keyboard = build_inline_keyboard([["<< back"]])
         update.message.reply_text("Ingredient already exists! Please enter a different ingredient.", reply_markup=keyboard)
         return ADD_INGREDIENT
@@ -627,9 +758,8 @@ def add_ingredient(update: Update, _:CallbackContext) -> int:
         ], [
             InlineKeyboardButton("<< back", callback_data=recipe_name)
         ]] 
-        db.add_ingredient(user_id, recipe_name, ingredient)
         update.message.reply_text(
-            "List of ingredients has been updated!\n\n" + get_ingredient_list(user_id, recipe_name) + "\nWhat else would you like to do?",
+            "List of ingredients has been updated!\n\n" + get_ingredient_list(ingredients) + "\nWhat else would you like to do?",
             reply_markup=InlineKeyboardMarkup(keyboard) 
         )
         return EDIT_INGREDIENTS
@@ -637,23 +767,31 @@ def add_ingredient(update: Update, _:CallbackContext) -> int:
 def update_ingredient(update: Update, _: CallbackContext) -> int:
     """Asks user what they would like to update the selected ingredient to."""
     ingredient = update.callback_query
-    ingredient.answer()
-    db.update_username(ingredient.from_user.id, ingredient.from_user.username)
-    _.user_data['ingredient'] = ingredient.data
+    sender.submit(ingredient.answer)
+    usernames.update(ingredient.from_user.id, ingredient.from_user.username)
+    ingredient_id = int(ingredient.data.split()[1])
+    recipe = db.load_recipe(_.user_data['user id'], _.user_data['recipe name'])
+    _.user_data['ingredient id'] = ingredient_id
     keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("<< back", callback_data="edit")]])
 
-    ingredient.edit_message_text("What would you like to change " + ingredient.data + " to?")
-    ingredient.edit_message_reply_markup(keyboard)
+    current_ingredient = recipe.ingredients[recipe.ingredient_ids.index(ingredient_id)]
+    ingredient.edit_message_text("What would you like to change " + current_ingredient + " to?", reply_markup=keyboard)
     return SAVE_INGREDIENT
 
 def save_ingredient(update: Update, _: CallbackContext) -> int:
     """Updates the selected ingredient with the given input."""
     new_ingredient = update.message.text
-    current_ingredient = _.user_data['ingredient']
+    ingredient_id = _.user_data['ingredient id']
     user_id = _.user_data['user id']
-    db.update_username(user_id, update.message.from_user.username)
     recipe_name = _.user_data['recipe name']
-    if new_ingredient in db.get_ingredients(user_id, recipe_name):
+    with db.transaction():
+        usernames.update(user_id, update.message.from_user.username)
+        recipe = db.load_recipe(user_id, recipe_name)
+        duplicate = new_ingredient in recipe.ingredients
+        if not duplicate:
+            db.update_ingredient(user_id, recipe_name, ingredient_id, new_ingredient)
+            recipe = db.load_recipe(user_id, recipe_name)
+    if duplicate:
         keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("<< back", callback_data="edit")]])
         update.message.reply_text(
             "This ingredient already exists in the ingredient list. Please send a different one.",
@@ -661,165 +799,183 @@ def save_ingredient(update: Update, _: CallbackContext) -> int:
         )
         return SAVE_INGREDIENT
     else:
-        db.update_ingredient(user_id, recipe_name, current_ingredient, new_ingredient)
-        ingredients = db.get_ingredients(user_id, recipe_name)
-        buttons = [[ingredient] for ingredient in ingredients]
-        buttons.append(["<< back"])
-        keyboard = build_inline_keyboard(buttons)
         update.message.reply_text(
-            "List of ingredients has been updated!\n\n" + get_ingredient_list(user_id, recipe_name) + "\n"
+            "List of ingredients has been updated!\n\n" + get_ingredient_list(recipe.ingredients) + "\n"
             "Select another ingredient to update, or press back to return to the previous menu.",
-            reply_markup=keyboard
+            reply_markup=build_ingredient_keyboard(recipe)
         )
         return UPDATE_INGREDIENT
 
 def delete_ingredient(update: Update, _: CallbackContext) -> int:
     """Deletes the selected ingredient from the database."""
     ingredient = update.callback_query
-    ingredient.answer()
+    sender.submit(ingredient.answer)
     user_id = _.user_data['user id']
-    db.update_username(user_id, ingredient.from_user.username)
     recipe_name = _.user_data['recipe name']
-    db.delete_ingredient(user_id, recipe_name, ingredient.data)
-    ingredients = db.get_ingredients(user_id, recipe_name)
-    buttons = [[ingredient] for ingredient in ingredients]
-    buttons.append(["<< back"])
-    keyboard = build_inline_keyboard(buttons)
+    with db.transaction():
+        usernames.update(user_id, ingredient.from_user.username)
+        db.delete_ingredient(user_id, recipe_name, int(ingredient.data.split()[1]))
+        recipe = db.load_recipe(user_id, recipe_name)
     ingredient.edit_message_text(
-        "List of ingredients has been updated!\n\n" + get_ingredient_list(user_id, recipe_name) + "\n"
-        "Select another ingredient to delete, or press back to return to the previous menu."
+        "List of ingredients has been updated!\n\n" + get_ingredient_list(recipe.ingredients) + "\n"
+        "Select another ingredient to delete, or press back to return to the previous menu.",
+        reply_markup=build_ingredient_keyboard(recipe)
     )
-    ingredient.edit_message_reply_markup(keyboard)
     return DELETE_INGREDIENT
 
 def edit_steps(update: Update, _: CallbackContext) -> int:
     """Asks user how they would like to edit the list of steps."""
     query = update.callback_query
-    query.answer()
+    sender.submit(query.answer)
     user_id = _.user_data['user id']
-    db.update_username(user_id, query.from_user.username)
+    usernames.update(user_id, query.from_user.username)
     recipe_name = _.user_data['recipe name']
-    step_list = get_step_list(user_id, recipe_name)
-    keyboard = [[
-        InlineKeyboardButton("add a step", callback_data="add"),
-        InlineKeyboardButton("edit a step", callback_data="edit"),
-        InlineKeyboardButton("delete a step", callback_data="delete")
-    ], [
-        InlineKeyboardButton("<< back", callback_data=recipe_name)
-    ]]
+    step_list = get_step_list(db.load_recipe(user_id, recipe_name).steps)
 
     query.edit_message_text(
         step_list + "\n"
-        "What would you like to do with the directions?"
+        "What would you like to do with the directions?",
+        reply_markup=build_steps_menu_keyboard(recipe_name)
     )
-    query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard))
     return EDIT_STEPS
 
 def steps_list_operation(update: Update, _: CallbackContext) -> int:
-    """Allows user to edit the steps list according to their choice (add, edit, delete)."""
+    """Allows user to edit the steps list according to their choice (add, insert, move, edit, delete)."""
     query = update.callback_query
-    query.answer()
+    sender.submit(query.answer)
     user_id = _.user_data['user id']
-    db.update_username(user_id, query.from_user.username)
+    usernames.update(user_id, query.from_user.username)
     recipe_name = _.user_data['recipe name']
     if query.data == "add":
-        steps = db.get_steps(user_id, recipe_name)
+        _.user_data['insert before'] = None
         keyboard = ([[InlineKeyboardButton("<< back", callback_data="<< back")]])
-        query.edit_message_text("Please tell Mama what's the next step to the recipe.")
-        query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard))
+        query.edit_message_text("Please tell Mama what's the next step to the recipe.", reply_markup=InlineKeyboardMarkup(keyboard))
         return ADD_STEP
     else:
-        steps = db.get_steps(user_id, recipe_name)
-        x = 1
-        buttons = []
-        for step in steps:
-            buttons.append([InlineKeyboardButton(str(x), callback_data=step)])
-            x+=1
-        buttons.append([InlineKeyboardButton("<< back", callback_data="<< back")])
-        if query.data == "edit":
-            query.edit_message_text(get_step_list(user_id, recipe_name) + "\nPlease select a step to edit:")
-            query.edit_message_reply_markup(InlineKeyboardMarkup(buttons))
+        recipe = db.load_recipe(user_id, recipe_name)
+        step_list = get_step_list(recipe.steps)
+        if query.data == "insert":
+            query.edit_message_text(step_list + "\nPlease select the step that the new step should come before:", reply_markup=build_step_keyboard(recipe))
+            return INSERT_STEP
+        elif query.data == "move":
+            query.edit_message_text(step_list + "\nPlease select a step to move:", reply_markup=build_step_keyboard(recipe))
+            return MOVE_STEP
+        elif query.data == "edit":
+            query.edit_message_text(step_list + "\nPlease select a step to edit:", reply_markup=build_step_keyboard(recipe))
             return UPDATE_STEP
         else:
-            query.edit_message_text(get_step_list(user_id, recipe_name) + "\nPlease select a step to delete:")
-            query.edit_message_reply_markup(InlineKeyboardMarkup(buttons))
+            query.edit_message_text(step_list + "\nPlease select a step to delete:", reply_markup=build_step_keyboard(recipe))
             return DELETE_STEP
 
-def add_step(update: Update, _:CallbackContext) -> int: # only allows user to append to the end of the directions
-    """Adds the given step to the end of the list of steps."""
+def insert_step(update: Update, _: CallbackContext) -> int:
+    """Asks user for the step to insert before the selected step."""
+    query = update.callback_query
+    sender.submit(query.answer)
+    usernames.update(query.from_user.id, query.from_user.username)
+    step_id = int(query.data.split()[1])
+    recipe = db.load_recipe(_.user_data['user id'], _.user_data['recipe name'])
+    _.user_data['insert before'] = step_id
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("<< back", callback_data="<< back")]])
+    query.edit_message_text(
+        "Please tell Mama the step that comes before step " + str(recipe.step_ids.index(step_id) + 1) + ".",
+        reply_markup=keyboard
+    )
+    return ADD_STEP
+
+def add_step(update: Update, _:CallbackContext) -> int:
+    """Adds the given step to the end of the list of steps, or before the step selected to insert at."""
     step = update.message.text
     user_id = _.user_data['user id']
-    db.update_username(user_id, update.message.from_user.username)
     recipe_name = _.user_data['recipe name']
-    keyboard = [[
-        InlineKeyboardButton("add a step", callback_data="add"),
-        InlineKeyboardButton("edit a step", callback_data="edit"),
-        InlineKeyboardButton("delete a step", callback_data="delete")
-    ], [
-        InlineKeyboardButton("<< back", callback_data=recipe_name)
-    ]] 
-    db.add_step(user_id, recipe_name, step)
+    with db.transaction():
+        usernames.update(user_id, update.message.from_user.username)
+        db.add_step(user_id, recipe_name, step, _.user_data.pop('insert before', None))
+        steps = db.load_recipe(user_id, recipe_name).steps
     update.message.reply_text(
-        "The directions have been updated!\n\n" + get_step_list(user_id, recipe_name) + "\nWhat else would you like to do?",
-        reply_markup=InlineKeyboardMarkup(keyboard) 
+        "The directions have been updated!\n\n" + get_step_list(steps) + "\nWhat else would you like to do?",
+        reply_markup=build_steps_menu_keyboard(recipe_name)
+    )
+    return EDIT_STEPS
+
+def move_step(update: Update, _: CallbackContext) -> int:
+    """Asks user where the selected step should be moved to."""
+    query = update.callback_query
+    sender.submit(query.answer)
+    usernames.update(query.from_user.id, query.from_user.username)
+    step_id = int(query.data.split()[1])
+    recipe = db.load_recipe(_.user_data['user id'], _.user_data['recipe name'])
+    _.user_data['step id'] = step_id
+    query.edit_message_text(
+        get_step_list(recipe.steps) + "\n"
+        "Step " + str(recipe.step_ids.index(step_id) + 1) + " should come before which step?",
+        reply_markup=build_step_keyboard(recipe, "move to the end")
+    )
+    return MOVE_STEP_TO
+
+def move_step_to(update: Update, _: CallbackContext) -> int:
+    """Moves the selected step before the chosen step, or to the end of the directions."""
+    query = update.callback_query
+    sender.submit(query.answer)
+    user_id = _.user_data['user id']
+    recipe_name = _.user_data['recipe name']
+    before = None if query.data == "move to the end" else int(query.data.split()[1])
+    with db.transaction():
+        usernames.update(user_id, query.from_user.username)
+        db.move_step(user_id, recipe_name, _.user_data['step id'], before)
+        steps = db.load_recipe(user_id, recipe_name).steps
+    query.edit_message_text(
+        "The directions have been updated!\n\n" + get_step_list(steps) + "\nWhat else would you like to do?",
+        reply_markup=build_steps_menu_keyboard(recipe_name)
     )
     return EDIT_STEPS
 
 def update_step(update: Update, _: CallbackContext) -> int:
     """Asks user what they would like to update the selected step to."""
     step = update.callback_query
-    step.answer()
-    db.update_username(step.from_user.id, step.from_user.username)
-    _.user_data['step'] = step.data
+    sender.submit(step.answer)
+    usernames.update(step.from_user.id, step.from_user.username)
+    step_id = int(step.data.split()[1])
+    recipe = db.load_recipe(_.user_data['user id'], _.user_data['recipe name'])
+    _.user_data['step id'] = step_id
     keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("<< back", callback_data="edit")]])
-    step.edit_message_text("What would you like to change the step '" + step.data + "' to?")
-    step.edit_message_reply_markup(keyboard)
+    current_step = recipe.steps[recipe.step_ids.index(step_id)]
+    step.edit_message_text("What would you like to change the step '" + current_step + "' to?", reply_markup=keyboard)
     return SAVE_STEP
 
 def save_step(update: Update, _: CallbackContext) -> int:
     """Updates the selected step with the given input."""
     new_step = update.message.text
-    current_step = _.user_data['step']
+    step_id = _.user_data['step id']
     user_id = _.user_data['user id']
-    db.update_username(user_id, update.message.from_user.username)
     recipe_name = _.user_data['recipe name']
-    db.update_step(user_id, recipe_name, current_step, new_step)
-    steps = db.get_steps(user_id, recipe_name)
+    with db.transaction():
+        usernames.update(user_id, update.message.from_user.username)
+        db.update_step(user_id, recipe_name, step_id, new_step)
+        recipe = db.load_recipe(user_id, recipe_name)
 
-    x = 1
-    buttons = []
-    for step in steps:
-        buttons.append([InlineKeyboardButton(str(x), callback_data=step)])
-        x+=1
-    buttons.append([InlineKeyboardButton("<< back", callback_data="<< back")])
     update.message.reply_text(
-        "The directions have been updated!\n\n" + get_step_list(user_id, recipe_name) + "\n"
+        "The directions have been updated!\n\n" + get_step_list(recipe.steps) + "\n"
         "Select another step to update, or press back to return to the previous menu.",
-        reply_markup=InlineKeyboardMarkup(buttons)
+        reply_markup=build_step_keyboard(recipe)
     )
     return UPDATE_STEP
 
 def delete_step(update: Update, _: CallbackContext) -> int:
     """Deletes the selected step from the database."""
     query = update.callback_query
-    query.answer()
+    sender.submit(query.answer)
     user_id = _.user_data['user id']
-    db.update_username(user_id, query.from_user.username)
     recipe_name = _.user_data['recipe name']
-    db.delete_step(user_id, recipe_name, query.data)
-    steps = db.get_steps(user_id, recipe_name)
+    with db.transaction():
+        usernames.update(user_id, query.from_user.username)
+        db.delete_step(user_id, recipe_name, int(query.data.split()[1]))
+        recipe = db.load_recipe(user_id, recipe_name)
 
-    x = 1
-    buttons = []
-    for step in steps:
-        buttons.append([InlineKeyboardButton(str(x), callback_data=step)])
-        x+=1
-    buttons.append([InlineKeyboardButton("<< back", callback_data="<< back")])
     query.edit_message_text(
-        "The directions have been updated!\n\n" + get_step_list(user_id, recipe_name) + "\n"
-        "Select another step to delete, or press back to return to the previous menu."
+        "The directions have been updated!\n\n" + get_step_list(recipe.steps) + "\n"
+        "Select another step to delete, or press back to return to the previous menu.",
+        reply_markup=build_step_keyboard(recipe)
     )
-    query.edit_message_reply_markup(InlineKeyboardMarkup(buttons))
     return DELETE_STEP
 
 def edit_timeout(update: Update, _: CallbackContext) -> int:
@@ -834,7 +990,7 @@ def exit(update: Update, _: CallbackContext) -> int:
 def delete_recipe(update: Update, _: CallbackContext) -> int:
     """Asks user for a recipe to delete."""
     user_id = update.message.from_user.id
-    db.update_username(user_id, update.message.from_user.username)
+    usernames.update(user_id, update.message.from_user.username)
     _.user_data['user id'] = user_id
     recipes = db.get_recipes(user_id)
     if len(recipes) == 0:
@@ -848,43 +1004,135 @@ def delete_recipe(update: Update, _: CallbackContext) -> int:
 def confirmation(update: Update, _: CallbackContext) -> int:
     """Makes sure user deletes the correct recipe."""
     recipe_name = update.callback_query
-    recipe_name.answer()
-    db.update_username(recipe_name.from_user.id, recipe_name.from_user.username)
+    sender.submit(recipe_name.answer)
+    usernames.update(recipe_name.from_user.id, recipe_name.from_user.username)
     _.user_data["recipe name"] = recipe_name.data
     keyboard = build_inline_keyboard([["yes", "no"]])
     recipe_name.edit_message_text(
-        "Are you sure you want to delete '" + recipe_name.data + "'? Mama won't be able to recover any deleted recipes!"
+        "Are you sure you want to delete '" + recipe_name.data + "'? Mama won't be able to recover any deleted recipes!",
+        reply_markup=keyboard
     )
-    recipe_name.edit_message_reply_markup(keyboard)
     return DELETION
 
 def deletion(update: Update, _: CallbackContext) -> None:
     """Deletes recipe from the database."""
     answer = update.callback_query
-    answer.answer()
-    db.update_username(answer.from_user.id, answer.from_user.username)
+    sender.submit(answer.answer)
     if answer.data == "yes":
         user_id = _.user_data['user id']
         recipe_name = _.user_data["recipe name"]
-        if len(db.get_picture_url(user_id, recipe_name)) != 0:
-            blob_name = str(user_id) + "-" + recipe_name + ".jpg"
-            bucket.delete_blob(blob_name)
-        db.delete_recipe(user_id, recipe_name)
-        _.user_data.clear()
+        usernames.update(answer.from_user.id, answer.from_user.username)
+        remove_recipe(user_id, recipe_name)
+        drop_draft(_.user_data)
         answer.edit_message_text(recipe_name + " has been deleted from your recipes.")
     else:
-        _.user_data.clear()
+        usernames.update(answer.from_user.id, answer.from_user.username)
+        drop_draft(_.user_data)
         answer.edit_message_text("Seems like you've changed your mind!")
 
+def build_search_page(terms, page):
+    results = db.search_recipes(terms, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE)
+    if len(results) == 0:
+        return None
+    buttons = []
+    for recipe_id, user_id, recipe_name, username in results[:SEARCH_PAGE_SIZE]:
+        label = recipe_name if username in (None, "None") else recipe_name + " by @" + username
+        buttons.append([InlineKeyboardButton(label, callback_data="search result " + str(recipe_id))])
+    page_buttons = []
+    if page > 0:
+        page_buttons.append(InlineKeyboardButton("<< previous", callback_data="search page " + str(page - 1)))
+    if len(results) > SEARCH_PAGE_SIZE:
+        page_buttons.append(InlineKeyboardButton("next >>", callback_data="search page " + str(page + 1)))
+    if len(page_buttons) != 0:
+        buttons.append(page_buttons)
+    return InlineKeyboardMarkup(buttons)
+
 def search_recipes(update: Update, _: CallbackContext) -> None:
     """Returns the related recipes from the given keywords."""
-    input = update.message.text[8:]
-    update.message.reply_text("searching for term...")
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
+    terms = update.message.text[8:].strip()
+    if terms == "":
+        update.message.reply_text("Please tell Mama what to look for, e.g. /search chicken rice")
+        return
+    _.user_data['search term'] = terms
+    keyboard = build_search_page(terms, 0)
+    if keyboard is None:
+        update.message.reply_text("Sorry, Mama couldn't find any public recipes for '" + terms + "'.")
+    else:
+        update.message.reply_text("Here are the public recipes Mama found for '" + terms + "':", reply_markup=keyboard)
+
+def search_page(update: Update, _: CallbackContext) -> None:
+    """Shows another page of search results."""
+    query = update.callback_query
+    sender.submit(query.answer)
+    usernames.update(query.from_user.id, query.from_user.username)
+    terms = _.user_data.get('search term')
+    keyboard = None if terms is None else build_search_page(terms, int(query.data.split()[-1]))
+    if keyboard is None:
+        query.edit_message_text("This search has expired. Please search again with /search <search term>.")
+    else:
+        query.edit_message_text("Here are the public recipes Mama found for '" + terms + "':", reply_markup=keyboard)
+
+def search_result(update: Update, _: CallbackContext) -> None:
+    """Sends the search result chosen by the user."""
+    query = update.callback_query
+    sender.submit(query.answer)
+    usernames.update(query.from_user.id, query.from_user.username)
+    owner = db.get_recipe_owner(int(query.data.split()[-1]))
+    recipe = None if len(owner) == 0 else db.load_recipe(*owner[0])
+    if recipe is None:
+        query.message.reply_text("Sorry, Mama couldn't find the recipe.")
+    elif owner[0][0] != query.from_user.id and not recipe.public:
+        query.message.reply_text("Sorry, you are unable to view this recipe as it has been set to private.")
+    else:
+        reply_recipe_photo(query.message, owner[0][0], recipe)
+        query.message.reply_text(full_recipe(recipe))
+
+def format_web_recipe(recipe):
+    msg = recipe.name + "\n\n" + get_ingredient_list(recipe.ingredients) + "\n" + get_step_list(recipe.steps)
+    source = "\nFrom " + recipe.url
+    if len(msg) + len(source) > constants.MAX_MESSAGE_LENGTH:
+        msg = msg[:constants.MAX_MESSAGE_LENGTH - len(source) - 4] + "...\n"
+    return msg + source
+
+def web_search(update: Update, _: CallbackContext) -> None:
+    """Sends recipes from the web for the given keywords as they are found."""
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
+    terms = " ".join(_.args or [])
+    if terms == "":
+        update.message.reply_text("Please tell Mama what to look for, e.g. /websearch chicken rice")
+        return
+    update.message.reply_text("Mama is looking for recipes for '" + terms + "' on the web...")
+    found = 0
+    try:
+        for recipe in services.get("web search").search(terms):
+            update.message.reply_text(format_web_recipe(recipe), disable_web_page_preview=True)
+            found += 1
+    except FetchError:
+        logger.warning("Web search for '%s' failed", terms, exc_info=True)
+        update.message.reply_text("Sorry, Mama couldn't reach the recipe website. Please try again later.")
+        return
+    if found == 0:
+        update.message.reply_text("Sorry, Mama couldn't find any recipes for '" + terms + "' on the web.")
+
+def show_stats(update: Update, _: CallbackContext) -> None:
+    """Shows admins how long updates wait for their chat and which database methods take the most time."""
+    if update.message.from_user.id not in ADMIN_IDS:
+        return
+    chats = _.dispatcher.scheduler.stats()
+    update.message.reply_text(
+        "{active_chats} chats with {queued} updates queued, {processed} handled, deepest queue {max_depth}\n"
+        "Wait for the chat: p50 {wait_p50_ms}ms, p99 {wait_p99_ms}ms, max {wait_max_ms}ms".format(**chats)
+    )
+    if sql_stats is None:
+        update.message.reply_text("SQL statistics are off. Start the bot with SQL_STATS=1 to collect them.")
+    else:
+        update.message.reply_text(sql_stats.summary())
 
 def search_user(update: Update, _: CallbackContext) -> int:
     username = update.message.text[9:]
     user_id = db.get_user_id(username)
-    db.update_username(update.message.from_user.id, update.message.from_user.username)
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
     if len(user_id) == 0:
         update.message.reply_text(
             "Sorry, it seems like Mama doesn't know this person!\n"
@@ -906,23 +1154,453 @@ def search_user(update: Update, _: CallbackContext) -> int:
                 reply_markup=keyboard)    
         return SEND_RECIPE
 
-def update_usernames(_: CallbackContext) -> None:
-    chat_ids = db.get_all_chat_id()
-    for id in chat_ids:
-        username = Bot.get_chat(id).username
-        if username != None:
-            db.update_username(id, username)
+def export_book(update: Update, _: CallbackContext) -> None:
+    """Sends the user their recipe book as a JSON Lines file."""
+    user_id = update.message.from_user.id
+    usernames.update(user_id, update.message.from_user.username)
+    with tempfile.TemporaryFile() as file:
+        out = io.TextIOWrapper(file, encoding="utf-8")
+        count = export_jsonl(db, out, user_id)
+        if count == 0:
+            update.message.reply_text("Your recipe book is empty. Use /add to leave your recipes with Mama!")
+            return
+        out.flush()
+        file.seek(0)
+        update.message.reply_document(file, filename="recipes.jsonl", caption="Mama has packed up " + str(count) + " recipes for you!")
+        out.detach()
+
+def import_instructions(update: Update, _: CallbackContext) -> None:
+    """Explains how to import a recipe book."""
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
+    update.message.reply_text(
+        "Send Mama a .jsonl file (like the one from /export) and she will add its recipes to your book.\n"
+        "Recipes with a name you already use will be skipped."
+    )
 
-def main() -> None:
-    # Create the Updater and pass it your bot's token.
-    updater = Updater(API_KEY)
-    job = updater.job_queue
+def import_book(update: Update, _: CallbackContext) -> None:
+    """Adds the recipes in an uploaded JSON Lines file to the user's book."""
+    user_id = update.message.from_user.id
+    usernames.update(user_id, update.message.from_user.username)
+    with tempfile.TemporaryFile() as file:
+        update.message.document.get_file().download(out=file)
+        file.seek(0)
+        try:
+            imported, skipped = import_jsonl(db, io.TextIOWrapper(file, encoding="utf-8"), user_id)
+        except (ValueError, KeyError, TypeError):
+            update.message.reply_text("Sorry, Mama couldn't read that file. Please send a recipe book from /export.")
+            return
+    update.message.reply_text(
+        "Mama has added " + str(imported) + " recipes to your book!"
+        + ("\n" + str(skipped) + " recipes were skipped because you already have a recipe with the same name." if skipped else "")
+    )
 
-    # Get the dispatcher to register handlers
-    dispatcher = updater.dispatcher
+# asyncio versions of the handlers, used when BOT_MODE is "asyncio". Handlers
+# without one here (most of /edit) run unchanged on the engine's thread pool.
+
+async def reply_recipe_photo_async(_: AsyncContext, message, user_id, recipe, thumbnail=False) -> None:
+    file_id, url, set_file_id = get_photo_source(recipe, thumbnail)
+    if file_id is not None:
+        try:
+            await _.call(message.reply_photo, file_id)
+            return
+        except BadRequest:
+            logger.warning("Stored file_id of '%s' was rejected, sending the photo by URL", recipe.name)
+    if url is not None:
+        sent = await _.call(message.reply_photo, url)
+        await adb.run(set_file_id, user_id, recipe.name, url, sent.photo[-1].file_id)
+
+async def start_async(update: Update, _: AsyncContext) -> None:
+    """Send a message when the command /start is issued."""
+    user = update.effective_user
+    await asyncio.gather(
+        adb.run(usernames.add_user, user.id, update.message.chat_id, "None" if user.username is None else user.username),
+        _.call(update.message.reply_markdown_v2, get_start_message(user))
+    )
 
+async def add_recipe_async(update: Update, _: AsyncContext) -> int:
+    """Asks user for the recipe name."""
+    await adb.run(drop_draft, _.user_data)
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
+    await _.call(
+        update.message.reply_text,
+        "Please tell me the name of your new recipe or type /cancel if you change your mind anytime!\n"
+        "All recipes are set to public by default. You can change this by editing the recipe later. "
+        "Private recipes will not be accessed by other users."
+    )
+    return NAME
+
+async def name_async(update: Update, _: AsyncContext) -> int:
+    """Stores given name and asks for a photo of the recipe."""
+    user_id = update.message.from_user.id
+    usernames.update(user_id, update.message.from_user.username)
+    recipe_name = update.message.text
+    if recipe_name == "remove yield":
+        await _.call(update.message.reply_text, "Sorry! Please choose a different name.")
+        return NAME
+    if recipe_name in await adb.get_recipes(user_id):
+        await _.call(update.message.reply_text, "Recipe name already exists! Please choose a different name.")
+        return NAME
+    start_draft(_.user_data, recipe_name)
+    await _.call(
+        update.message.reply_text,
+        "Perfect! Next, please send a picture of your food so Mama knows what it looks like.\n"
+        "Type /skip if you do not have a photo to show Mama."
+    )
+    return PHOTO
+
+async def photo_async(update: Update, _: AsyncContext) -> int:
+    """Starts uploading the given photo and asks for the yield of the recipe."""
+    user_id = update.message.from_user.id
+    recipe_name = _.user_data['recipe name']
+    usernames.update(user_id, update.message.from_user.username)
+    photo = update.message.photo[-1]
+    upload = {}
+    queued = services.get("uploader").submit(
+        lambda: photo.get_file().download_as_bytearray(),
+        photo_uploaded(upload, photo.file_id),
+        photo_upload_failed(_.bot, update.message.chat_id, recipe_name)
+    )
+    if not queued:
+        await _.call(update.message.reply_text, "Mama is busy with a lot of photos right now. Please send it again in a moment, or type /skip.")
+        return PHOTO
+    _.user_data['photo upload'] = upload
+    _.user_data['picture file id'] = photo.file_id
+    await _.call(
+        update.message.reply_text,
+        "Mama is impressed! Next, please state the yield of your recipe i.e. how many people or how much food your recipe serves.\n"
+        "Type /skip if you are not sure."
+    )
+    return SERVINGS
+
+async def skip_photo_async(update: Update, _: AsyncContext) -> int:
+    """Skips the photo and asks for the yield of the recipe."""
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
+    await _.call(
+        update.message.reply_text,
+        "Don't worry. You can always show Mama the next time!\n"
+        "Next, please state the yield of your recipe i.e. how many people or how much food your recipe serves.\n"
+        "Type /skip if you are not sure."
+    )
+    return SERVINGS
+
+async def servings_async(update: Update, _: AsyncContext) -> int:
+    """Stores the yield of the recipe and asks for the ingredients needed."""
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
+    servings = update.message.text
+    _.user_data['servings'] = servings
+    await _.call(
+        update.message.reply_text,
+        "Okay! Your recipe serves " + servings + ".\n"
+        "Please tell Mama what ingredients are needed next.\nType /done when you have entered all the ingredients."
+    )
+    return INGREDIENTS
+
+async def skip_servings_async(update: Update, _: AsyncContext) -> int:
+    """Skips the recipe yield and asks for the ingredients needed."""
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
+    await _.call(
+        update.message.reply_text,
+        "It's okay. Please tell Mama what ingredients are needed next.\n"
+        "Type /done when you have entered all the ingredients."
+    )
+    return INGREDIENTS
+
+async def ingredients_async(update: Update, _: AsyncContext) -> int:
+    """Stores the ingredients and asks for the steps."""
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
+    ingredient = update.message.text
+    if ingredient == "/done":
+        await _.call(
+            update.message.reply_text,
+            "Impressive! Now please write down the steps to the recipe. Type /done when you have entered all the steps you need."
+        )
+        return STEPS
+    elif ingredient in _.user_data['ingredients']:
+        await _.call(update.message.reply_text, "Ingredient has already been added.\nType /done if you have entered all the ingredients needed.")
+        return INGREDIENTS
+    else:
+        _.user_data['ingredients'].append(ingredient)
+        _.user_data['ingredient list'] += "- " + ingredient + "\n"
+        await _.call(update.message.reply_text, _.user_data['ingredient list'])
+        return INGREDIENTS
+
+async def steps_async(update: Update, _: AsyncContext) -> int:
+    """Stores the steps of the recipe and ends the conversation."""
+    user_id = update.message.from_user.id
+    usernames.update(user_id, update.message.from_user.username)
+    step = update.message.text
+    if step == "/done":
+        # saving and the first reply do not depend on each other
+        recipe, _sent = await asyncio.gather(
+            adb.run(save_draft, user_id, _.user_data),
+            _.call(update.message.reply_text, "Terrific! This is your new recipe:")
+        )
+        await adb.run(drop_draft, _.user_data)
+        await reply_recipe_photo_async(_, update.message, user_id, recipe)
+        await _.call(update.message.reply_text, full_recipe(recipe))
+        return ConversationHandler.END
+    else:
+        _.user_data['steps'].append(step)
+        _.user_data['step list'] += str(len(_.user_data['steps'])) + ". " + step + "\n"
+        await _.call(update.message.reply_text, _.user_data['step list'])
+        return STEPS
+
+async def cancel_add_async(update: Update, _: AsyncContext) -> int:
+    """Cancels and ends the conversation."""
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
+    await asyncio.gather(
+        _.call(
+            update.message.reply_text,
+            "It's OK! You can always come back to Mama whenever you are ready!",
+            reply_markup=ReplyKeyboardRemove()
+        ),
+        adb.run(drop_draft, _.user_data)
+    )
+    return ConversationHandler.END
+
+async def view_recipe_async(update: Update, _: AsyncContext) -> int:
+    """Allows user to view an existing recipe."""
+    user_id = update.message.from_user.id
+    _.user_data['user id'] = user_id
+    usernames.update(user_id, update.message.from_user.username)
+    recipes = await adb.get_recipes(user_id)
+    if len(recipes) == 0:
+        await _.call(update.message.reply_text, "You currently do not have any recipes stored. Use /add to leave your recipes with Mama!")
+        return ConversationHandler.END
+    await _.call(update.message.reply_text, "Which recipe would you like to view?", reply_markup=build_keyboard(recipes))
+    return SEND_RECIPE
+
+async def send_recipe_async(update: Update, _: AsyncContext) -> int:
+    """Sends the chosen recipe to the user."""
+    user_id = _.user_data['user id']
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
+    recipe = await adb.load_recipe(user_id, update.message.text)
+    if recipe is None:
+        await _.call(update.message.reply_text, "Sorry, Mama couldn't find the recipe.", reply_markup=ReplyKeyboardRemove())
+    elif user_id == update.message.from_user.id or recipe.public:
+        await reply_recipe_photo_async(_, update.message, user_id, recipe)
+        await _.call(update.message.reply_text, full_recipe(recipe), reply_markup=ReplyKeyboardRemove())
+    else:
+        await _.call(update.message.reply_text, "Sorry, you are unable to view this recipe as it has been set to private.", reply_markup=ReplyKeyboardRemove())
+    return ConversationHandler.END
+
+async def search_user_async(update: Update, _: AsyncContext) -> int:
+    """Lists the public recipes of the mentioned user."""
+    username = update.message.text[9:]
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
+    user_id = await adb.get_user_id(username)
+    if len(user_id) == 0:
+        await _.call(
+            update.message.reply_text,
+            "Sorry, it seems like Mama doesn't know this person!\n"
+            "If their username was changed recently, you may check back again in a day as Mama's database may not have been updated yet."
+        )
+        return ConversationHandler.END
+    _.user_data['user id'] = user_id[0]
+    recipes = await adb.get_public_recipes(user_id[0])
+    if len(recipes) == 0:
+        await _.call(
+            update.message.reply_text,
+            "Hmm, it seems like this user has not left any recipes with Mama or they do not have any public recipes!"
+        )
+        return ConversationHandler.END
+    await _.call(update.message.reply_text, "Which recipe from @" + username + " would you like to view?", reply_markup=build_keyboard(recipes))
+    return SEND_RECIPE
+
+async def edit_recipe_async(update: Update, _: AsyncContext) -> int:
+    """Allows user to edit the details of a stored recipe."""
+    user_id = update.message.from_user.id
+    usernames.update(user_id, update.message.from_user.username)
+    _.user_data['user id'] = user_id
+    recipes = await adb.get_recipes(user_id)
+    if len(recipes) == 0:
+        await _.call(update.message.reply_text, "Hmm, it seems like you do not have any recipes stored currently. Type /add to start adding new recipes!")
+        return ConversationHandler.END
+    keyboard = build_inline_keyboard([[recipe] for recipe in recipes])
+    await _.call(update.message.reply_text, "Which recipe would you like to edit?", reply_markup=keyboard)
+    return RECIPE_CHOICE
+
+async def edit_recipe_inline_async(update: Update, _: AsyncContext) -> int:
+    """Allows user to choose a different recipe to edit when using inline buttons."""
+    query = update.callback_query
+    usernames.update(query.from_user.id, query.from_user.username)
+    _answered, recipes = await asyncio.gather(_.call(query.answer), adb.get_recipes(_.user_data['user id']))
+    keyboard = build_inline_keyboard([[recipe] for recipe in recipes])
+    await _.call(query.edit_message_text, "Which recipe would you like to edit?", reply_markup=keyboard)
+    return RECIPE_CHOICE
+
+async def recipe_choice_async(update: Update, _: AsyncContext) -> int:
+    """Stores the name of the recipe to be edited."""
+    query = update.callback_query
+    _.user_data['recipe name'] = query.data
+    user_id = _.user_data['user id']
+    usernames.update(user_id, query.from_user.username)
+    _answered, recipe = await asyncio.gather(_.call(query.answer), adb.load_recipe(user_id, query.data))
+    await reply_recipe_photo_async(_, query.message, user_id, recipe, thumbnail=True)
+    await asyncio.gather(
+        _.call(
+            query.message.reply_text,
+            full_recipe(recipe) + "\nYou are currently editing '" + query.data + "'.\n"
+            "Which part of the recipe would you like to edit?",
+            reply_markup=build_recipe_part_keyboard(recipe)
+        ),
+        _.call(query.edit_message_reply_markup, None)
+    )
+    return RECIPE_PART
+
+async def edit_timeout_async(update: Update, _: AsyncContext) -> int:
+    """Exits the /edit conversation when no change has been made for 5 minutes."""
+    await _.call(update.message.reply_text, "Editing has been cancelled.")
+    return ConversationHandler.END
+
+async def exit_async(update: Update, _: AsyncContext) -> int:
+    """Exits current conversation handler when a new valid command is sent."""
+    return ConversationHandler.END
+
+async def delete_recipe_async(update: Update, _: AsyncContext) -> int:
+    """Asks user for a recipe to delete."""
+    user_id = update.message.from_user.id
+    usernames.update(user_id, update.message.from_user.username)
+    _.user_data['user id'] = user_id
+    recipes = await adb.get_recipes(user_id)
+    if len(recipes) == 0:
+        await _.call(update.message.reply_text, "Your recipe book is already empty.")
+        return ConversationHandler.END
+    keyboard = build_inline_keyboard([[recipe] for recipe in recipes])
+    await _.call(update.message.reply_text, "Please select a recipe to delete.", reply_markup=keyboard)
+    return CONFIRMATION
+
+async def confirmation_async(update: Update, _: AsyncContext) -> int:
+    """Makes sure user deletes the correct recipe."""
+    query = update.callback_query
+    usernames.update(query.from_user.id, query.from_user.username)
+    _.user_data["recipe name"] = query.data
+    await asyncio.gather(
+        _.call(query.answer),
+        _.call(
+            query.edit_message_text,
+            "Are you sure you want to delete '" + query.data + "'? Mama won't be able to recover any deleted recipes!",
+            reply_markup=build_inline_keyboard([["yes", "no"]])
+        )
+    )
+    return DELETION
+
+async def deletion_async(update: Update, _: AsyncContext) -> None:
+    """Deletes recipe from the database."""
+    query = update.callback_query
+    usernames.update(query.from_user.id, query.from_user.username)
+    if query.data == "yes":
+        recipe_name = _.user_data["recipe name"]
+        await asyncio.gather(_.call(query.answer), _.call(remove_recipe, _.user_data['user id'], recipe_name))
+        await adb.run(drop_draft, _.user_data)
+        await _.call(query.edit_message_text, recipe_name + " has been deleted from your recipes.")
+    else:
+        await adb.run(drop_draft, _.user_data)
+        await asyncio.gather(_.call(query.answer), _.call(query.edit_message_text, "Seems like you've changed your mind!"))
+
+async def search_recipes_async(update: Update, _: AsyncContext) -> None:
+    """Returns the related recipes from the given keywords."""
+    usernames.update(update.message.from_user.id, update.message.from_user.username)
+    terms = update.message.text[8:].strip()
+    if terms == "":
+        await _.call(update.message.reply_text, "Please tell Mama what to look for, e.g. /search chicken rice")
+        return
+    _.user_data['search term'] = terms
+    keyboard = await adb.run(build_search_page, terms, 0)
+    if keyboard is None:
+        await _.call(update.message.reply_text, "Sorry, Mama couldn't find any public recipes for '" + terms + "'.")
+    else:
+        await _.call(update.message.reply_text, "Here are the public recipes Mama found for '" + terms + "':", reply_markup=keyboard)
+
+async def search_page_async(update: Update, _: AsyncContext) -> None:
+    """Shows another page of search results."""
+    query = update.callback_query
+    usernames.update(query.from_user.id, query.from_user.username)
+    terms = _.user_data.get('search term')
+    if terms is None:
+        _answered, keyboard = await _.call(query.answer), None
+    else:
+        _answered, keyboard = await asyncio.gather(_.call(query.answer), adb.run(build_search_page, terms, int(query.data.split()[-1])))
+    if keyboard is None:
+        await _.call(query.edit_message_text, "This search has expired. Please search again with /search <search term>.")
+    else:
+        await _.call(query.edit_message_text, "Here are the public recipes Mama found for '" + terms + "':", reply_markup=keyboard)
+
+async def search_result_async(update: Update, _: AsyncContext) -> None:
+    """Sends the search result chosen by the user."""
+    query = update.callback_query
+    usernames.update(query.from_user.id, query.from_user.username)
+    _answered, owner = await asyncio.gather(_.call(query.answer), adb.get_recipe_owner(int(query.data.split()[-1])))
+    recipe = None if len(owner) == 0 else await adb.load_recipe(*owner[0])
+    if recipe is None:
+        await _.call(query.message.reply_text, "Sorry, Mama couldn't find the recipe.")
+    elif owner[0][0] != query.from_user.id and not recipe.public:
+        await _.call(query.message.reply_text, "Sorry, you are unable to view this recipe as it has been set to private.")
+    else:
+        await reply_recipe_photo_async(_, query.message, owner[0][0], recipe)
+        await _.call(query.message.reply_text, full_recipe(recipe))
+
+ASYNC_CALLBACKS = {
+    start: start_async,
+    add_recipe: add_recipe_async,
+    name: name_async,
+    photo: photo_async,
+    skip_photo: skip_photo_async,
+    servings: servings_async,
+    skip_servings: skip_servings_async,
+    ingredients: ingredients_async,
+    steps: steps_async,
+    cancel_add: cancel_add_async,
+    view_recipe: view_recipe_async,
+    send_recipe: send_recipe_async,
+    search_user: search_user_async,
+    edit_recipe: edit_recipe_async,
+    edit_recipe_inline: edit_recipe_inline_async,
+    recipe_choice: recipe_choice_async,
+    edit_timeout: edit_timeout_async,
+    exit: exit_async,
+    delete_recipe: delete_recipe_async,
+    confirmation: confirmation_async,
+    deletion: deletion_async,
+    search_recipes: search_recipes_async,
+    search_page: search_page_async,
+    search_result: search_result_async,
+}
+
+def flush_usernames(_: CallbackContext) -> None:
+    """Writes username changes seen since the last flush in one batch."""
+    flushed = usernames.flush()
+    logger.info("Flushed %d username changes", flushed)
+
+def log_stats(_: CallbackContext) -> None:
+    """Logs the stats of the caches, outbound requests and background services."""
+    logger.info("Username cache stats: %s", usernames.stats())
+    logger.info("Recipe cache stats: %s", db.cache.stats())
+    # asyncio mode has no per-chat queues
+    if isinstance(getattr(_, 'dispatcher', None), ScheduledDispatcher):
+        logger.info("Chat queue stats: %s", _.dispatcher.scheduler.stats())
+    logger.info("Outbound request stats: %s", _.bot.request.stats())
+    if services.created("uploader"):
+        logger.info("Photo upload stats: %s", services.get("uploader").stats())
+    if services.created("web search"):
+        logger.info("Web search cache stats: %s", services.get("web search").stats())
+    if services.created("browser pool"):
+        logger.info("Browser pool stats: %s", services.get("browser pool").stats())
+    if sql_stats is not None:
+        logger.info("SQL stats: %s", sql_stats.totals())
+
+def update_usernames(_: CallbackContext) -> None:
+    """Looks up the usernames of chats that have not been checked for a while."""
+    # pending changes go first, so the refresh never overwrites a newer username
+    usernames.flush()
+    refresher.run(_.bot.get_chat)
+
+def schedule_jobs(job) -> None:
     job.run_daily(update_usernames, datetime.time(hour=12, tzinfo=pytz.timezone('Asia/Singapore')))
+    job.run_repeating(flush_usernames, interval=USERNAME_FLUSH_INTERVAL)
+    job.run_repeating(log_stats, interval=STATS_LOG_INTERVAL)
 
+def add_handlers(dispatcher) -> None:
     # Create the Conversation Handler
     add_recipe_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("add", add_recipe)],
@@ -937,7 +1615,7 @@ def main() -> None:
     )
 
     view_recipe_conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("view", view_recipe), CommandHandler("search", search_user)],
+        entry_points=[CommandHandler("view", view_recipe), CommandHandler("search", search_user, filters=Filters.entity(constants.MESSAGEENTITY_MENTION))],
         states = {
             SEND_RECIPE: [MessageHandler(Filters.text & (~ Filters.command), send_recipe)]
         },
@@ -978,26 +1656,38 @@ def main() -> None:
             ADD_INGREDIENT: [CallbackQueryHandler(edit_ingredients), MessageHandler(Filters.text, add_ingredient)],
             UPDATE_INGREDIENT: [
                 CallbackQueryHandler(edit_ingredients, pattern="^<< back$"),
-                CallbackQueryHandler(update_ingredient)
+                CallbackQueryHandler(update_ingredient, pattern="^ingredient \\d+$")
             ],
             SAVE_INGREDIENT: [CallbackQueryHandler(ingredients_list_operation), MessageHandler(Filters.text, save_ingredient)],
             DELETE_INGREDIENT: [
                 CallbackQueryHandler(edit_ingredients, pattern="^<< back$"),
-                CallbackQueryHandler(delete_ingredient)
+                CallbackQueryHandler(delete_ingredient, pattern="^ingredient \\d+$")
             ],
             EDIT_STEPS: [
-                CallbackQueryHandler(steps_list_operation, pattern="^add|edit|delete$"),
+                CallbackQueryHandler(steps_list_operation, pattern="^(add|insert|move|edit|delete)$"),
                 CallbackQueryHandler(recipe_choice)
             ],
+            INSERT_STEP: [
+                CallbackQueryHandler(edit_steps, pattern="^<< back$"),
+                CallbackQueryHandler(insert_step, pattern="^step \\d+$")
+            ],
+            MOVE_STEP: [
+                CallbackQueryHandler(edit_steps, pattern="^<< back$"),
+                CallbackQueryHandler(move_step, pattern="^step \\d+$")
+            ],
+            MOVE_STEP_TO: [
+                CallbackQueryHandler(edit_steps, pattern="^<< back$"),
+                CallbackQueryHandler(move_step_to, pattern="^(step \\d+|move to the end)$")
+            ],
             ADD_STEP: [CallbackQueryHandler(edit_steps), MessageHandler(Filters.text, add_step)],
             UPDATE_STEP: [
                 CallbackQueryHandler(edit_steps, pattern="^<< back$"),
-                CallbackQueryHandler(update_step)
+                CallbackQueryHandler(update_step, pattern="^step \\d+$")
             ],
             SAVE_STEP: [CallbackQueryHandler(steps_list_operation), MessageHandler(Filters.text, save_step)],
             DELETE_STEP: [
                 CallbackQueryHandler(edit_steps, pattern="^<< back$"),
-                CallbackQueryHandler(delete_step)
+                CallbackQueryHandler(delete_step, pattern="^step \\d+$")
             ],
             ConversationHandler.TIMEOUT: [MessageHandler(Filters.all, edit_timeout)]
         },
@@ -1021,21 +1711,81 @@ def main() -> None:
 
     # on different commands - answer in Telegram
     dispatcher.add_handler(CommandHandler("start", start))
+    dispatcher.add_handler(CommandHandler("export", export_book))
+    dispatcher.add_handler(CommandHandler("stats", show_stats))
+    dispatcher.add_handler(CommandHandler("import", import_instructions))
+    dispatcher.add_handler(MessageHandler(Filters.document.file_extension("jsonl"), import_book))
     dispatcher.add_handler(add_recipe_conv_handler, 5)
     dispatcher.add_handler(edit_recipe_conv_handler, 4)
     dispatcher.add_handler(delete_recipe_conv_handler, 3)
     dispatcher.add_handler(CommandHandler("search", search_recipes, filters=(~Filters.entity(constants.MESSAGEENTITY_MENTION))), 2)
+    dispatcher.add_handler(CallbackQueryHandler(search_page, pattern="^search page \\d+$"), 2)
+    dispatcher.add_handler(CallbackQueryHandler(search_result, pattern="^search result \\d+$"), 2)
+    dispatcher.add_handler(CommandHandler("websearch", web_search), 2)
     dispatcher.add_handler(view_recipe_conv_handler, 1)
 
-    # Start the Bot
-    updater.start_polling()
+def build_dispatcher(update_queue) -> ScheduledDispatcher:
+    bot = Bot(API_KEY, base_url=TELEGRAM_API_URL, request=RateLimitedRequest(con_pool_size=CHAT_WORKERS + SENDER_WORKERS + 4))
+    job_queue = JobQueue()
+    dispatcher = ScheduledDispatcher(bot, update_queue, job_queue=job_queue, scheduler_workers=CHAT_WORKERS, scheduler_queue_size=CHAT_QUEUE_SIZE)
+    job_queue.set_dispatcher(dispatcher)
+    schedule_jobs(job_queue)
+    add_handlers(dispatcher)
+    return dispatcher
+
+def wait_for_stop_signal() -> None:
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(sig, lambda *_: stop.set())
+    while not stop.wait(1):
+        pass
+
+def main() -> None:
+    if sql_stats is not None and METRICS_PORT and BOT_MODE != "webhook":
+        serve_metrics(sql_stats, int(METRICS_PORT))
+    if WEB_SEARCH_BROWSER and WEB_BROWSERS_WARM > 0:
+        threading.Thread(target=lambda: services.get("browser pool").warm(WEB_BROWSERS_WARM), name="warm-browsers", daemon=True).start()
+    if BOT_MODE == "asyncio":
+        # the engine makes concurrent Telegram calls, so the bot needs a connection for each I/O thread
+        bot = Bot(API_KEY, base_url=TELEGRAM_API_URL, request=RateLimitedRequest(con_pool_size=ASYNC_IO_WORKERS + 4))
+        engine = AsyncEngine(bot, ASYNC_CALLBACKS, io_workers=ASYNC_IO_WORKERS)
+        schedule_jobs(engine)
+        add_handlers(engine)
+        engine.run()
+        refresher.stop()
+    elif BOT_MODE == "webhook":
+        from webhook import run_webhook
+        # the webhook hands updates to the dispatcher through a bounded queue
+        dispatcher = build_dispatcher(queue.Queue(WEBHOOK_QUEUE_SIZE))
+        record = open(os.getenv('WEBHOOK_RECORD'), 'a', encoding='utf-8') if os.getenv('WEBHOOK_RECORD') else None
+        try:
+            run_webhook(
+                dispatcher, WEBHOOK_URL, WEBHOOK_PATH, port=WEBHOOK_PORT, max_connections=WEBHOOK_MAX_CONNECTIONS,
+                record=record, on_stop=refresher.stop, metrics=None if sql_stats is None else sql_stats.metrics
+            )
+        finally:
+            if record is not None:
+                record.close()
+    else:
+        # Create the Updater around a dispatcher that keeps each chat's updates in order
+        updater = Updater(dispatcher=build_dispatcher(queue.Queue()))
+
+        # Start the Bot
+        updater.start_polling()
 
-    # Run the bot until you press Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+        # Run the bot until you press Ctrl-C or the process receives SIGINT,
+        # SIGTERM or SIGABRT. Unlike updater.idle(), running jobs are told to
+        # stop first, since the job queue waits for them.
+        wait_for_stop_signal()
+        refresher.stop()
+        updater.stop()
+    sender.shutdown()
+    services.close()
+    adb.shutdown()
+    usernames.flush()
 
 
 if __name__ == '__main__':
     db.setup()
+    usernames.load()
     main()
\ No newline at end of file
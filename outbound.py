@@ -0,0 +1,103 @@
+import logging, threading, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from telegram.error import RetryAfter
+from telegram.utils.request import Request
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Bot API methods that count towards Telegram's message limits
+LIMITED_METHODS = ("send", "edit", "forward", "copy")
+
+# A telegram.utils.request.Request that keeps the bot under Telegram's limits
+# instead of running into 429s: about 30 messages a second overall, one a
+# second in a private chat and 20 a minute in a group. A call waits for a
+# token of its chat first and then for a global one. When Telegram answers
+# with RetryAfter anyway, that chat (or everyone, for calls without a chat)
+# waits as long as asked and the call is retried.
+#
+# Buckets are kept for the max_chats most recently used chats; a chat that
+# falls out simply starts again with a full bucket.
+class RateLimitedRequest(Request):
+    def __init__(self, *args, global_rate=30, chat_rate=1, chat_burst=3, group_rate=20 / 60, group_burst=5,
+                 max_chats=10000, retries=3, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_chats = max_chats
+        self.retries = retries
+        self.chat_buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.waited = 0.0
+        self.retried = 0
+
+    def chat_bucket(self, chat_id):
+        with self.lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                # group and channel ids are negative, or @usernames
+                private = isinstance(chat_id, int) and chat_id > 0
+                bucket = TokenBucket(self.chat_rate, self.chat_burst) if private else TokenBucket(self.group_rate, self.group_burst)
+                self.chat_buckets[chat_id] = bucket
+                if len(self.chat_buckets) > self.max_chats:
+                    self.chat_buckets.popitem(last=False)
+            else:
+                self.chat_buckets.move_to_end(chat_id)
+            return bucket
+
+    def throttle(self, buckets):
+        started = time.monotonic()
+        for bucket in buckets:
+            bucket.acquire()
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            with self.lock:
+                self.waited += waited
+
+    def post(self, url, data, timeout=None):
+        buckets = []
+        if url.rsplit("/", 1)[-1].startswith(LIMITED_METHODS):
+            chat_id = (data or {}).get("chat_id")
+            buckets = [self.bucket] if chat_id is None else [self.chat_bucket(chat_id), self.bucket]
+            self.throttle(buckets)
+        attempt = 0
+        while True:
+            try:
+                return super().post(url, data, timeout)
+            except RetryAfter as exc:
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                with self.lock:
+                    self.retried += 1
+                logger.warning("Flood control on %s, retrying in %ss", url.rsplit("/", 1)[-1], exc.retry_after)
+                (buckets[0] if buckets else self.bucket).pause(exc.retry_after)
+                self.throttle(buckets or [self.bucket])
+
+    def stats(self):
+        with self.lock:
+            return {"waited_s": round(self.waited, 3), "retried": self.retried, "chats": len(self.chat_buckets)}
+
+# Runs Telegram calls whose result a handler does not need, such as
+# answering a callback query or taking the keyboard off an old message, on a
+# few background threads, so the handler's next call does not wait a round
+# trip for them. Failures are logged.
+class Sender:
+    def __init__(self, max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sender")
+
+    def submit(self, fn, *args, **kwargs):
+        future = self.executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(self.log_failure)
+        return future
+
+    def log_failure(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Background Telegram call failed", exc_info=future.exception())
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
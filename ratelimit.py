@@ -0,0 +1,47 @@
+import threading, time
+
+# Allows `rate` operations a second on average, with bursts of up to
+# `capacity`, across any number of threads. pause() stops everyone for a
+# while, e.g. when Telegram answers with RetryAfter.
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    # Time to wait before `tokens` are available, taking them if that is now.
+    def reserve(self, tokens=1):
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def try_acquire(self, tokens=1):
+        return self.reserve(tokens) == 0
+
+    # Blocks until `tokens` are taken, or until stop is set. Returns whether
+    # they were taken.
+    def acquire(self, tokens=1, stop=None):
+        while True:
+            wait = self.reserve(tokens)
+            if wait == 0:
+                return True
+            if stop is None:
+                time.sleep(wait)
+            elif stop.wait(wait):
+                return False
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.updated = self.paused_until
+            self.tokens = 0
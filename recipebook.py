@@ -0,0 +1,51 @@
+import argparse, json, sys
+from dbhelper import DBHelper
+
+def export_jsonl(db, out, user_id=None):
+    """Writes recipes to a text stream as JSON Lines, one recipe per line."""
+    count = 0
+    for recipe in db.iter_recipes(user_id):
+        out.write(json.dumps(recipe, ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+def read_jsonl(lines):
+    """Yields one recipe per non-empty line of a JSON Lines stream."""
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def import_jsonl(db, lines, user_id=None, batch_size=500):
+    """Imports recipes from JSON Lines, returning (imported, skipped)."""
+    return db.import_recipes(read_jsonl(lines), user_id, batch_size)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Export or import BotMaMa recipe books as JSON Lines.")
+    parser.add_argument("--db", default="recipes.sqlite", help="path to the recipe database")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write recipes to a file or stdout")
+    export_parser.add_argument("file", nargs="?", default="-")
+    export_parser.add_argument("--user", type=int, help="only export this user's recipes")
+    import_parser = commands.add_parser("import", help="read recipes from a file or stdin")
+    import_parser.add_argument("file", nargs="?", default="-")
+    import_parser.add_argument("--user", type=int, help="import every recipe into this user's book")
+    import_parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    db = DBHelper(args.db)
+    db.setup()
+    if args.command == "export":
+        out = sys.stdout if args.file == "-" else open(args.file, "w", encoding="utf-8")
+        with out:
+            count = export_jsonl(db, out, args.user)
+        print("Exported {} recipes.".format(count), file=sys.stderr)
+    else:
+        lines = sys.stdin if args.file == "-" else open(args.file, encoding="utf-8")
+        with lines:
+            imported, skipped = import_jsonl(db, lines, args.user, args.batch_size)
+        print("Imported {} recipes, skipped {} duplicates.".format(imported, skipped), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import logging, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from telegram.error import BadRequest, RetryAfter, TimedOut, NetworkError, Unauthorized
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Looks up the current username of every known chat with getChat. Chats are
+# read from the database in batches of batch_size, in chat id order, and
+# each batch is looked up by max_workers threads sharing a rate limit of
+# `rate` calls a second. The results are written in one transaction per
+# batch together with the time of the check. Chats checked within max_age
+# are skipped, so a run that was interrupted continues where it stopped,
+# and a large user base is spread over several runs.
+#
+# Only private chats carry a user's username (their id is the user id);
+# other chats are recorded as checked and left alone. Chats that blocked
+# the bot or no longer exist are also recorded, so they are not retried
+# until max_age has passed.
+class UsernameRefresher:
+    def __init__(self, db, usernames=None, max_workers=8, rate=20, batch_size=500, max_age=7 * 24 * 3600, retries=3):
+        self.db = db
+        self.usernames = usernames
+        self.max_workers = max_workers
+        self.bucket = TokenBucket(rate)
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.retries = retries
+        self.running = threading.Lock()
+        self.stopping = threading.Event()
+
+    # Returns the number of chats checked and of usernames changed, or None
+    # if another run is still going.
+    def run(self, get_chat):
+        if not self.running.acquire(blocking=False):
+            logger.info("Username refresh is still running, skipping this one")
+            return None
+        try:
+            return self.refresh(get_chat)
+        finally:
+            self.running.release()
+
+    def refresh(self, get_chat):
+        checked = changed = 0
+        after = None
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="username-refresh") as executor:
+            while not self.stopping.is_set():
+                chat_ids = self.db.get_unchecked_chat_ids(started - self.max_age, after, self.batch_size)
+                if len(chat_ids) == 0:
+                    break
+                after = chat_ids[-1]
+                results = list(executor.map(lambda chat_id: self.check(get_chat, chat_id), chat_ids))
+                done = [chat_id for chat_id, result in zip(chat_ids, results) if result is not False]
+                found = [(chat_id, result) for chat_id, result in zip(chat_ids, results) if result]
+                changed += self.db.record_username_checks(done, found, time.time())
+                if self.usernames is not None:
+                    self.usernames.remember(found)
+                checked += len(done)
+        logger.info("Checked %d chats, %d usernames changed", checked, changed)
+        return checked, changed
+
+    # The chat's username, None when there is none to record, or False when
+    # it could not be checked and should be tried again next run.
+    def check(self, get_chat, chat_id):
+        attempt = 0
+        while self.bucket.acquire(stop=self.stopping):
+            try:
+                chat = get_chat(chat_id)
+            except RetryAfter as exc:
+                # Telegram asks everyone to slow down, not just this thread
+                self.bucket.pause(exc.retry_after)
+                continue
+            except (Unauthorized, BadRequest):
+                return None
+            except (TimedOut, NetworkError):
+                if attempt >= self.retries:
+                    logger.warning("Could not look up chat %s", chat_id, exc_info=True)
+                    return False
+                attempt += 1
+                continue
+            if chat.type != "private" or chat.username is None:
+                return None
+            return chat.username
+        return False
+
+    def stop(self):
+        self.stopping.set()
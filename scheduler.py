@@ -0,0 +1,129 @@
+import logging, threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from telegram import Update
+from telegram.ext import Dispatcher
+
+logger = logging.getLogger(__name__)
+
+def update_key(update):
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return None
+
+# Runs handle(item) on a pool of worker threads, one item at a time per key
+# and in the order submitted, while items with different keys run in
+# parallel. A key with work waiting holds at most one worker, and goes to
+# the back of the pool's queue after each item so a busy chat cannot starve
+# the others. At most max_queued items are queued or running at a time;
+# submit() blocks beyond that, so a bounded queue in front of the submitter
+# fills up instead of this one growing without limit.
+#
+# stats() reports the chats with work queued and the time items waited
+# between submit() and their handler starting, over the last max_samples
+# items. Chats are not identified, since the stats may be served publicly.
+class ChatScheduler:
+    def __init__(self, handle, workers=4, max_samples=1000, max_queued=1000):
+        self.handle = handle
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat")
+        self.slots = threading.BoundedSemaphore(max_queued)
+        self.lock = threading.Lock()
+        # key -> deque of (submitted at, item) waiting behind the running one
+        self.queues = {}
+        self.waits = deque(maxlen=max_samples)
+        self.processed = 0
+        self.max_depth = 0
+
+    def submit(self, key, item):
+        self.slots.acquire()
+        now = time.monotonic()
+        with self.lock:
+            pending = self.queues.get(key)
+            if pending is not None:
+                pending.append((now, item))
+                self.max_depth = max(self.max_depth, len(pending) + 1)
+                return
+            self.queues[key] = deque()
+        if not self.schedule(key, now, item):
+            self.run(key, now, item)
+
+    def schedule(self, key, submitted, item):
+        try:
+            self.executor.submit(self.run, key, submitted, item)
+            return True
+        except RuntimeError:
+            return False
+
+    def run(self, key, submitted, item):
+        while True:
+            started = time.monotonic()
+            try:
+                self.handle(item)
+            except Exception:
+                logger.exception("Error while handling an update for chat %s", key)
+            finally:
+                self.slots.release()
+            with self.lock:
+                self.waits.append(started - submitted)
+                self.processed += 1
+                pending = self.queues[key]
+                if not pending:
+                    del self.queues[key]
+                    return
+                submitted, item = pending.popleft()
+            if self.schedule(key, submitted, item):
+                return
+            # shutting down: finish the chat's remaining updates on this thread
+
+    def depth(self, key):
+        with self.lock:
+            pending = self.queues.get(key)
+            return 0 if pending is None else len(pending) + 1
+
+    def stats(self, top=5):
+        now = time.monotonic()
+        with self.lock:
+            waits = sorted(self.waits)
+            chats = [
+                {"depth": len(pending) + 1, "oldest_wait_ms": round((now - pending[0][0]) * 1000, 1) if pending else 0}
+                for pending in self.queues.values()
+            ]
+            processed, max_depth = self.processed, self.max_depth
+        chats.sort(key=lambda chat: chat["depth"], reverse=True)
+        return {
+            "active_chats": len(chats),
+            "queued": sum(chat["depth"] for chat in chats),
+            "max_depth": max_depth,
+            "processed": processed,
+            "wait_p50_ms": round(waits[len(waits) // 2] * 1000, 2) if waits else None,
+            "wait_p99_ms": round(waits[min(len(waits) - 1, len(waits) * 99 // 100)] * 1000, 2) if waits else None,
+            "wait_max_ms": round(waits[-1] * 1000, 2) if waits else None,
+            "deepest_chats": chats[:top],
+        }
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+# A Dispatcher that hands each update to a ChatScheduler instead of
+# processing it on its own thread. Handlers for one chat never overlap, so
+# they cannot race on user_data or the ConversationHandler state, while
+# different chats use up to scheduler_workers threads. The bot's connection
+# pool should be at least that large. Once scheduler_queue_size updates are
+# waiting the dispatcher stops taking more off update_queue, so a bounded
+# update_queue (as the webhook uses) pushes back on Telegram.
+class ScheduledDispatcher(Dispatcher):
+    def __init__(self, *args, scheduler_workers=4, scheduler_queue_size=1000, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = ChatScheduler(partial(Dispatcher.process_update, self), scheduler_workers, max_queued=scheduler_queue_size)
+
+    def process_update(self, update):
+        self.scheduler.submit(update_key(update), update)
+
+    def stop(self):
+        super().stop()
+        self.scheduler.shutdown()
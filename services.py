@@ -0,0 +1,49 @@
+import logging, threading, time
+
+logger = logging.getLogger(__name__)
+
+# Creates shared clients (blob store, Firebase, browsers, ...) the first time
+# they are asked for, so importing the bot never imports a heavy library or
+# opens a network connection it does not end up using. A factory does its
+# own imports and runs once, under a per-service lock; close(instance) runs
+# on shutdown only for services that were created.
+class Services:
+    def __init__(self):
+        self.factories = {}
+        self.instances = {}
+        self.locks = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, factory, close=None):
+        with self.lock:
+            self.factories[name] = (factory, close)
+            self.locks[name] = threading.Lock()
+
+    def get(self, name):
+        instance = self.instances.get(name)
+        if instance is not None:
+            return instance
+        with self.locks[name]:
+            if name not in self.instances:
+                started = time.perf_counter()
+                self.instances[name] = self.factories[name][0]()
+                self.timings[name] = time.perf_counter() - started
+                logger.info("Started %s in %.3fs", name, self.timings[name])
+            return self.instances[name]
+
+    def created(self, name):
+        return name in self.instances
+
+    def stats(self):
+        return {name: round(seconds, 3) for name, seconds in self.timings.items()}
+
+    def close(self):
+        for name in reversed(list(self.instances)):
+            close = self.factories[name][1]
+            if close is not None:
+                try:
+                    close(self.instances[name])
+                except Exception:
+                    logger.exception("Closing %s failed", name)
+        self.instances.clear()
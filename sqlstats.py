@@ -0,0 +1,250 @@
+import bisect, logging, sqlite3, sys, threading, time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds of the latency histogram buckets, the last one being +Inf
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+# Statement timings of a DBHelper, grouped by the DBHelper method that ran
+# them: how often each ran, how long it took in total and as a histogram,
+# how many rows it returned or changed, and how often it failed.
+# Statements that take slow_ms or longer are logged and kept in a log of
+# the last slow_log_size, with their bound parameters replaced by their type.
+class QueryStats:
+    def __init__(self, slow_ms=100, slow_log_size=100):
+        self.slow = slow_ms / 1000
+        self.slow_log = deque(maxlen=slow_log_size)
+        self.methods = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, method, sql, seconds, rows, parameters=None, many=False, failed=False):
+        with self.lock:
+            entry = self.methods.get(method)
+            if entry is None:
+                entry = self.methods[method] = {"calls": 0, "seconds": 0.0, "rows": 0, "errors": 0, "slow": 0, "buckets": [0] * (len(BUCKETS) + 1)}
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+            entry["rows"] += rows
+            entry["errors"] += failed
+            entry["buckets"][bisect.bisect_left(BUCKETS, seconds)] += 1
+            if seconds < self.slow:
+                return
+            entry["slow"] += 1
+            query = {
+                "at": time.time(), "method": method, "sql": " ".join(sql.split()), "ms": round(seconds * 1000, 1),
+                "rows": rows, "parameters": redact(parameters, many)
+            }
+            self.slow_log.append(query)
+        logger.warning("Slow query in %s took %.1fms: %s %s", method, query["ms"], query["sql"], query["parameters"])
+
+    def snapshot(self):
+        with self.lock:
+            return {method: dict(entry, buckets=list(entry["buckets"])) for method, entry in self.methods.items()}
+
+    def slow_queries(self, limit=None):
+        with self.lock:
+            queries = list(self.slow_log)
+        return queries if limit is None else queries[-limit:]
+
+    def totals(self):
+        methods = self.snapshot()
+        return {
+            "statements": sum(entry["calls"] for entry in methods.values()),
+            "seconds": round(sum(entry["seconds"] for entry in methods.values()), 3),
+            "errors": sum(entry["errors"] for entry in methods.values()),
+            "slow": sum(entry["slow"] for entry in methods.values()),
+        }
+
+    # A few lines for the /stats command: the methods taking the most time
+    # in total, and the latest slow queries.
+    def summary(self, top=10, slow=5):
+        methods = sorted(self.snapshot().items(), key=lambda item: item[1]["seconds"], reverse=True)
+        totals = self.totals()
+        lines = ["{statements} statements in {seconds}s since {since}, {slow} slow, {errors} failed".format(
+            since=time.strftime("%Y-%m-%d %H:%M", time.localtime(self.started)), **totals
+        ), ""]
+        for method, entry in methods[:top]:
+            lines.append("{}: {} calls, {:.1f}ms total, p50 {} p99 {}, {} rows".format(
+                method, entry["calls"], entry["seconds"] * 1000,
+                format_bound(percentile(entry["buckets"], 0.5)), format_bound(percentile(entry["buckets"], 0.99)), entry["rows"]
+            ))
+        queries = self.slow_queries(slow)
+        if len(queries) != 0:
+            lines += ["", "Latest slow queries:"]
+            for query in reversed(queries):
+                sql = query["sql"] if len(query["sql"]) <= 80 else query["sql"][:77] + "..."
+                lines.append("{} {}ms: {} {}".format(query["method"], query["ms"], sql, query["parameters"]))
+        return "\n".join(lines)
+
+    # The statistics in Prometheus' text exposition format.
+    def metrics(self):
+        methods = sorted(self.snapshot().items())
+        lines = ["# HELP botmama_sql_seconds Time spent running SQL statements, by DBHelper method.", "# TYPE botmama_sql_seconds histogram"]
+        for method, entry in methods:
+            label = 'method="{}"'.format(method)
+            count = 0
+            for bound, hits in zip(BUCKETS + ("+Inf", ), entry["buckets"]):
+                count += hits
+                lines.append('botmama_sql_seconds_bucket{{{},le="{}"}} {}'.format(label, bound, count))
+            lines.append("botmama_sql_seconds_sum{{{}}} {}".format(label, entry["seconds"]))
+            lines.append("botmama_sql_seconds_count{{{}}} {}".format(label, entry["calls"]))
+        for name, key, description in (("rows", "rows", "Rows returned or changed"), ("errors", "errors", "Statements that failed"), ("slow", "slow", "Slow statements")):
+            lines += ["# HELP botmama_sql_{}_total {}, by DBHelper method.".format(name, description), "# TYPE botmama_sql_{}_total counter".format(name)]
+            lines += ['botmama_sql_{}_total{{method="{}"}} {}'.format(name, method, entry[key]) for method, entry in methods]
+        return "\n".join(lines) + "\n"
+
+# Upper bound of the bucket the given quantile falls in.
+def percentile(buckets, quantile):
+    total = sum(buckets)
+    if total == 0:
+        return None
+    count = 0
+    for bound, hits in zip(BUCKETS + (float("inf"), ), buckets):
+        count += hits
+        if count >= quantile * total:
+            return bound
+
+def format_bound(bound):
+    if bound is None:
+        return "-"
+    return ">{}ms".format(BUCKETS[-1] * 1000) if bound == float("inf") else "<{}ms".format(bound * 1000)
+
+# Only the type (and length of strings) of bound parameters is kept, since
+# they hold users' recipes and usernames.
+def redact(parameters, many=False):
+    if many:
+        return "<{} rows>".format(len(parameters)) if isinstance(parameters, (list, tuple)) else "<rows>"
+    if parameters is None:
+        return []
+    if isinstance(parameters, dict):
+        return {key: redact_value(value) for key, value in parameters.items()}
+    return [redact_value(value) for value in parameters]
+
+def redact_value(value):
+    if isinstance(value, str):
+        return "<str:{}>".format(len(value))
+    return "<{}>".format(type(value).__name__)
+
+# A SQLite connection that reports every statement to its stats. Statements
+# are put down to the function that called execute(), i.e. the DBHelper
+# method. A query's rows are still fetched lazily, through a TimedCursor, so
+# reading a large result does not hold it in memory.
+class InstrumentedConnection(sqlite3.Connection):
+    stats = None
+
+    def execute(self, sql, parameters=()):
+        method = sys._getframe(1).f_code.co_name
+        started = time.perf_counter()
+        try:
+            cursor = super().execute(sql, parameters)
+        except sqlite3.Error:
+            self.stats.record(method, sql, time.perf_counter() - started, 0, parameters, failed=True)
+            raise
+        seconds = time.perf_counter() - started
+        if cursor.description is None:
+            self.stats.record(method, sql, seconds, max(cursor.rowcount, 0), parameters)
+            return cursor
+        return TimedCursor(cursor, self.stats, method, sql, parameters, seconds)
+
+    def executemany(self, sql, parameters):
+        # executemany consumes iterators, and the slow-query log wants a length
+        parameters = list(parameters)
+        started = time.perf_counter()
+        try:
+            cursor = super().executemany(sql, parameters)
+        except sqlite3.Error:
+            self.stats.record(sys._getframe(1).f_code.co_name, sql, time.perf_counter() - started, 0, parameters, many=True, failed=True)
+            raise
+        self.stats.record(sys._getframe(1).f_code.co_name, sql, time.perf_counter() - started, max(cursor.rowcount, 0), parameters, many=True)
+        return cursor
+
+    def commit(self):
+        started = time.perf_counter()
+        super().commit()
+        self.stats.record("commit", "COMMIT", time.perf_counter() - started, 0)
+
+# Reads like the cursor of a query, adding up the time spent fetching rows
+# and counting them. The query is recorded once, when its rows run out or
+# when the cursor is dropped with rows left unread.
+class TimedCursor:
+    def __init__(self, cursor, stats, method, sql, parameters, seconds):
+        self.cursor = cursor
+        self.stats = stats
+        self.method = method
+        self.sql = sql
+        self.parameters = parameters
+        self.seconds = seconds
+        self.rows = 0
+        self.recorded = False
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = next(self.cursor)
+        except StopIteration:
+            self.seconds += time.perf_counter() - started
+            self.finish()
+            raise
+        except sqlite3.Error:
+            self.seconds += time.perf_counter() - started
+            self.finish(failed=True)
+            raise
+        self.seconds += time.perf_counter() - started
+        self.rows += 1
+        return row
+
+    def fetchone(self):
+        return next(self, None)
+
+    def fetchall(self):
+        return list(self)
+
+    def finish(self, failed=False):
+        if not self.recorded:
+            self.recorded = True
+            self.stats.record(self.method, self.sql, self.seconds, self.rows, self.parameters, failed=failed)
+
+    def __del__(self):
+        self.finish()
+
+# Serves stats.metrics() on http://host:port/metrics from a daemon thread,
+# for when the bot does not run the webhook app, which has its own /metrics.
+def serve_metrics(stats, port, host="0.0.0.0"):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = stats.metrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving SQL metrics on %s:%d/metrics", host, port)
+    return server
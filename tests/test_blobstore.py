@@ -0,0 +1,27 @@
+import os
+from blobstore import LocalStore
+
+def test_local_store_round_trip(tmp_path):
+    store = LocalStore(tmp_path)
+    url = store.put(b"cake")
+    assert url.startswith("file://") and url.endswith(".jpg")
+    path = os.path.join(str(tmp_path), url.rsplit("/", 1)[-1])
+    with open(path, "rb") as f:
+        assert f.read() == b"cake"
+    store.delete(url)
+    assert os.listdir(tmp_path) == []
+    # deleting again, or a url of another store, does nothing
+    store.delete(url)
+    store.delete("https://storage.googleapis.com/bucket/" + url.rsplit("/", 1)[-1])
+
+def test_local_store_keeps_one_copy_per_content(tmp_path):
+    store = LocalStore(tmp_path, "http://photos.example/")
+    url = store.put(b"cake")
+    # a second recipe with the same photo gets the same url, which is why
+    # discard_photo checks that no recipe still uses a url before deleting it
+    assert store.put(b"cake") == url
+    assert store.put(b"cake", "image/png") != url
+    assert store.put(b"rice") != url
+    assert len(os.listdir(tmp_path)) == 3
+    store.delete(url)
+    assert len(os.listdir(tmp_path)) == 2
@@ -0,0 +1,55 @@
+import threading, time
+import pytest
+from dbhelper import DBHelper
+
+THREADS = 16
+OPS = 100 # add_ingredient + get_ingredients pairs per thread
+MIN_OPS_PER_SECOND = 500 # several times below a laptop, so only a real slowdown fails
+
+@pytest.fixture
+def db(tmp_path):
+    # a file, not :memory:, so reads go through the pooled reader connections
+    db = DBHelper(str(tmp_path / "recipes.sqlite"), pool_size=4)
+    db.setup()
+    yield db
+    db.pool.close()
+
+def test_concurrent_ingredients(db):
+    # two threads share each recipe, so writes to one recipe interleave
+    for recipe in range(THREADS // 2):
+        db.add_full_recipe(1, "recipe {}".format(recipe), None, None, [], [])
+    start = threading.Barrier(THREADS)
+    errors = []
+
+    def hammer(thread):
+        recipe_name = "recipe {}".format(thread // 2)
+        added = []
+        try:
+            start.wait()
+            for i in range(OPS):
+                ingredient = "ingredient {} of thread {}".format(i, thread)
+                db.add_ingredient(1, recipe_name, ingredient)
+                added.append(ingredient)
+                ingredients = db.get_ingredients(1, recipe_name)
+                # this thread's ingredients are all there, in the order added
+                mine = [x for x in ingredients if x.endswith("of thread {}".format(thread))]
+                assert mine == added
+        except BaseException as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=hammer, args=(thread, )) for thread in range(THREADS)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    assert errors == []
+    for recipe in range(THREADS // 2):
+        ingredients = db.get_ingredients(1, "recipe {}".format(recipe))
+        assert len(ingredients) == 2 * OPS
+        assert len(set(ingredients)) == 2 * OPS
+    assert db.pool.readers.qsize() > 0
+    ops_per_second = THREADS * OPS * 2 / elapsed
+    assert ops_per_second >= MIN_OPS_PER_SECOND, "{:.0f} ops/s".format(ops_per_second)
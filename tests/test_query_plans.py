@@ -0,0 +1,66 @@
+import pytest
+from dbhelper import DBHelper
+
+# Every statement the hot DBHelper methods run must look its rows up through
+# an index (or the rowid), so their cost follows the size of one recipe
+# rather than of the whole database.
+HOT_CALLS = {
+    "get_recipe_id": lambda db, r: db.get_recipe_id(1, "egg rice"),
+    "read_recipe": lambda db, r: db.read_recipe(1, "egg rice"),
+    "get_ingredients": lambda db, r: db.get_ingredients(1, "egg rice"),
+    "get_steps": lambda db, r: db.get_steps(1, "egg rice"),
+    "get_recipes": lambda db, r: db.get_recipes(1),
+    "get_public_recipes": lambda db, r: db.get_public_recipes(1),
+    "is_public": lambda db, r: db.is_public(1, "egg rice"),
+    "get_recipe_owner": lambda db, r: db.get_recipe_owner(r.recipe_id),
+    "get_user_id": lambda db, r: db.get_user_id("alice"),
+    "update_username": lambda db, r: db.update_username(1, "alicia"),
+    "get_picture_url": lambda db, r: db.get_picture_url(1, "egg rice"),
+    "get_photo_urls": lambda db, r: db.get_photo_urls(1, "egg rice"),
+    "is_picture_used": lambda db, r: db.is_picture_used("https://example.com/egg.jpg"),
+    "change_privacy": lambda db, r: db.change_privacy(1, "egg rice", 0),
+    "add_ingredient": lambda db, r: db.add_ingredient(1, "egg rice", "salt"),
+    "update_ingredient": lambda db, r: db.update_ingredient(1, "egg rice", r.ingredient_ids[0], "3 eggs"),
+    "delete_ingredient": lambda db, r: db.delete_ingredient(1, "egg rice", r.ingredient_ids[1]),
+    "add_step": lambda db, r: db.add_step(1, "egg rice", "serve", r.step_ids[0]),
+    "move_step": lambda db, r: db.move_step(1, "egg rice", r.step_ids[2], r.step_ids[0]),
+    "update_step": lambda db, r: db.update_step(1, "egg rice", r.step_ids[0], "fry the eggs"),
+    "delete_step": lambda db, r: db.delete_step(1, "egg rice", r.step_ids[1]),
+    "delete_recipe": lambda db, r: db.delete_recipe(1, "egg rice"),
+}
+
+@pytest.fixture
+def db():
+    # an in-memory database runs every statement on the writer connection
+    db = DBHelper(":memory:")
+    db.setup()
+    db.add_user(1, 1, "alice")
+    db.add_full_recipe(1, "egg rice", "https://example.com/egg.jpg", "2", ["2 eggs", "rice", "soy sauce"], ["boil rice", "fry eggs", "mix"])
+    yield db
+    db.pool.close()
+
+def query_plans(db, call):
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    try:
+        call()
+    finally:
+        db.conn.set_trace_callback(None)
+    plans = {}
+    for stmt in statements:
+        # "-- TRIGGER name" lines mark trigger bodies running
+        if stmt.startswith("--") or stmt.split(None, 1)[0].upper() in ("BEGIN", "COMMIT", "ROLLBACK", "PRAGMA"):
+            continue
+        plans[stmt] = [row[3] for row in db.conn.execute("EXPLAIN QUERY PLAN " + stmt)]
+    return plans
+
+@pytest.mark.parametrize("method", sorted(HOT_CALLS))
+def test_hot_queries_use_indexes(db, method):
+    recipe = db.read_recipe(1, "egg rice")
+    plans = query_plans(db, lambda: HOT_CALLS[method](db, recipe))
+    assert plans, "{} ran no statements".format(method)
+    for stmt, plan in plans.items():
+        for detail in plan:
+            assert not detail.startswith("SCAN"), "{} scans: {}\n{}".format(method, stmt, plan)
+            if detail.startswith("SEARCH"):
+                assert " USING " in detail, "{} searches without an index: {}\n{}".format(method, stmt, plan)
@@ -0,0 +1,42 @@
+import io, os, threading
+import pytest
+from blobstore import LocalStore, content_key
+from uploads import PhotoUploader
+
+# kills its worker process for the photo b"crash", like the OOM killer would
+def crash_on_request(data):
+    if data == b"crash":
+        os._exit(1)
+    return data + b" photo", data + b" thumbnail"
+
+def upload(uploader, data):
+    done = threading.Event()
+    result = []
+    uploader.submit(lambda: data, lambda *urls: (result.append(urls), done.set()), lambda exc: (result.append(exc), done.set()))
+    assert done.wait(30)
+    return result[0]
+
+def test_broken_process_pool_is_replaced(tmp_path):
+    store = LocalStore(tmp_path, "http://photos.example/")
+    uploader = PhotoUploader(store, process=crash_on_request, processes=1, retries=0)
+    try:
+        assert isinstance(upload(uploader, b"crash"), Exception)
+        urls = [upload(uploader, b"cake"), upload(uploader, b"rice")]
+    finally:
+        uploader.shutdown()
+    blobs = [b"cake photo", b"cake thumbnail", b"rice photo", b"rice thumbnail"]
+    assert [url for pair in urls for url in pair] == ["http://photos.example/" + content_key(blob) for blob in blobs]
+    assert sorted(os.listdir(tmp_path)) == sorted(content_key(blob) for blob in blobs)
+    assert uploader.stats()["failed"] == 1
+
+def test_process_photo_makes_upright_jpegs():
+    Image = pytest.importorskip("PIL.Image")
+    from images import process_photo
+    exif = Image.Exif()
+    exif[0x0112] = 6 # taken sideways, shown rotated by 90 degrees
+    data = io.BytesIO()
+    Image.new("RGB", (4000, 3000), "orange").save(data, "JPEG", exif=exif)
+    photo, thumbnail = process_photo(data.getvalue())
+    photo, thumbnail = Image.open(io.BytesIO(photo)), Image.open(io.BytesIO(thumbnail))
+    assert (photo.format, photo.mode, photo.size) == ("JPEG", "RGB", (960, 1280))
+    assert (thumbnail.format, thumbnail.size) == ("JPEG", (240, 320))
@@ -0,0 +1,47 @@
+import io, json, queue
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("flask_sslify")
+pytest.importorskip("telegram")
+from webhook import create_fake_api, create_webhook_app
+
+def message_update(update_id, text="/start"):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 1700000000, "text": text,
+            "chat": {"id": 42, "type": "private"}, "from": {"id": 42, "is_bot": False, "first_name": "Mama"},
+        },
+    }
+
+def test_posted_update_is_queued_and_recorded():
+    updates = queue.Queue(10)
+    record = io.StringIO()
+    client = create_webhook_app(None, updates, "secret", record=record).test_client()
+    assert client.post("/secret", json=message_update(1, "/add")).status_code == 200
+    update = updates.get_nowait()
+    assert (update.update_id, update.message.text) == (1, "/add")
+    assert json.loads(record.getvalue()) == message_update(1, "/add")
+    assert client.post("/secret", data="not json").status_code == 400
+    assert client.post("/elsewhere", json=message_update(2)).status_code == 404
+    assert updates.empty()
+
+def test_full_queue_refuses_updates_instead_of_blocking():
+    updates = queue.Queue(1)
+    client = create_webhook_app(None, updates, "secret", extra_stats=lambda: {"active_chats": 0}).test_client()
+    assert client.post("/secret", json=message_update(1)).status_code == 200
+    refused = client.post("/secret", json=message_update(2))
+    assert refused.status_code == 503
+    assert refused.headers["Retry-After"] == "1"
+    assert updates.get_nowait().update_id == 1
+    health = client.get("/healthz").get_json()
+    assert health == {"accepted": 1, "refused": 1, "invalid": 0, "queue_depth": 0, "queue_size": 1, "active_chats": 0}
+
+def test_fake_api_answers_and_counts_calls():
+    client = create_fake_api().test_client()
+    sent = client.post("/botTOKEN/sendMessage", json={"chat_id": 42, "text": "hello"}).get_json()
+    assert sent["ok"] and sent["result"]["chat"]["id"] == 42 and sent["result"]["text"] == "hello"
+    assert client.post("/botTOKEN/getMe").get_json()["result"]["is_bot"]
+    assert client.post("/botTOKEN/answerCallbackQuery", json={}).get_json() == {"ok": True, "result": True}
+    assert client.get("/stats").get_json() == {"sendMessage": 1, "getMe": 1, "answerCallbackQuery": 1}
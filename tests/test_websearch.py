@@ -0,0 +1,135 @@
+import json, re, socket, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from websearch import BrowserFetcher, BrowserPool, CachedWebSearch, FetchError, HttpFetcher, SearchCache, WebSearch
+
+EGG_RICE = {
+    "@context": "https://schema.org",
+    "@graph": [
+        {"@type": "WebPage", "name": "Egg rice | Fixture Recipes"},
+        {
+            "@type": "Recipe",
+            "name": "Egg &amp; rice",
+            "recipeIngredient": ["2 eggs", "1 cup <b>rice</b>"],
+            "recipeInstructions": [
+                {"@type": "HowToStep", "text": "Boil the rice."},
+                {"@type": "HowToSection", "itemListElement": [{"@type": "HowToStep", "text": "Fry the eggs."}]},
+            ],
+        },
+    ],
+}
+JS_RICE = {"@type": "Recipe", "name": "Rendered rice", "recipeIngredient": ["rice"], "recipeInstructions": "Cook it.\nEat it."}
+
+def recipe_page(data):
+    return '<html><head><title>Fixture</title><script type="application/ld+json">{}</script></head><body></body></html>'.format(json.dumps(data))
+
+# canned pages of a recipe site; /recipe/2/ only has its recipe once
+# JavaScript has run, and /recipe/3/ is gone
+PAGES = {
+    "/search": """<html><body>
+        <a href="/about">About</a>
+        <a href="/recipe/1/egg-rice/">Egg rice</a>
+        <a href="/recipe/1/egg-rice/#reviews">Egg rice reviews</a>
+        <a href="https://elsewhere.example/recipe/9/">Elsewhere</a>
+        <a href="/recipe/2/rendered-rice/">Rendered rice</a>
+        <a href="/recipe/3/gone/">Gone</a>
+    </body></html>""",
+    "/recipe/1/egg-rice/": recipe_page(EGG_RICE),
+    "/recipe/2/rendered-rice/": '<html><body><div id="app">Loading...</div><script src="/app.js"></script></body></html>',
+}
+
+@pytest.fixture
+def site():
+    hits = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            hits.append(path)
+            page = PAGES.get(path)
+            if page is None:
+                self.send_error(404)
+                return
+            body = page.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = "http://127.0.0.1:{}".format(server.server_address[1])
+    server.hits = hits
+    yield server
+    server.shutdown()
+    server.server_close()
+
+# Stands in for headless Chrome: renders /recipe/2/ and fails on anything else.
+class StubBrowser:
+    def __init__(self):
+        self.urls = []
+
+    def fetch(self, url):
+        self.urls.append(url)
+        if "/recipe/2/" in url:
+            return recipe_page(JS_RICE)
+        raise FetchError("could not render " + url)
+
+def web_search(site, *fetchers):
+    return WebSearch(site.url + "/search?q={query}", "^" + re.escape(site.url) + r"/recipe/\d+/", list(fetchers), max_results=5)
+
+def test_search_reads_recipes_from_canned_pages(site):
+    browser = StubBrowser()
+    search = web_search(site, HttpFetcher(timeout=5), browser)
+    try:
+        recipes = {recipe.name: recipe for recipe in search.search("egg rice")}
+    finally:
+        search.close()
+    assert sorted(recipes) == ["Egg & rice", "Rendered rice"]
+    egg_rice = recipes["Egg & rice"]
+    assert egg_rice.url == site.url + "/recipe/1/egg-rice/"
+    assert egg_rice.ingredients == ["2 eggs", "1 cup rice"]
+    assert egg_rice.steps == ["Boil the rice.", "Fry the eggs."]
+    assert recipes["Rendered rice"].steps == ["Cook it.", "Eat it."]
+    # the browser is only a fallback, for pages plain HTTP could not read
+    assert sorted(browser.urls) == [site.url + "/recipe/2/rendered-rice/", site.url + "/recipe/3/gone/"]
+    # links are deduplicated, and other sites and pages are left alone
+    assert site.hits.count("/recipe/1/egg-rice/") == 1
+    assert "/about" not in site.hits
+
+def test_unreachable_site_raises_fetch_error():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    search = WebSearch("http://127.0.0.1:{}/search?q={{query}}".format(port), r"/recipe/\d+/", [HttpFetcher(timeout=5)])
+    try:
+        with pytest.raises(FetchError):
+            list(search.search("egg rice"))
+    finally:
+        search.close()
+
+def test_browser_start_failure_skips_the_page(site):
+    def start_driver():
+        raise RuntimeError("chrome is not installed")
+
+    pool = BrowserPool(size=1, acquire_timeout=1, start_driver=start_driver)
+    search = web_search(site, HttpFetcher(timeout=5), BrowserFetcher(pool))
+    try:
+        assert [recipe.name for recipe in search.search("egg rice")] == ["Egg & rice"]
+    finally:
+        search.close()
+
+def test_cached_search_passes_on_results_and_reuses_them(site, tmp_path):
+    search = CachedWebSearch(web_search(site, HttpFetcher(timeout=5), StubBrowser()), SearchCache(str(tmp_path / "websearch.sqlite")))
+    try:
+        first = sorted(recipe.name for recipe in search.search("Egg  Rice"))
+        hits = len(site.hits)
+        second = sorted(recipe.name for recipe in search.search("egg rice"))
+    finally:
+        search.close()
+    assert first == second == ["Egg & rice", "Rendered rice"]
+    assert len(site.hits) == hits
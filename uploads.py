@@ -0,0 +1,134 @@
+import logging, threading, time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+# Uploads photos to a blob store (see blobstore.py) on a small pool of
+# background threads so handlers can reply straight away. At most max_workers
+# uploads run at once and max_queue more may wait; beyond that submit()
+# refuses the upload. The photo is read into memory by the worker, so nothing
+# is written to local disk.
+#
+# When process is given (e.g. images.process_photo) it turns the photo bytes
+# into (photo, thumbnail) bytes and runs in a pool of `processes` worker
+# processes, so image encoding never holds the GIL of the bot's threads.
+class PhotoUploader:
+    def __init__(self, store, process=None, processes=None, max_workers=2, max_queue=32, retries=3, backoff=1.0):
+        self.store = store
+        self.process = process
+        self.processes = processes
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="photo-upload")
+        self.process_pool = None
+        self.slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+
+    # read_bytes is called on the worker (e.g. a telegram File's
+    # download_as_bytearray), then on_done(url, thumbnail_url) once the photo
+    # is stored, or on_error(exc) after the last attempt has failed.
+    # thumbnail_url is None when there is no process step. Returns False
+    # without queueing anything when the queue is full.
+    def submit(self, read_bytes, on_done, on_error=None, content_type="image/jpeg"):
+        if not self.slots.acquire(blocking=False):
+            return False
+        with self.lock:
+            self.pending += 1
+        try:
+            self.executor.submit(self.run, read_bytes, on_done, on_error, content_type)
+        except RuntimeError:
+            self.release()
+            return False
+        return True
+
+    def run(self, read_bytes, on_done, on_error, content_type):
+        try:
+            try:
+                url, thumbnail_url = self.upload(read_bytes, content_type)
+            except Exception as exc:
+                with self.lock:
+                    self.failed += 1
+                logger.exception("Giving up on a photo upload")
+                if on_error is not None:
+                    on_error(exc)
+                return
+            with self.lock:
+                self.completed += 1
+            on_done(url, thumbnail_url)
+        except Exception:
+            logger.exception("Photo upload callback failed")
+        finally:
+            self.release()
+
+    def upload(self, read_bytes, content_type):
+        data = self.retry(lambda: bytes(read_bytes()))
+        if self.process is None:
+            return self.retry(lambda: self.store.put(data, content_type)), None
+        photo, thumbnail = self.process_in_pool(data)
+        return self.retry(lambda: self.store.put(photo, "image/jpeg")), self.retry(lambda: self.store.put(thumbnail, "image/jpeg"))
+
+    def retry(self, attempt_once):
+        attempt = 0
+        while True:
+            try:
+                return attempt_once()
+            except Exception:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                attempt += 1
+                with self.lock:
+                    self.retried += 1
+                logger.warning("Photo upload failed, retrying in %.1fs", delay, exc_info=True)
+                time.sleep(delay)
+
+    # Processing is deterministic, so unlike the network calls it is not
+    # retried, except once on a new pool when a worker process died (e.g. was
+    # killed for running out of memory): a dead worker breaks the whole pool,
+    # and every photo in it fails, not just the one that was too much.
+    def process_in_pool(self, data):
+        attempt = 0
+        while True:
+            pool = self.get_process_pool()
+            try:
+                return pool.submit(self.process, data).result()
+            except BrokenProcessPool:
+                self.discard_process_pool(pool)
+                if attempt >= 1:
+                    raise
+                attempt += 1
+                logger.warning("Photo processing pool broke, starting a new one", exc_info=True)
+
+    # Worker processes are only started once the first photo needs them.
+    def get_process_pool(self):
+        with self.lock:
+            if self.process_pool is None:
+                self.process_pool = ProcessPoolExecutor(max_workers=self.processes)
+            return self.process_pool
+
+    def discard_process_pool(self, pool):
+        with self.lock:
+            # another upload may already have replaced it
+            if self.process_pool is not pool:
+                return
+            self.process_pool = None
+        pool.shutdown(wait=False)
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+        self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {"queue_depth": self.pending, "completed": self.completed, "failed": self.failed, "retries": self.retried}
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=wait)
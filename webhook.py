@@ -0,0 +1,214 @@
+import argparse, itertools, json, logging, queue, signal, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from flask import Flask, request, Response
+from flask_sslify import SSLify
+from telegram import Update
+from werkzeug.serving import make_server
+
+logger = logging.getLogger(__name__)
+
+# Receives Telegram webhook posts on /<url_path>. Each update is parsed, put
+# on update_queue for the dispatcher and acknowledged straight away, so a slow
+# handler never holds up Telegram's connection. update_queue should be
+# bounded: when it is full the update is refused with a 503 and Telegram
+# delivers it again later, instead of the bot running out of memory. When
+# record is an open text file every accepted update is appended to it as a
+# JSON line, for replaying later. /healthz adds the result of extra_stats(),
+# e.g. a ChatScheduler's per-chat queue metrics, and /metrics serves the
+# plain text returned by metrics(), e.g. sqlstats.QueryStats.metrics.
+def create_webhook_app(bot, update_queue, url_path, force_https=False, record=None, extra_stats=None, metrics=None):
+    app = Flask(__name__)
+    if force_https:
+        SSLify(app, permanent=True)
+    lock = threading.Lock()
+    counts = {"accepted": 0, "refused": 0, "invalid": 0}
+
+    def count(key):
+        with lock:
+            counts[key] += 1
+
+    @app.route("/" + url_path, methods=["POST"])
+    def receive_update():
+        data = request.get_json(force=True, silent=True)
+        update = None if not isinstance(data, dict) else Update.de_json(data, bot)
+        if update is None:
+            count("invalid")
+            return Response("not an update", status=400)
+        try:
+            update_queue.put_nowait(update)
+        except queue.Full:
+            count("refused")
+            return Response("busy", status=503, headers={"Retry-After": "1"})
+        count("accepted")
+        if record is not None:
+            with lock:
+                record.write(json.dumps(data, ensure_ascii=False) + "\n")
+        return Response(status=200)
+
+    @app.route("/healthz")
+    def health():
+        with lock:
+            stats = dict(counts)
+        stats["queue_depth"] = update_queue.qsize()
+        stats["queue_size"] = update_queue.maxsize
+        if extra_stats is not None:
+            stats.update(extra_stats())
+        return stats
+
+    if metrics is not None:
+        @app.route("/metrics")
+        def show_metrics():
+            return Response(metrics(), mimetype="text/plain; version=0.0.4")
+
+    return app
+
+# Serves the webhook with a threaded dispatcher, as the counterpart of
+# Updater.start_polling() + idle(): starts the dispatcher and job queue,
+# registers url + url_path with Telegram and blocks until SIGINT or SIGTERM.
+# Updates still queued on shutdown are handled before the dispatcher stops.
+# on_stop() is called first, e.g. to end long-running jobs the job queue
+# would otherwise wait for.
+def run_webhook(dispatcher, url, url_path, host="0.0.0.0", port=8443, max_connections=40, record=None, drain_timeout=10, on_stop=None, metrics=None):
+    scheduler = getattr(dispatcher, "scheduler", None)
+    app = create_webhook_app(
+        dispatcher.bot, dispatcher.update_queue, url_path, url.startswith("https://"), record,
+        None if scheduler is None else scheduler.stats, metrics
+    )
+    server = make_server(host, port, app, threaded=True)
+    ready = threading.Event()
+    dispatcher_thread = threading.Thread(target=dispatcher.start, kwargs={"ready": ready}, name="dispatcher")
+    dispatcher_thread.start()
+    ready.wait()
+    if dispatcher.job_queue is not None:
+        dispatcher.job_queue.start()
+    server_thread = threading.Thread(target=server.serve_forever, name="webhook")
+    server_thread.start()
+    dispatcher.bot.set_webhook(url.rstrip("/") + "/" + url_path, max_connections=max_connections)
+    logger.info("Receiving updates on %s:%d/%s", host, port, url_path)
+
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+    while not stop.wait(1):
+        pass
+
+    if on_stop is not None:
+        on_stop()
+    server.shutdown()
+    server_thread.join()
+    deadline = time.monotonic() + drain_timeout
+    while dispatcher.update_queue.qsize() > 0 and time.monotonic() < deadline:
+        time.sleep(0.1)
+    if dispatcher.job_queue is not None:
+        dispatcher.job_queue.stop()
+    dispatcher.stop()
+    dispatcher_thread.join()
+
+# A stand-in for the Telegram Bot API, for load tests: point the bot at it
+# with TELEGRAM_API_URL=http://127.0.0.1:<port>/bot and every method
+# succeeds without a network call. Methods that return a Message get a
+# minimal one for the chat they were sent to. GET /stats counts the calls.
+def create_fake_api():
+    app = Flask(__name__)
+    lock = threading.Lock()
+    calls = {}
+    message_ids = itertools.count(1)
+    simple_results = {
+        "getMe": {"id": 1, "is_bot": True, "first_name": "Mama", "username": "fake_mama_bot"},
+        "getUpdates": [],
+    }
+
+    @app.route("/bot<token>/<method>", methods=["GET", "POST"])
+    def call_method(token, method):
+        params = request.get_json(force=True, silent=True) or request.values.to_dict()
+        with lock:
+            calls[method] = calls.get(method, 0) + 1
+            message_id = next(message_ids)
+        if method in simple_results:
+            result = simple_results[method]
+        elif method == "getFile":
+            result = {"file_id": params.get("file_id"), "file_unique_id": "fake", "file_path": "photos/fake.jpg"}
+        elif method.startswith(("send", "edit", "forward", "copy")):
+            result = {
+                "message_id": message_id, "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id") or 0), "type": "private"}, "text": params.get("text")
+            }
+        else:
+            result = True
+        return {"ok": True, "result": result}
+
+    @app.route("/stats")
+    def stats():
+        with lock:
+            return dict(calls)
+
+    return app
+
+# Posts recorded updates (one JSON update per line) to a webhook url, as
+# Telegram would, at up to `rate` updates a second from `concurrency`
+# connections. Returns the number of updates that got each status code
+# (0 for connection errors) and the p50/p99 time to acknowledge.
+def replay(url, updates, rate=None, concurrency=8, repeat=1):
+    bodies = [json.dumps(update).encode("utf-8") for update in updates] * repeat
+    statuses = {}
+    latencies = []
+    lock = threading.Lock()
+
+    def post(body):
+        started = time.perf_counter()
+        try:
+            with urlopen(Request(url, body, {"Content-Type": "application/json"}), timeout=30) as response:
+                status = response.status
+        except HTTPError as exc:
+            status = exc.code
+        except OSError:
+            status = 0
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i, body in enumerate(bodies):
+            if rate:
+                delay = started + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            executor.submit(post, body)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "sent": len(bodies),
+        "statuses": statuses,
+        "seconds": round(elapsed, 3),
+        "per_second": round(len(bodies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2) if latencies else None,
+        "p99_ms": round(latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000, 2) if latencies else None,
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test the BotMaMa webhook with recorded updates.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    replay_parser = commands.add_parser("replay", help="post recorded updates to a running webhook")
+    replay_parser.add_argument("file", help="JSON Lines file of updates, e.g. from WEBHOOK_RECORD")
+    replay_parser.add_argument("url", help="webhook url including its path")
+    replay_parser.add_argument("--rate", type=float, help="updates per second (default: as fast as possible)")
+    replay_parser.add_argument("--concurrency", type=int, default=8)
+    replay_parser.add_argument("--repeat", type=int, default=1, help="send the recorded updates this many times")
+    api_parser = commands.add_parser("fake-api", help="serve a stand-in Telegram Bot API")
+    api_parser.add_argument("--host", default="127.0.0.1")
+    api_parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+
+    if args.command == "replay":
+        with open(args.file, encoding="utf-8") as lines:
+            updates = [json.loads(line) for line in lines if line.strip()]
+        print(json.dumps(replay(args.url, updates, args.rate, args.concurrency, args.repeat)), file=sys.stderr)
+    else:
+        make_server(args.host, args.port, create_fake_api(), threaded=True).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
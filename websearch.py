@@ -0,0 +1,499 @@
+import html, json, logging, re, sqlite3, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from html.parser import HTMLParser
+from urllib.parse import quote_plus, urljoin, urldefrag
+from urllib.request import Request, urlopen
+
+logger = logging.getLogger(__name__)
+
+class FetchError(Exception):
+    pass
+
+# Fetchers turn a URL into the page's HTML, raising FetchError when they
+# cannot. HttpFetcher is a plain HTTP GET and is tried first; BrowserFetcher
+# renders the page in headless Chrome, for sites that only fill in the recipe
+# with JavaScript.
+class HttpFetcher:
+    def __init__(self, timeout=10, max_bytes=2 * 1024 * 1024, user_agent="Mozilla/5.0 (compatible; BotMaMa/1.0)"):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.user_agent = user_agent
+
+    def fetch(self, url):
+        try:
+            with urlopen(Request(url, headers={"User-Agent": self.user_agent}), timeout=self.timeout) as response:
+                body = response.read(self.max_bytes)
+                charset = response.headers.get_content_charset() or "utf-8"
+        except (OSError, ValueError) as exc:
+            raise FetchError("could not fetch {}: {}".format(url, exc)) from exc
+        return body.decode(charset, errors="replace")
+
+def start_chrome(driver_path, timeout):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    options = Options()
+    options.add_argument("--headless")
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    driver = webdriver.Chrome(driver_path, options=options)
+    driver.set_page_load_timeout(timeout)
+    return driver
+
+class BrowserSession:
+    __slots__ = ("driver", "pages")
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.pages = 0
+
+# Keeps up to `size` headless Chrome sessions running between searches, so
+# pages do not wait for chromedriver to be resolved and a browser to start.
+# Callers beyond `size` queue for up to acquire_timeout seconds. An idle
+# session is checked before it is handed out and replaced if it stopped
+# responding; a session is recycled after max_pages pages, or once its
+# JavaScript heap grows past max_memory bytes.
+class BrowserPool:
+    def __init__(self, size=2, max_pages=50, max_memory=512 * 1024 * 1024, acquire_timeout=30, timeout=20, start_driver=None):
+        self.size = size
+        self.max_pages = max_pages
+        self.max_memory = max_memory
+        self.acquire_timeout = acquire_timeout
+        self.timeout = timeout
+        self.start_driver = start_driver
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = []
+        self.lock = threading.Lock()
+        self.setup_lock = threading.Lock()
+        self.closed = False
+        self.counts = {"started": 0, "recycled": 0, "unhealthy": 0, "queued": 0, "timeouts": 0, "pages": 0}
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    # Failures to start a browser, including selenium not being installed,
+    # are raised as FetchError like any other page that could not be fetched.
+    def new_session(self):
+        try:
+            with self.setup_lock:
+                if self.start_driver is None:
+                    # chromedriver is looked up once, not for every browser
+                    from webdriver_manager.chrome import ChromeDriverManager
+                    driver_path = ChromeDriverManager().install()
+                    self.start_driver = lambda: start_chrome(driver_path, self.timeout)
+            session = BrowserSession(self.start_driver())
+        except Exception as exc:
+            raise FetchError("could not start a browser: {}".format(exc)) from exc
+        self.count("started")
+        return session
+
+    def is_healthy(self, session):
+        try:
+            return session.driver.execute_script("return 1") == 1
+        except Exception:
+            return False
+
+    def memory(self, session):
+        try:
+            return session.driver.execute_script("return performance.memory ? performance.memory.usedJSHeapSize : 0") or 0
+        except Exception:
+            return 0
+
+    def acquire(self):
+        if not self.slots.acquire(blocking=False):
+            self.count("queued")
+            if not self.slots.acquire(timeout=self.acquire_timeout):
+                self.count("timeouts")
+                raise FetchError("all {} browsers are busy".format(self.size))
+        try:
+            while True:
+                with self.lock:
+                    session = self.idle.pop() if self.idle else None
+                if session is None:
+                    return self.new_session()
+                if self.is_healthy(session):
+                    return session
+                self.count("unhealthy")
+                self.quit(session)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    # broken sessions (e.g. after a failed page load) are replaced
+    def release(self, session, broken=False, used=True):
+        if used:
+            session.pages += 1
+            self.count("pages")
+        try:
+            worn = session.pages >= self.max_pages or self.memory(session) > self.max_memory
+            with self.lock:
+                keep = not (broken or worn or self.closed)
+                if keep:
+                    self.idle.append(session)
+            if not keep:
+                if worn:
+                    self.count("recycled")
+                self.quit(session)
+        finally:
+            self.slots.release()
+
+    def quit(self, session):
+        try:
+            session.driver.quit()
+        except Exception:
+            logger.warning("Could not quit a browser", exc_info=True)
+
+    # Starts up to n browsers ahead of the first search.
+    def warm(self, n):
+        sessions = []
+        try:
+            for _ in range(min(n, self.size)):
+                sessions.append(self.acquire())
+        except Exception:
+            logger.warning("Could not warm up the browser pool", exc_info=True)
+        for session in sessions:
+            self.release(session, used=False)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats["idle"] = len(self.idle)
+        return stats
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for session in idle:
+            self.quit(session)
+
+# Renders pages with a browser from the pool.
+class BrowserFetcher:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def fetch(self, url):
+        session = self.pool.acquire()
+        broken = False
+        try:
+            session.driver.get(url)
+            return session.driver.page_source
+        except Exception as exc:
+            broken = True
+            raise FetchError("could not render {}: {}".format(url, exc)) from exc
+        finally:
+            self.pool.release(session, broken)
+
+class WebRecipe:
+    __slots__ = ("url", "name", "ingredients", "steps")
+
+    def __init__(self, url, name, ingredients, steps):
+        self.url = url
+        self.name = name
+        self.ingredients = ingredients
+        self.steps = steps
+
+# Collects the page title, its JSON-LD blocks and its links.
+class PageParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.title = ""
+        self.json_ld = []
+        self.links = []
+        self.in_title = False
+        self.in_json_ld = False
+        self.buffer = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "title":
+            self.in_title = True
+        elif tag == "script" and (attrs.get("type") or "").lower() == "application/ld+json":
+            self.in_json_ld = True
+            self.buffer = []
+        elif tag == "a" and attrs.get("href"):
+            self.links.append(attrs["href"])
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self.in_title = False
+        elif tag == "script" and self.in_json_ld:
+            self.in_json_ld = False
+            self.json_ld.append("".join(self.buffer))
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title += data
+        elif self.in_json_ld:
+            self.buffer.append(data)
+
+def parse_page(page):
+    parser = PageParser()
+    parser.feed(page)
+    parser.close()
+    return parser
+
+def find_recipe_data(data):
+    if isinstance(data, list):
+        for item in data:
+            found = find_recipe_data(item)
+            if found is not None:
+                return found
+    elif isinstance(data, dict):
+        types = data.get("@type")
+        if types == "Recipe" or (isinstance(types, list) and "Recipe" in types):
+            return data
+        return find_recipe_data(data.get("@graph"))
+    return None
+
+def clean_text(text):
+    return re.sub(r"\s+", " ", html.unescape(re.sub(r"<[^>]+>", " ", str(text)))).strip()
+
+def instruction_steps(instructions):
+    if isinstance(instructions, str):
+        return [line for line in (clean_text(part) for part in re.split(r"\n+", instructions)) if line]
+    if isinstance(instructions, dict):
+        # a HowToSection lists its steps, a HowToStep has text
+        if "itemListElement" in instructions:
+            return instruction_steps(instructions["itemListElement"])
+        return instruction_steps(instructions.get("text") or instructions.get("name") or "")
+    if isinstance(instructions, list):
+        return [step for item in instructions for step in instruction_steps(item)]
+    return []
+
+# Reads the schema.org Recipe that recipe sites embed as JSON-LD for search
+# engines. Returns None for pages without one, e.g. when it is only added by
+# JavaScript.
+def extract_recipe(url, page):
+    parsed = parse_page(page)
+    for block in parsed.json_ld:
+        try:
+            data = find_recipe_data(json.loads(block))
+        except ValueError:
+            continue
+        if data is None:
+            continue
+        ingredients = [clean_text(item) for item in data.get("recipeIngredient") or data.get("ingredients") or []]
+        steps = instruction_steps(data.get("recipeInstructions"))
+        if ingredients or steps:
+            return WebRecipe(url, clean_text(data.get("name") or parsed.title), ingredients, steps)
+    return None
+
+# Finds recipe pages for a query on a site's search page (search_url with
+# {query} in it) and reads them with the first fetcher that yields a
+# recipe, on up to max_workers threads. Pages come back in the order they
+# finish rather than the order they were found.
+class WebSearch:
+    def __init__(self, search_url, link_pattern, fetchers, max_results=5, max_workers=5):
+        self.search_url = search_url
+        self.link_pattern = re.compile(link_pattern)
+        self.fetchers = fetchers
+        self.max_results = max_results
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="web-search")
+
+    # Raises FetchError if no fetcher could load the search page.
+    def find_links(self, query):
+        url = self.search_url.format(query=quote_plus(query))
+        error = None
+        for fetcher in self.fetchers:
+            try:
+                page = fetcher.fetch(url)
+            except FetchError as exc:
+                error = exc
+                continue
+            links = []
+            for href in parse_page(page).links:
+                link = urldefrag(urljoin(url, href))[0]
+                if self.link_pattern.search(link) and link not in links:
+                    links.append(link)
+            if links:
+                return links[:self.max_results]
+        if error is not None:
+            raise error
+        return []
+
+    def read_recipe(self, url):
+        for fetcher in self.fetchers:
+            try:
+                recipe = extract_recipe(url, fetcher.fetch(url))
+            except FetchError:
+                logger.warning("%s failed on %s", type(fetcher).__name__, url, exc_info=True)
+                continue
+            if recipe is not None:
+                return recipe
+        return None
+
+    # Yields each recipe found for the query as soon as its page is read.
+    def search(self, query):
+        futures = [self.executor.submit(self.read_recipe, link) for link in self.find_links(query)]
+        try:
+            for future in as_completed(futures):
+                recipe = future.result()
+                if recipe is not None:
+                    yield recipe
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for fetcher in self.fetchers:
+            if hasattr(fetcher, "close"):
+                fetcher.close()
+
+def normalize_query(query):
+    return " ".join(query.casefold().split())
+
+# The results of one search as they come in, for every caller waiting on it.
+class Flight:
+    def __init__(self):
+        self.results = []
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def add(self, recipe):
+        with self.condition:
+            self.results.append(recipe)
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+    def follow(self):
+        i = 0
+        while True:
+            with self.condition:
+                while i >= len(self.results) and not self.done:
+                    self.condition.wait()
+                if i < len(self.results):
+                    recipe = self.results[i]
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+            i += 1
+            yield recipe
+
+# Keeps JSON-serializable results by key in their own SQLite file, for up to
+# ttl seconds. Beyond max_entries the least recently used are evicted.
+class SearchCache:
+    def __init__(self, dbname="websearch.sqlite", ttl=24 * 3600, max_entries=1000, busy_timeout=5.0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(dbname, timeout=busy_timeout, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        stmt = (''' CREATE TABLE IF NOT EXISTS search_result
+                   (query TEXT PRIMARY KEY,
+                    results TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    used_at REAL NOT NULL
+                   );''')
+        self.conn.execute(stmt)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS search_result_used_idx ON search_result (used_at)")
+        self.conn.commit()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, query):
+        now = time.time()
+        stmt = "SELECT results, created_at FROM search_result WHERE query = (?)"
+        args = (query, )
+        with self.lock:
+            row = self.conn.execute(stmt, args).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if row[1] < now - self.ttl:
+                self.misses += 1
+                self.expired += 1
+                self.conn.execute("DELETE FROM search_result WHERE query = (?)", args)
+                self.conn.commit()
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE search_result SET used_at = (?) WHERE query = (?)", (now, query))
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, query, results):
+        now = time.time()
+        stmt = "INSERT OR REPLACE INTO search_result (query, results, created_at, used_at) VALUES (?, ?, ?, ?)"
+        args = (query, json.dumps(results, ensure_ascii=False), now, now)
+        with self.lock:
+            self.conn.execute(stmt, args)
+            self.conn.execute("DELETE FROM search_result WHERE created_at < (?)", (now - self.ttl, ))
+            stmt = ("DELETE FROM search_result WHERE query IN "
+                    "(SELECT query FROM search_result ORDER BY used_at DESC LIMIT -1 OFFSET (?))")
+            self.evictions += self.conn.execute(stmt, (self.max_entries, )).rowcount
+            self.conn.commit()
+
+    def stats(self):
+        with self.lock:
+            size = self.conn.execute("SELECT COUNT(*) FROM search_result").fetchone()[0]
+            lookups = self.hits + self.misses
+            hit_rate = self.hits / lookups if lookups else 0.0
+            return {"size": size, "evictions": self.evictions, "expired": self.expired, "hits": self.hits, "misses": self.misses, "hit_rate": hit_rate}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# Puts a SearchCache in front of a WebSearch, keyed by the
+# normalized query. Concurrent searches for the same query share a single
+# web search, which runs on its own thread so it completes (and is cached)
+# even if the caller that started it stops listening; every caller still
+# gets recipes as they arrive. Failed searches are not cached.
+class CachedWebSearch:
+    def __init__(self, web_search, cache):
+        self.web_search = web_search
+        self.cache = cache
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.shared = 0
+
+    def search(self, query):
+        key = normalize_query(query)
+        cached = self.cache.get(key)
+        if cached is not None:
+            for url, name, ingredients, steps in cached:
+                yield WebRecipe(url, name, ingredients, steps)
+            return
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = Flight()
+                threading.Thread(target=self.run, args=(key, query, flight), name="web-search-flight", daemon=True).start()
+            else:
+                self.shared += 1
+        yield from flight.follow()
+
+    def run(self, key, query, flight):
+        error = None
+        try:
+            for recipe in self.web_search.search(query):
+                flight.add(recipe)
+            self.cache.put(key, [[recipe.url, recipe.name, recipe.ingredients, recipe.steps] for recipe in flight.results])
+        except Exception as exc:
+            error = exc
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.finish(error)
+
+    def stats(self):
+        stats = self.cache.stats()
+        with self.lock:
+            stats["shared"] = self.shared
+            stats["in_flight"] = len(self.flights)
+        return stats
+
+    def close(self):
+        self.web_search.close()
+        self.cache.close()